@@ -0,0 +1,74 @@
+#!/usr/bin/python
+
+"""Parses or extracts the MPOs in zip and tar archives without unpacking them.
+
+Writes one JSON line per member, as batch_parse_mpo.py does for files. By
+default only the headers of each member are read. With --extract-dir or
+--extract-tar the left and right images are streamed out of the archive as
+each member is read.
+"""
+
+import sys, os, json, time, optparse
+
+import mpo_archive
+
+def Main(argv):
+  option_parser = optparse.OptionParser(
+      usage='%prog [options] <zip-or-tar-file>...')
+  option_parser.add_option('--extract-dir',
+      help='Write the images of each member under this directory')
+  option_parser.add_option('--extract-tar',
+      help='Write the images of each member into this tar file, '
+          'compressed if it ends in .gz or .bz2')
+  options, args = option_parser.parse_args(argv)
+  if not args:
+    option_parser.error('Expected at least one archive, or - for a tar '
+        'stream on stdin')
+  if options.extract_dir and options.extract_tar:
+    option_parser.error('Expected at most one of --extract-dir and '
+        '--extract-tar')
+
+  write_image = None
+  if options.extract_dir:
+    write_image = mpo_archive.DirectoryImageWriter(options.extract_dir)
+  elif options.extract_tar:
+    write_image = mpo_archive.TarImageWriter(options.extract_tar)
+  start = time.time()
+  num_members = 0
+  num_failed = 0
+  total_bytes = 0
+  header_bytes = 0
+  try:
+    for archive_filename in args:
+      for member in mpo_archive.IterArchiveMembers(archive_filename):
+        result = {'path': '%s:%s' % (archive_filename, member.name)}
+        try:
+          if write_image:
+            parser = mpo_archive.ExtractMember(member, write_image)
+          else:
+            parser = mpo_archive.ParseMember(member)
+            header_bytes += parser.bytes_read
+          result.update(parser.GetInfo().ToDict())
+        except Exception, e:
+          num_failed += 1
+          result['error'] = '%s: %s' % (e.__class__.__name__, e)
+          result['file_size'] = member.size
+        num_members += 1
+        total_bytes += member.size
+        sys.stdout.write(json.dumps(result, sort_keys=True) + '\n')
+  finally:
+    if options.extract_tar:
+      write_image.Close()
+  elapsed = max(time.time() - start, 1e-6)
+
+  sys.stderr.write('%s %d members (%d failed) in %.2fs: %.1f members/s, '
+      '%.1f MB/s\n' % (write_image and 'Extracted' or 'Parsed', num_members,
+      num_failed, elapsed, num_members / elapsed,
+      total_bytes / elapsed / (1 << 20)))
+  if not write_image:
+    sys.stderr.write('Header bytes read: %d of %d\n' % (header_bytes,
+        total_bytes))
+  return num_failed and 1 or 0
+
+if __name__ == '__main__':
+  sys.exit(Main(sys.argv[1:]))
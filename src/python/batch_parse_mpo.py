@@ -0,0 +1,193 @@
+#!/usr/bin/python
+
+"""Parses many MPO files in parallel and writes one JSON line per file."""
+
+import sys, os, glob, json, time, itertools, multiprocessing, optparse
+
+import mpo, mpo_cache, mpo_trace
+
+MPO_EXTENSIONS = ('.mpo',)
+
+def FindMpoFiles(paths):
+  """Expands directories and glob patterns into a list of MPO file paths."""
+  filenames = []
+  for path in paths:
+    matches = glob.glob(path) or [path]
+    for match in sorted(matches):
+      if os.path.isdir(match):
+        for dirpath, dirnames, names in os.walk(match):
+          dirnames.sort()
+          for name in sorted(names):
+            if os.path.splitext(name)[1].lower() in MPO_EXTENSIONS:
+              filenames.append(os.path.join(dirpath, name))
+      else:
+        filenames.append(match)
+  return filenames
+
+def ParseInfo(filename, full, estimate_parallax, recover, tracer):
+  if not (full or estimate_parallax):
+    return mpo.ParseMpoFile(filename, recover=recover, tracer=tracer)
+  mpo_file = open(filename, 'rb')
+  try:
+    data = mpo.MapFile(mpo_file)
+    try:
+      parser = mpo.ImageParser(data, tracer=tracer)
+      info = parser.Parse(recover)
+      if estimate_parallax and info.GetParallaxXOffset() is None:
+        # Imported here so that NumPy is only needed when estimating.
+        import estimate_parallax
+        info.estimated_parallax_x_offset = (
+            estimate_parallax.EstimateParallaxXOffset(parser))
+      return info
+    finally:
+      data.close()
+  finally:
+    mpo_file.close()
+
+def GetProfileFilename(profile_dir, filename):
+  return os.path.join(profile_dir, '%s.prof' % os.path.basename(filename))
+
+def ParseOne(args):
+  (filename, full, estimate_parallax, recover, stats, profile_dir,
+      trace_memory) = args
+  result = {'path': filename}
+  tracer = None
+  if stats:
+    tracer = mpo_trace.Tracer()
+    # Warnings go in the result so that problem files can be found.
+    warnings = []
+    tracer.AddListener(lambda event: warnings.append(event.GetMessage()))
+  try:
+    if profile_dir or trace_memory:
+      profile_filename = None
+      if profile_dir:
+        profile_filename = GetProfileFilename(profile_dir, filename)
+      info, profile_stats = mpo_trace.RunProfiled(ParseInfo,
+          (filename, full, estimate_parallax, recover, tracer),
+          profile_filename, trace_memory)
+      result.update(profile_stats)
+    else:
+      info = ParseInfo(filename, full, estimate_parallax, recover, tracer)
+    result.update(info.ToDict())
+  except Exception, e:
+    result['error'] = '%s: %s' % (e.__class__.__name__, e)
+    try:
+      result['file_size'] = os.path.getsize(filename)
+    except OSError:
+      result['file_size'] = 0
+  if tracer is not None:
+    if warnings:
+      result['warnings'] = warnings
+    result['trace'] = tracer.GetStats()
+  return result
+
+def Main(argv):
+  option_parser = optparse.OptionParser(
+      usage='%prog [options] <dir-or-glob>...')
+  option_parser.add_option('-j', '--jobs', type='int',
+      default=multiprocessing.cpu_count(),
+      help='Number of worker processes [default: %default]')
+  option_parser.add_option('--chunksize', type='int', default=16,
+      help='Files handed to a worker at a time [default: %default]')
+  option_parser.add_option('--ordered', action='store_true', default=False,
+      help='Write results in input order instead of completion order')
+  option_parser.add_option('--full', action='store_true', default=False,
+      help='Map and parse whole files instead of only their headers')
+  option_parser.add_option('--estimate-parallax', action='store_true',
+      default=False, help='Estimate the parallax of files without a '
+          'makernote value (needs NumPy and PIL)')
+  option_parser.add_option('--recover', action='store_true', default=False,
+      help='Split files with an unusable MP Index by scanning for images')
+  option_parser.add_option('--stats', action='store_true', default=False,
+      help='Report calls and time per parse stage over all files, and list '
+          'parse warnings in each result')
+  option_parser.add_option('--profile-dir',
+      help='Write a cProfile profile of each file to this directory')
+  option_parser.add_option('--trace-memory', action='store_true',
+      default=False, help='Record the peak memory use of each file')
+  option_parser.add_option('--cache',
+      help='SQLite file to cache results in across runs')
+  option_parser.add_option('--cache-max-entries', type='int',
+      default=mpo_cache.DEFAULT_MAX_ENTRIES,
+      help='Evict least recently used entries past this [default: %default]')
+  option_parser.add_option('--cache-verify', action='store_true',
+      default=False, help='Also require the SHA-1 of cached files to match')
+  options, args = option_parser.parse_args(argv)
+  if not args:
+    option_parser.error('Expected at least one directory or glob')
+
+  filenames = FindMpoFiles(args)
+  start = time.time()
+  cache = None
+  if options.cache:
+    cache = mpo_cache.MpoCache(options.cache, options.cache_max_entries,
+        options.cache_verify)
+  # Cache lookups happen here so that only misses are sent to the pool. The
+  # key of each miss holds its stat from before the parse, for cache.Put.
+  cache_mode = mpo_cache.GetMode(options.full, options.recover,
+      options.estimate_parallax)
+  cache_keys = {}
+  cached_results = {}
+  tasks = []
+  for i, filename in enumerate(filenames):
+    info = None
+    if cache:
+      try:
+        cache_keys[filename] = cache.GetKey(filename, cache_mode)
+        info = cache.Get(cache_keys[filename])
+      except OSError:
+        pass
+    if info is not None:
+      cached_results[i] = dict(info.ToDict(), path=filename, cached=True)
+    else:
+      tasks.append((filename, options.full, options.estimate_parallax,
+          options.recover, options.stats, options.profile_dir,
+          options.trace_memory))
+
+  if options.profile_dir and not os.path.isdir(options.profile_dir):
+    os.makedirs(options.profile_dir)
+  tracer = mpo_trace.Tracer()
+  pool = multiprocessing.Pool(max(options.jobs, 1))
+  try:
+    if options.ordered:
+      parsed_results = pool.imap(ParseOne, tasks, options.chunksize)
+      results = (cached_results.get(i) or parsed_results.next()
+          for i in xrange(len(filenames)))
+    else:
+      parsed_results = pool.imap_unordered(ParseOne, tasks, options.chunksize)
+      results = itertools.chain(cached_results.itervalues(), parsed_results)
+    num_failed = 0
+    total_bytes = 0
+    for result in results:
+      if 'trace' in result:
+        tracer.Merge(result.pop('trace'))
+      if 'error' in result:
+        num_failed += 1
+      elif result['path'] in cache_keys and not result.get('cached'):
+        cache.Put(cache_keys[result['path']], mpo.MpoInfo.FromDict(result))
+      total_bytes += result['file_size']
+      sys.stdout.write(json.dumps(result, sort_keys=True) + '\n')
+      sys.stdout.flush()
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+    if cache:
+      cache.Close()
+  elapsed = max(time.time() - start, 1e-6)
+
+  sys.stderr.write('Parsed %d files (%d failed) in %.2fs: %.1f files/s, '
+      '%.1f MB/s\n' % (len(filenames), num_failed, elapsed,
+      len(filenames) / elapsed, total_bytes / elapsed / (1 << 20)))
+  if cache:
+    sys.stderr.write('Cache: %(hits)d hits, %(misses)d misses, '
+        '%(invalidations)d invalidated, %(evictions)d evicted\n'
+        % cache.GetStats())
+  if options.stats:
+    sys.stderr.write(''.join(line + '\n' for line in tracer.FormatStats()))
+  return num_failed and 1 or 0
+
+if __name__ == '__main__':
+  sys.exit(Main(sys.argv[1:]))
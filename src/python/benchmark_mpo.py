@@ -0,0 +1,350 @@
+#!/usr/bin/python
+
+"""Benchmarks MPO header parsing, full parsing and image extraction.
+
+Runs over the sample images and a generated corpus of MPOs with large APP
+segments. Each stage runs in its own process so that its peak RSS can be
+reported. The benchmarks are run --runs times and each figure is the median
+of the runs. Results can be saved as JSON and compared against a baseline.
+
+--self-test times nothing and instead checks generated files the sample
+images do not cover: a multi-image MPO with a non-JPEG MP entry and entries
+out of file order must parse and index like a mapped parse, and the SHORT
+tags of big endian Exif must decode to their values.
+"""
+
+import sys, os, io, json, time, shutil, struct, tempfile, resource, optparse
+import multiprocessing
+
+import mpo, mpo_writer, batch_parse_mpo
+
+SAMPLE_IMAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', '..', 'sampleimages')
+
+STAGES = ('headers', 'parse', 'extract')
+
+# APP segments used to pad synthetic files. APP3 is not used by MPO readers.
+PADDING_MARKER = 0xffe3
+# Sizes of a whole padding segment: its marker, its length field, which
+# counts itself, and its payload.
+MIN_PADDING_SEGMENT_SIZE = 4
+MAX_PADDING_SEGMENT_SIZE = 0xffff + 2
+
+def HeadersStage(filename, output_dir):
+  mpo.ParseMpoFile(filename)
+
+def ParseStage(filename, output_dir):
+  mpo_file = open(filename, 'rb')
+  try:
+    data = mpo.MapFile(mpo_file)
+    try:
+      mpo.ParseMpo(data)
+    finally:
+      data.close()
+  finally:
+    mpo_file.close()
+
+def ExtractStage(filename, output_dir):
+  mpo.ExtractImages(filename, os.path.join(output_dir, 'image%d.jpg'))
+
+STAGE_FUNCTIONS = {
+  'headers': HeadersStage,
+  'parse': ParseStage,
+  'extract': ExtractStage,
+}
+
+def Percentile(sorted_values, fraction):
+  index = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+  return sorted_values[index]
+
+def RunStage(args):
+  """Times one stage over a corpus. Runs in a fresh worker process."""
+  stage, filenames, repeat = args
+  stage_function = STAGE_FUNCTIONS[stage]
+  output_dir = tempfile.mkdtemp()
+  try:
+    latencies = []
+    total_bytes = 0
+    start = time.time()
+    for i in xrange(repeat):
+      for filename in filenames:
+        file_start = time.time()
+        stage_function(filename, output_dir)
+        latencies.append(time.time() - file_start)
+        total_bytes += os.path.getsize(filename)
+    elapsed = max(time.time() - start, 1e-9)
+  finally:
+    shutil.rmtree(output_dir)
+  latencies.sort()
+  return {
+    'files': len(latencies),
+    'p50_ms': Percentile(latencies, 0.5) * 1000,
+    'p90_ms': Percentile(latencies, 0.9) * 1000,
+    'p99_ms': Percentile(latencies, 0.99) * 1000,
+    'files_per_s': len(latencies) / elapsed,
+    'mb_per_s': total_bytes / elapsed / (1 << 20),
+    'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+  }
+
+def PadMpo(data, padding_size):
+  """Returns data with padding_size bytes of APP segments after the first SOI.
+
+  A segment takes at least 4 bytes, so padding_size may not be 1 to 3. The
+  padding shifts the MP endian marker along with the second image, so only
+  the size of the first image in the MP Entry table needs updating.
+  """
+  mpo.Assert(padding_size == 0 or padding_size >= MIN_PADDING_SEGMENT_SIZE,
+      'Padding must be 0 or at least %d bytes' % MIN_PADDING_SEGMENT_SIZE)
+  parser = mpo.ImageParser(data)
+  parser.Parse()
+  segments = []
+  remaining = padding_size
+  while remaining > 0:
+    segment_size = min(remaining, MAX_PADDING_SEGMENT_SIZE)
+    # Leave enough for a whole last segment.
+    if 0 < remaining - segment_size < MIN_PADDING_SEGMENT_SIZE:
+      segment_size -= MIN_PADDING_SEGMENT_SIZE
+    segments.append(struct.pack('>HH', PADDING_MARKER, segment_size - 2))
+    segments.append('\0' * (segment_size - 4))
+    remaining -= segment_size
+  padding = ''.join(segments)
+  mpo.AssertEquals(padding_size, len(padding))
+  size_offset = parser.mp_entry_offset + 4
+  size_format = mpo.EndianPrefix(parser.mp_is_big_endian) + 'I'
+  image_size = struct.unpack_from(size_format, data, size_offset)[0]
+  size_offset += len(padding)
+  padded = data[:2] + padding + data[2:]
+  return (padded[:size_offset]
+      + struct.pack(size_format, image_size + len(padding))
+      + padded[size_offset + 4:])
+
+def GenerateCorpus(template_filename, output_dir, count, max_padding):
+  template = open(template_filename, 'rb').read()
+  filenames = []
+  for i in xrange(count):
+    # Vary the padding so the corpus covers small and large headers.
+    padding_size = max_padding * (i + 1) // count
+    if 0 < padding_size < MIN_PADDING_SEGMENT_SIZE:
+      padding_size = MIN_PADDING_SEGMENT_SIZE
+    filename = os.path.join(output_dir, 'synthetic%05d.mpo' % i)
+    out_file = open(filename, 'wb')
+    out_file.write(PadMpo(template, padding_size))
+    out_file.close()
+    filenames.append(filename)
+  return filenames
+
+def GenerateMultiImageMpo(template_filename):
+  """Returns a 3 image MPO of the template's left image whose MP Entries are
+  not in file order: entry 1 is the last image in the file and entry 2, the
+  middle one, is flagged as not being a JPEG."""
+  parser = mpo.ImageParser(open(template_filename, 'rb').read())
+  parser.Parse()
+  left = str(parser.GetImageData(0))
+  out = io.BytesIO()
+  mpo_writer.MpoWriter().WriteImages([io.BytesIO(left) for i in xrange(3)],
+      out)
+  data = bytearray(out.getvalue())
+  parser = mpo.ImageParser(str(data))
+  parser.Parse()
+  entry_size = mpo.MP_ENTRY_STRUCTS[parser.mp_is_big_endian].size
+  first = parser.mp_entry_offset + entry_size
+  second = first + entry_size
+  data[first:second], data[second:second + entry_size] = (
+      data[second:second + entry_size], data[first:second])
+  # The data format is in the low bits of the attribute's top byte.
+  attribute_format = mpo.EndianPrefix(parser.mp_is_big_endian) + 'I'
+  attribute = struct.unpack_from(attribute_format, data, second)[0]
+  struct.pack_into(attribute_format, data, second, attribute | 1 << 24)
+  return str(data)
+
+def CheckMultiImageMpo(filename):
+  """Raises unless a file from GenerateMultiImageMpo parses and indexes
+  from its headers the same as when mapped."""
+  data = open(filename, 'rb').read()
+  parser = mpo.ImageParser(data)
+  info = parser.Parse()
+  mpo.AssertEquals([0, 2, 1], parser.GetImagesInFileOrder(),
+      'Expected entries out of file order')
+  mpo.Assert(not parser.IsJpegImage(2), 'Expected a non-JPEG entry')
+  header_info, segment_index = mpo.IndexMpoFile(filename)
+  mpo.AssertEquals(info.ToDict(), header_info.ToDict(),
+      'Header parse differs from mapped parse')
+  mpo.AssertEquals(parser.IndexSegments().ToDict(), segment_index.ToDict(),
+      'Header segment index differs from mapped index')
+  mpo.AssertEquals(3, segment_index.GetImageCount())
+  mpo.AssertEquals(0, len(segment_index.GetImageEntries(2)),
+      'Non-JPEG entry should have no segments')
+  mpo.AssertEquals(parser.image_offsets[1] + 2,
+      segment_index.offsets[segment_index.GetImageEntries(1)[0]],
+      'Segments of entry 1 should start after its SOI')
+
+# Exif tags and values written by GenerateBigEndianExifMpo as (tag id, type,
+# value): Orientation and PixelXDimension as SHORTs, which take the first two
+# bytes of their payload, and PixelYDimension as a LONG.
+BIG_ENDIAN_EXIF_IFD0_ROWS = [(274, 3, 6)]
+BIG_ENDIAN_EXIF_IFD_ROWS = [(40962, 3, 640), (40963, 4, 480)]
+EXIF_IFD_POINTER_TAG = 34665
+
+def EncodeBigEndianIfd(rows, next_ifd_offset):
+  parts = [struct.pack('>H', len(rows))]
+  for tag_id, tag_type, value in rows:
+    if tag_type == 3:
+      payload = struct.pack('>HH', value, 0)
+    else:
+      payload = struct.pack('>I', value)
+    parts.append(struct.pack('>HHI', tag_id, tag_type, 1) + payload)
+  parts.append(struct.pack('>I', next_ifd_offset))
+  return ''.join(parts)
+
+def GenerateBigEndianExifMpo(template_filename):
+  """Returns a stereo MPO of the template's left image whose only APP1 is
+  big endian Exif holding the rows above."""
+  parser = mpo.ImageParser(open(template_filename, 'rb').read())
+  parser.Parse()
+  left = str(parser.GetImageData(0))
+  ifd0_rows = BIG_ENDIAN_EXIF_IFD0_ROWS + [(EXIF_IFD_POINTER_TAG, 4,
+      8 + mpo_writer.GetIfdSize(len(BIG_ENDIAN_EXIF_IFD0_ROWS) + 1))]
+  exif = mpo_writer.EncodeAppSegment(mpo.APP1_MARKER, ''.join([
+    mpo.EXIF_FORMAT_IDENTIFIER,
+    mpo.BIG_ENDIAN_TAG,
+    struct.pack('>I', 8),
+    EncodeBigEndianIfd(ifd0_rows, 0),
+    EncodeBigEndianIfd(BIG_ENDIAN_EXIF_IFD_ROWS, 0),
+  ]))
+  body_offset = mpo_writer.SourceJpeg(io.BytesIO(left)).body_offset
+  jpeg = left[:2] + exif + left[body_offset:]
+  out = io.BytesIO()
+  mpo_writer.MpoWriter().WriteImages([io.BytesIO(jpeg) for i in xrange(2)],
+      out)
+  return out.getvalue()
+
+def CheckBigEndianExifMpo(filename):
+  """Raises unless the Exif of a file from GenerateBigEndianExifMpo decodes
+  to the values written, from its headers and when mapped."""
+  expected = dict((tag_id, (tag_type, 1, value)) for tag_id, tag_type, value
+      in BIG_ENDIAN_EXIF_IFD0_ROWS + BIG_ENDIAN_EXIF_IFD_ROWS)
+  data = open(filename, 'rb').read()
+  for info in (mpo.ParseMpo(data), mpo.ParseMpoFile(filename)):
+    exif_tags = info.images[0].exif_tags
+    mpo.AssertEquals(expected, dict((tag_id, exif_tags.get(tag_id))
+        for tag_id in expected), 'Big endian Exif decoded wrongly')
+
+def RunSelfTest(template_filename):
+  """Runs the checks of generated files, raising on the first failure."""
+  test_dir = tempfile.mkdtemp()
+  try:
+    multi_image_filename = os.path.join(test_dir, 'multi.mpo')
+    open(multi_image_filename, 'wb').write(GenerateMultiImageMpo(
+        template_filename))
+    CheckMultiImageMpo(multi_image_filename)
+    big_endian_filename = os.path.join(test_dir, 'big_endian_exif.mpo')
+    open(big_endian_filename, 'wb').write(GenerateBigEndianExifMpo(
+        template_filename))
+    CheckBigEndianExifMpo(big_endian_filename)
+  finally:
+    shutil.rmtree(test_dir)
+
+def RunBenchmarks(corpora, repeat):
+  results = {}
+  for corpus_name, filenames in corpora:
+    for stage in STAGES:
+      # One process per stage so peak RSS reflects only that stage.
+      pool = multiprocessing.Pool(1, maxtasksperchild=1)
+      try:
+        results['%s/%s' % (corpus_name, stage)] = pool.apply(RunStage,
+            ((stage, filenames, repeat),))
+        pool.close()
+      finally:
+        pool.join()
+  return results
+
+def GetMedianResults(runs):
+  """Returns the median of each figure of each stage over a list of results
+  from RunBenchmarks."""
+  results = {}
+  for key, stage_result in runs[0].iteritems():
+    results[key] = dict((field, sorted(run[key][field] for run in runs)[
+        len(runs) // 2]) for field in stage_result)
+  return results
+
+def CompareToBaseline(results, baseline, threshold, noise_floor_ms):
+  """Returns descriptions of stages whose p50 regressed by over threshold
+  and by over noise_floor_ms."""
+  regressions = []
+  for key, stage_result in sorted(results.iteritems()):
+    if key not in baseline:
+      continue
+    baseline_p50 = baseline[key]['p50_ms']
+    if baseline_p50 and stage_result['p50_ms'] > (baseline_p50
+        * (1 + threshold) + noise_floor_ms):
+      regressions.append('%s: p50 %.3f ms vs baseline %.3f ms' % (
+          key, stage_result['p50_ms'], baseline_p50))
+  return regressions
+
+def Main(argv):
+  option_parser = optparse.OptionParser(usage='%prog [options] [<mpo-dir>]')
+  option_parser.add_option('-r', '--repeat', type='int', default=5,
+      help='Passes over the sample images [default: %default]')
+  option_parser.add_option('--runs', type='int', default=3,
+      help='Runs of the benchmarks to take the median of '
+          '[default: %default]')
+  option_parser.add_option('--synthetic-count', type='int', default=2000,
+      help='Number of generated MPOs, 0 to skip [default: %default]')
+  option_parser.add_option('--synthetic-padding', type='int', default=1 << 20,
+      help='Largest APP padding in a generated MPO [default: %default]')
+  option_parser.add_option('-o', '--output',
+      help='Write results as JSON to this file')
+  option_parser.add_option('-b', '--baseline',
+      help='JSON results to compare against')
+  option_parser.add_option('-t', '--threshold', type='float', default=0.1,
+      help='Allowed p50 slowdown against the baseline [default: %default]')
+  option_parser.add_option('--noise-floor-ms', type='float', default=0.1,
+      help='p50 slowdown in ms always allowed as timing noise '
+          '[default: %default]')
+  option_parser.add_option('--self-test', action='store_true', default=False,
+      help='Check parsing of generated multi-image files instead of '
+          'benchmarking')
+  options, args = option_parser.parse_args(argv)
+  if options.runs < 1:
+    option_parser.error('--runs must be at least 1')
+
+  sample_filenames = batch_parse_mpo.FindMpoFiles(args or [SAMPLE_IMAGES_DIR])
+  if not sample_filenames:
+    option_parser.error('No MPO files found')
+  if options.self_test:
+    RunSelfTest(sample_filenames[0])
+    print 'Self test passed'
+    return 0
+  corpora = [('samples', sample_filenames)]
+  corpus_dir = tempfile.mkdtemp()
+  try:
+    if options.synthetic_count > 0:
+      corpora.append(('synthetic', GenerateCorpus(sample_filenames[0],
+          corpus_dir, options.synthetic_count, options.synthetic_padding)))
+    results = GetMedianResults([RunBenchmarks(corpora, options.repeat)
+        for i in xrange(options.runs)])
+  finally:
+    shutil.rmtree(corpus_dir)
+
+  for key, stage_result in sorted(results.iteritems()):
+    print ('%-18s %6d files  p50 %8.3f ms  p90 %8.3f ms  p99 %8.3f ms  '
+        '%8.1f MB/s  peak RSS %d KB' % (key, stage_result['files'],
+        stage_result['p50_ms'], stage_result['p90_ms'],
+        stage_result['p99_ms'], stage_result['mb_per_s'],
+        stage_result['peak_rss_kb']))
+  if options.output:
+    out_file = open(options.output, 'w')
+    json.dump(results, out_file, indent=2, sort_keys=True)
+    out_file.close()
+  if options.baseline:
+    regressions = CompareToBaseline(results,
+        json.load(open(options.baseline)), options.threshold,
+        options.noise_floor_ms)
+    for regression in regressions:
+      print 'REGRESSION %s' % regression
+    if regressions:
+      return 1
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(Main(sys.argv[1:]))
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+
+"""Indexes perceptual hashes of MPO files and finds near duplicates.
+
+Files under the given directories or globs are hashed in parallel and added
+to the --index file; files whose size and mtime are unchanged since they
+were last hashed are skipped. Then:
+
+  --query <file>      writes one JSON line listing the indexed files near it
+  --find-duplicates   writes one JSON line per group of near duplicates
+
+See mpo_dedup.py for the hash and the index. Requires NumPy and PIL.
+"""
+
+import sys, os, json, time, multiprocessing, optparse
+
+import batch_parse_mpo, mpo_dedup
+
+def HashOne(args):
+  filename, size, mtime, source = args
+  try:
+    hash_value, used_source = mpo_dedup.HashFile(filename, source)
+  except Exception, e:
+    return filename, size, mtime, None, '%s: %s' % (e.__class__.__name__, e)
+  return filename, size, mtime, (hash_value, used_source), None
+
+def IndexFiles(index, filenames, source, jobs, chunksize):
+  """Hashes the files that are new or changed and returns (hashed, failed,
+  unchanged) counts."""
+  tasks = []
+  num_unchanged = 0
+  for filename in filenames:
+    path = os.path.abspath(filename)
+    try:
+      st = os.stat(path)
+    except OSError:
+      continue
+    if index.IsCurrent(path, st.st_size, st.st_mtime):
+      num_unchanged += 1
+    else:
+      tasks.append((path, st.st_size, st.st_mtime, source))
+  num_hashed = 0
+  num_failed = 0
+  if not tasks:
+    return num_hashed, num_failed, num_unchanged
+  pool = multiprocessing.Pool(max(jobs, 1))
+  try:
+    for path, size, mtime, result, error in pool.imap_unordered(HashOne,
+        tasks, chunksize):
+      if error:
+        num_failed += 1
+        sys.stderr.write('%s: %s\n' % (path, error))
+        continue
+      hash_value, used_source = result
+      index.Put(path, size, mtime, hash_value, used_source)
+      num_hashed += 1
+      # Committed as it goes so that an interrupted run keeps its work.
+      if num_hashed % 1000 == 0:
+        index.Commit()
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+    index.Commit()
+  return num_hashed, num_failed, num_unchanged
+
+def Main(argv):
+  option_parser = optparse.OptionParser(
+      usage='%prog [options] --index <index-file> [<dir-or-glob>...]')
+  option_parser.add_option('--index',
+      help='SQLite file holding the hashes')
+  option_parser.add_option('--query',
+      help='List the indexed files near this MPO')
+  option_parser.add_option('--find-duplicates', action='store_true',
+      default=False, help='List every group of near duplicates')
+  option_parser.add_option('-t', '--threshold', type='int',
+      default=mpo_dedup.DEFAULT_THRESHOLD,
+      help='Most bits of 64 two near duplicates differ by, up to %d '
+          '[default: %%default]' % mpo_dedup.MAX_THRESHOLD)
+  option_parser.add_option('--source', default='auto',
+      choices=mpo_dedup.SOURCES,
+      help='Hash the Exif thumbnail, the decoded image, or the thumbnail '
+          'where there is one (auto) [default: %default]')
+  option_parser.add_option('--prune', action='store_true', default=False,
+      help='Forget indexed files that no longer exist')
+  option_parser.add_option('-j', '--jobs', type='int',
+      default=multiprocessing.cpu_count(),
+      help='Number of worker processes [default: %default]')
+  option_parser.add_option('--chunksize', type='int', default=16,
+      help='Files handed to a worker at a time [default: %default]')
+  options, args = option_parser.parse_args(argv)
+  if not options.index:
+    option_parser.error('Expected --index')
+  if not (args or options.query or options.find_duplicates or options.prune):
+    option_parser.error('Expected files to index, --query, '
+        '--find-duplicates or --prune')
+  if not 0 <= options.threshold <= mpo_dedup.MAX_THRESHOLD:
+    option_parser.error('--threshold must be 0 to %d'
+        % mpo_dedup.MAX_THRESHOLD)
+
+  index = mpo_dedup.HashIndex(options.index)
+  try:
+    if options.prune:
+      sys.stderr.write('Pruned %d missing files\n' % index.Prune())
+      index.Commit()
+    if args:
+      filenames = batch_parse_mpo.FindMpoFiles(args)
+      start = time.time()
+      num_hashed, num_failed, num_unchanged = IndexFiles(index, filenames,
+          options.source, options.jobs, options.chunksize)
+      elapsed = max(time.time() - start, 1e-6)
+      sys.stderr.write('Hashed %d files (%d failed, %d unchanged) in %.2fs: '
+          '%.1f files/s\n' % (num_hashed, num_failed, num_unchanged, elapsed,
+          num_hashed / elapsed))
+    if options.query:
+      hash_value, _ = mpo_dedup.HashFile(options.query, options.source)
+      path = os.path.abspath(options.query)
+      matches = [{'path': match_path, 'distance': distance}
+          for distance, match_path in index.Query(hash_value,
+              options.threshold) if match_path != path]
+      sys.stdout.write(json.dumps({'path': path, 'hash': '%016x' % hash_value,
+          'matches': matches}, sort_keys=True) + '\n')
+    if options.find_duplicates:
+      start = time.time()
+      groups = index.FindDuplicates(options.threshold)
+      for group in groups:
+        sys.stdout.write(json.dumps({'paths': group}) + '\n')
+      sys.stderr.write('Found %d groups holding %d of %d files in %.2fs\n' % (
+          len(groups), sum(len(group) for group in groups), len(index),
+          time.time() - start))
+  finally:
+    index.Close()
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(Main(sys.argv[1:]))
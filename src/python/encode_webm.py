@@ -0,0 +1,109 @@
+#!/usr/bin/python
+
+"""Encodes WebP frames or MPO stereo pairs as a WebM video.
+
+Lossy WebP files are muxed as they are. MPO files are aligned as in
+render_mpo.py and encoded as one side by side stereo frame each, or as a
+left then right frame each with --mode wobble. Frames are written as they are
+produced, so long sequences need no more memory than short ones. MPO input
+requires NumPy and PIL with WebP support.
+"""
+
+import sys, os, io, optparse
+
+import webm
+
+MODES = ('side-by-side', 'wobble')
+DEFAULT_DURATION = 1000
+DEFAULT_QUALITY = 90
+
+def EncodeWebp(array, quality):
+  from PIL import Image
+  out = io.BytesIO()
+  Image.fromarray(array).save(out, 'WEBP', quality=quality)
+  return out.getvalue()
+
+def FitToSize(array, size):
+  """Centers an image array in a black (height, width) canvas, cropping any
+  excess."""
+  import numpy
+  height, width = size
+  result = numpy.zeros((height, width) + array.shape[2:], array.dtype)
+  source_y = max((array.shape[0] - height) // 2, 0)
+  source_x = max((array.shape[1] - width) // 2, 0)
+  array = array[source_y:source_y + height, source_x:source_x + width]
+  y = (height - array.shape[0]) // 2
+  x = (width - array.shape[1]) // 2
+  result[y:y + array.shape[0], x:x + array.shape[1]] = array
+  return result
+
+def GenerateMpoFrames(filename, mode, quality, view_size=None):
+  """Yields the WebP data of the frames for one MPO file.
+
+  Alignment crops each pair by its parallax, so views are fitted to
+  view_size to keep every frame of a video the same size.
+  """
+  import render_mpo
+  left, right, parallax_x_offset = render_mpo.LoadStereoPair(filename)
+  left, right = render_mpo.AlignStereoPair(left, right, parallax_x_offset)
+  if view_size is None:
+    view_size = left.shape[:2]
+  left = FitToSize(left, view_size)
+  right = FitToSize(right, view_size)
+  if mode == 'side-by-side':
+    yield EncodeWebp(render_mpo.RenderParallel(left, right), quality)
+  else:
+    yield EncodeWebp(left, quality)
+    yield EncodeWebp(right, quality)
+
+def Main(argv):
+  option_parser = optparse.OptionParser(
+      usage='%prog [options] -o <output.webm> <webp-or-mpo-file>...')
+  option_parser.add_option('-o', '--output', help='WebM file to write')
+  option_parser.add_option('-m', '--mode', default='side-by-side',
+      choices=MODES, help='How MPO files become frames, one of %s '
+          '[default: %%default]' % ', '.join(MODES))
+  option_parser.add_option('-d', '--duration', type='float',
+      default=DEFAULT_DURATION,
+      help='Milliseconds each frame is shown [default: %default]')
+  option_parser.add_option('-q', '--quality', type='int',
+      default=DEFAULT_QUALITY,
+      help='WebP quality for MPO frames [default: %default]')
+  option_parser.add_option('--stereo', action='store_true', default=False,
+      help='Mark WebP input as side by side stereo')
+  options, args = option_parser.parse_args(argv)
+  if not options.output or not args:
+    option_parser.error('Expected an output file and at least one input')
+
+  is_mpo = [os.path.splitext(filename)[1].lower() == '.mpo'
+      for filename in args]
+  if any(is_mpo) and not all(is_mpo):
+    option_parser.error('Expected either WebP or MPO files but not both')
+  is_stereo_side_by_side = options.stereo
+  if is_mpo[0]:
+    is_stereo_side_by_side = options.mode == 'side-by-side'
+
+  out_file = open(options.output, 'wb')
+  try:
+    writer = webm.WebmWriter(out_file, is_stereo_side_by_side)
+    for filename in args:
+      if is_mpo[0]:
+        view_size = None
+        if writer.width is not None:
+          view_size = (writer.height, writer.width)
+          if options.mode == 'side-by-side':
+            view_size = (writer.height, writer.width // 2)
+        frames = GenerateMpoFrames(filename, options.mode, options.quality,
+            view_size)
+      else:
+        frames = [open(filename, 'rb').read()]
+      for frame in frames:
+        writer.AddWebp(frame, options.duration)
+    writer.Finish()
+  finally:
+    out_file.close()
+  print 'Wrote %d frames, %.1fs, to %s' % (len(writer.cue_timecodes),
+      writer.duration / 1000, options.output)
+
+if __name__ == '__main__':
+  Main(sys.argv[1:])
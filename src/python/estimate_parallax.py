@@ -0,0 +1,177 @@
+#!/usr/bin/python
+
+"""Estimates the horizontal parallax of MPO stereo pairs.
+
+Used for files without a Fujifilm makernote parallax value. Images are
+decoded at reduced scale, a coarse offset is found by phase correlation on a
+further downsampled copy and then refined by block matching. Requires NumPy
+and PIL.
+"""
+
+import sys, io, re, time, optparse
+
+import numpy
+from PIL import JpegImagePlugin
+
+import mpo
+
+# Images are decoded at 1/DECODE_SCALE using the JPEG decoder's DCT scaling.
+DECODE_SCALE = 4
+# Number of 2x downsamples from the decoded size to the phase correlation size.
+PYRAMID_LEVELS = 1
+# Search radius in decoded pixels around the upsampled coarse estimate.
+REFINE_RADIUS = 3
+
+def DecodeGrayscale(image_data, scale=DECODE_SCALE):
+  """Returns a float32 grayscale array decoded at roughly 1/scale and the
+  full image width."""
+  image = JpegImagePlugin.JpegImageFile(io.BytesIO(image_data))
+  full_width = image.size[0]
+  image.draft('L', (image.size[0] // scale, image.size[1] // scale))
+  return numpy.asarray(image.convert('L'), dtype=numpy.float32), full_width
+
+def Downsample(image):
+  height = image.shape[0] // 2 * 2
+  width = image.shape[1] // 2 * 2
+  image = image[:height, :width]
+  return (image[0::2, 0::2] + image[1::2, 0::2] + image[0::2, 1::2]
+      + image[1::2, 1::2]) * 0.25
+
+def FastFftSize(n):
+  size = 1
+  while size < n:
+    size *= 2
+  return size
+
+def SubpixelPeak(before, peak, after):
+  # Vertex of the parabola through three samples around a maximum.
+  denom = before - 2 * peak + after
+  if denom == 0:
+    return 0.0
+  return 0.5 * (before - after) / denom
+
+def PhaseCorrelate(left, right):
+  """Returns (dx, dy) such that left(x + dx, y + dy) matches right(x, y)."""
+  height, width = left.shape
+  window = numpy.outer(numpy.hanning(height), numpy.hanning(width))
+  shape = (FastFftSize(height), FastFftSize(width))
+  left_fft = numpy.fft.rfft2((left - left.mean()) * window, shape)
+  right_fft = numpy.fft.rfft2((right - right.mean()) * window, shape)
+  cross_power = left_fft * numpy.conj(right_fft)
+  cross_power /= numpy.abs(cross_power) + 1e-9
+  correlation = numpy.fft.irfft2(cross_power, shape)
+  peak_y, peak_x = numpy.unravel_index(numpy.argmax(correlation),
+      correlation.shape)
+  row = correlation[peak_y]
+  column = correlation[:, peak_x]
+  dx = peak_x + SubpixelPeak(row[peak_x - 1], row[peak_x],
+      row[(peak_x + 1) % shape[1]])
+  dy = peak_y + SubpixelPeak(column[peak_y - 1], column[peak_y],
+      column[(peak_y + 1) % shape[0]])
+  if dx > shape[1] // 2:
+    dx -= shape[1]
+  if dy > shape[0] // 2:
+    dy -= shape[0]
+  return dx, dy
+
+def Overlap(left, right, dx, dy):
+  # Views of the regions where left(x + dx, y + dy) lines up with right(x, y).
+  height, width = left.shape
+  left = left[max(dy, 0):height + min(dy, 0), max(dx, 0):width + min(dx, 0)]
+  right = right[max(-dy, 0):height + min(-dy, 0),
+      max(-dx, 0):width + min(-dx, 0)]
+  return left, right
+
+def RefineByBlockMatching(left, right, dx, dy, radius=REFINE_RADIUS):
+  """Returns the integer dx within radius of dx with the lowest mean absolute
+  difference between the overlapping regions. Raises if no dx within radius
+  leaves the images overlapping."""
+  dy = int(round(dy))
+  best_dx = None
+  best_error = None
+  for candidate_dx in xrange(int(round(dx)) - radius,
+      int(round(dx)) + radius + 1):
+    left_overlap, right_overlap = Overlap(left, right, candidate_dx, dy)
+    if not left_overlap.size:
+      continue
+    error = numpy.abs(left_overlap - right_overlap).mean()
+    if best_error is None or error < best_error:
+      best_dx = candidate_dx
+      best_error = error
+  mpo.Assert(best_dx is not None, 'No overlap between the images within %d '
+      'pixels of dx %d' % (radius, int(round(dx))))
+  return best_dx
+
+def EstimateParallax(left, right, levels=PYRAMID_LEVELS):
+  """Returns the horizontal offset in pixels of right relative to left.
+
+  A positive value means left(x + offset) matches right(x), the same
+  convention as MpoInfo.GetParallaxXOffset.
+  """
+  mpo.AssertEquals(left.shape, right.shape, 'Expected images of equal size')
+  coarse_left, coarse_right = left, right
+  for level in xrange(levels):
+    coarse_left = Downsample(coarse_left)
+    coarse_right = Downsample(coarse_right)
+  dx, dy = PhaseCorrelate(coarse_left, coarse_right)
+  factor = 2 ** levels
+  return RefineByBlockMatching(left, right, dx * factor, dy * factor)
+
+def EstimateParallaxXOffset(parser):
+  """Estimates the parallax x offset of a parsed MPO in full size pixels."""
+  mpo.AssertEquals(2, len(parser.image_offsets), 'Expected stereo image')
+  left, full_width = DecodeGrayscale(parser.GetImageData(0))
+  right, _ = DecodeGrayscale(parser.GetImageData(1))
+  return EstimateParallax(left, right) * float(full_width) / left.shape[1]
+
+def EstimateFile(filename):
+  mpo_file = open(filename, 'rb')
+  try:
+    data = mpo.MapFile(mpo_file)
+    try:
+      parser = mpo.ImageParser(data)
+      info = parser.Parse()
+      return EstimateParallaxXOffset(parser), info.GetParallaxXOffset()
+    finally:
+      data.close()
+  finally:
+    mpo_file.close()
+
+# StereoPhoto Maker sample names record the x alignment it applied, e.g.
+# sample2-spm-fuji-p1-xn89.mpo was shifted by -89 pixels.
+KNOWN_OFFSET_PATTERN = re.compile(r'-x(n?)(\d+)\.mpo$')
+
+def GetKnownOffset(filename):
+  match = KNOWN_OFFSET_PATTERN.search(filename)
+  if not match:
+    return None
+  offset = int(match.group(2))
+  if match.group(1):
+    offset = -offset
+  return offset
+
+def Main(argv):
+  option_parser = optparse.OptionParser(usage='%prog <mpo-file>...')
+  options, args = option_parser.parse_args(argv)
+  if not args:
+    option_parser.error('Expected at least one MPO file')
+
+  residuals = []
+  for filename in args:
+    start = time.time()
+    estimated, makernote = EstimateFile(filename)
+    elapsed = time.time() - start
+    known = GetKnownOffset(filename)
+    print '%s: estimated %.1f makernote %s known %s (%.0f ms)' % (
+        filename, estimated, makernote, known, elapsed * 1000)
+    if known is not None:
+      # An alignment shift cancels the disparity, so the two should sum to
+      # the same constant for every file shot with the same framing.
+      residuals.append(estimated + known)
+  if len(residuals) > 1:
+    residuals = numpy.array(residuals)
+    print 'Known offsets: %d files, estimate + known = %.1f +/- %.1f px' % (
+        len(residuals), residuals.mean(), residuals.std())
+
+if __name__ == '__main__':
+  Main(sys.argv[1:])
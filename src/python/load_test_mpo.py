@@ -0,0 +1,178 @@
+#!/usr/bin/python
+
+"""Load tests serve_mpo.py, standing in for browser clients.
+
+Each of --concurrency threads keeps one HTTP connection open and requests
+random renderings of the given files until --requests have been made in
+total. Latency percentiles and throughput are printed, followed by the
+server's own /stats. With --serve a server for a directory is started in
+this process on a free port, and every MPO under it is requested.
+"""
+
+import sys, os, time, json, random, threading, httplib, urllib, urlparse
+import optparse
+
+import batch_parse_mpo, mpo_views
+
+DEFAULT_URL = 'http://localhost:8080/'
+
+class Client(threading.Thread):
+  def __init__(self, url, targets, counter, seed):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.url = urlparse.urlparse(url)
+    self.targets = targets
+    self.counter = counter
+    self.random = random.Random(seed)
+    self.latencies = []
+    self.status_counts = {}
+    self.num_bytes = 0
+
+  def Connect(self):
+    return httplib.HTTPConnection(self.url.hostname, self.url.port or 80)
+
+  def run(self):
+    connection = self.Connect()
+    while self.counter.next():
+      path = self.url.path.rstrip('/') + self.random.choice(self.targets)
+      start = time.time()
+      try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        body = response.read()
+        status = response.status
+      except (httplib.HTTPException, IOError), e:
+        status = e.__class__.__name__
+        body = ''
+        connection.close()
+        connection = self.Connect()
+      self.latencies.append(time.time() - start)
+      self.status_counts[status] = self.status_counts.get(status, 0) + 1
+      self.num_bytes += len(body)
+    connection.close()
+
+class Counter:
+  """Hands out up to limit tickets across threads."""
+
+  def __init__(self, limit):
+    self.remaining = limit
+    self.lock = threading.Lock()
+
+  def next(self):
+    with self.lock:
+      if self.remaining <= 0:
+        return False
+      self.remaining -= 1
+      return True
+
+def GetTargets(paths, views, scales):
+  return ['/render/%s?view=%s&scale=%d' % (urllib.quote(path), view, scale)
+      for path in paths for view in views for scale in scales]
+
+def GetPercentile(sorted_values, fraction):
+  return sorted_values[min(int(fraction * len(sorted_values)),
+      len(sorted_values) - 1)]
+
+def StartServer(root, jobs):
+  # Imported here so that testing a remote server does not need NumPy.
+  import mpo_service, serve_mpo
+  service = mpo_service.RenderService(jobs)
+  server = serve_mpo.RenderServer(('localhost', 0), root, service)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server, 'http://localhost:%d/' % server.server_address[1]
+
+def Main(argv):
+  option_parser = optparse.OptionParser(
+      usage='%prog [options] [<path relative to the served dir>...]')
+  option_parser.add_option('-u', '--url', default=DEFAULT_URL,
+      help='Server to test [default: %default]')
+  option_parser.add_option('--serve',
+      help='Start a server for this directory instead of using --url')
+  option_parser.add_option('-j', '--jobs', type='int', default=4,
+      help='Worker threads of the --serve server [default: %default]')
+  option_parser.add_option('-c', '--concurrency', type='int', default=8,
+      help='Concurrent connections [default: %default]')
+  option_parser.add_option('-n', '--requests', type='int', default=200,
+      help='Total requests [default: %default]')
+  option_parser.add_option('--views', default='anaglyph,left,right',
+      help='Comma separated views to request [default: %default]')
+  option_parser.add_option('--scales', default='2,4,8',
+      help='Comma separated scales to request [default: %default]')
+  option_parser.add_option('--seed', type='int', default=0,
+      help='Random seed for the request mix [default: %default]')
+  options, args = option_parser.parse_args(argv)
+  views = options.views.split(',')
+  try:
+    scales = [int(scale) for scale in options.scales.split(',')]
+  except ValueError:
+    scales = None
+  if not scales or not set(scales) <= set(mpo_views.SCALES):
+    option_parser.error('--scales must be a comma separated list of %s'
+        % ', '.join(str(scale) for scale in mpo_views.SCALES))
+  for view in views:
+    if view not in mpo_views.VIEWS:
+      option_parser.error('Unknown view %r' % view)
+  paths = args
+  server = None
+  url = options.url
+  if options.serve:
+    if not paths:
+      paths = [os.path.relpath(filename, options.serve) for filename
+          in batch_parse_mpo.FindMpoFiles([options.serve])]
+    server, url = StartServer(options.serve, options.jobs)
+  if not paths:
+    option_parser.error('Expected at least one path, or --serve')
+
+  counter = Counter(options.requests)
+  clients = [Client(url, GetTargets(paths, views, scales), counter,
+      options.seed + i) for i in xrange(max(options.concurrency, 1))]
+  start = time.time()
+  for client in clients:
+    client.start()
+  for client in clients:
+    client.join()
+  elapsed = max(time.time() - start, 1e-6)
+
+  latencies = sorted(latency for client in clients
+      for latency in client.latencies)
+  status_counts = {}
+  for client in clients:
+    for status, count in client.status_counts.iteritems():
+      status_counts[status] = status_counts.get(status, 0) + count
+  num_bytes = sum(client.num_bytes for client in clients)
+  print 'Made %d requests in %.2fs: %.1f requests/s, %.1f MB/s' % (
+      len(latencies), elapsed, len(latencies) / elapsed,
+      num_bytes / elapsed / (1 << 20))
+  print 'Statuses: %s' % ', '.join('%s: %d' % item
+      for item in sorted(status_counts.iteritems()))
+  if latencies:
+    print 'Latency ms: p50 %.1f, p90 %.1f, p99 %.1f, max %.1f' % tuple(
+        GetPercentile(latencies, fraction) * 1000
+        for fraction in (0.5, 0.9, 0.99, 1))
+
+  parsed_url = urlparse.urlparse(url)
+  connection = httplib.HTTPConnection(parsed_url.hostname,
+      parsed_url.port or 80)
+  connection.request('GET', parsed_url.path.rstrip('/') + '/stats')
+  stats = json.loads(connection.getresponse().read())
+  connection.close()
+  cache_stats = stats['cache']
+  print ('Server cache: %(hits)d hits, %(misses)d misses (%(hit_rate).0f%% '
+      'hit rate), %(evictions)d evicted, %(bytes)d bytes held' % dict(
+      cache_stats, hit_rate=cache_stats['hit_rate'] * 100))
+  print 'Server coalesced %d decodes and %d renders' % (
+      stats['coalesced_decodes'], stats['coalesced_renders'])
+  for name in ('decode_latency', 'render_latency'):
+    print 'Server %s ms: %s' % (name.replace('_', ' '), ', '.join(
+        '%s %.1f' % (key[:-3], stats[name][key])
+        for key in ('p50_ms', 'p90_ms', 'p99_ms', 'max_ms')))
+  if server is not None:
+    server.shutdown()
+    server.server_close()
+    server.service.Close()
+  return status_counts.keys() != [200] and 1 or 0
+
+if __name__ == '__main__':
+  sys.exit(Main(sys.argv[1:]))
@@ -0,0 +1,1417 @@
+"""Parsing of MPO (Multi Picture Object) stereo images.
+
+ParseMpoFile and ParseMpo return an MpoInfo describing the images in a file.
+ImageParser does the work and can also be used directly to get at the image
+data once a file has been parsed. OpenMpoFile gives lazy access to single
+images of files with many of them, and closes the file when used in a with
+statement.
+"""
+
+import os, re, struct, mmap, array
+
+import mpo_trace
+
+def BytesToFriendlyString(byte_str):
+  lines = []
+  out = []
+  for byte in byte_str:
+    rep = '%x' % ord(byte)
+    if len(rep) == 1:
+      rep = ' ' + rep
+    out.append(rep)
+  lines.append(' '.join(out))
+  out = []
+  for byte in byte_str:
+    rep = ('%r' % byte)[1:-1]
+    if rep.startswith('\\x'):
+      rep = rep[2:]
+    if len(rep) == 1:
+      rep = ' ' + rep
+    out.append(rep)
+  lines.append(' '.join(out))
+  return '\n'.join(lines)
+
+# Markers are compared as big endian shorts so they can be decoded in place.
+START_OF_IMAGE = 0xffd8
+END_OF_IMAGE = 0xffd9
+APP1_MARKER = 0xffe1
+APP2_MARKER = 0xffe2
+JPEG_START_OF_SCAN = 0xffda
+JPEG_DEFINE_QUANTIZATION_TABLE = 0xffdb
+EXIF_FORMAT_IDENTIFIER = 'Exif\x00\x00'
+BIG_ENDIAN_TAG = '\x4d\x4d\x00\x2a'
+LITTLE_ENDIAN_TAG = '\x49\x49\x2a\x00'
+MP_FORMAT_IDENTIFIER = 'MPF\x00'
+MP_VERSION = '0100'
+FUJIFILM_MAKERNOTE_IDENTIFIER = 'FUJIFILM'
+MP_IMAGE_DATA_FORMAT_JPEG = 0
+# MP Entry type codes, CIPA DC-007 5.2.3.3.1.
+MP_TYPE_CODE_UNDEFINED = 0x000000
+MP_TYPE_CODE_LARGE_THUMBNAIL_VGA = 0x010001
+MP_TYPE_CODE_LARGE_THUMBNAIL_FULL_HD = 0x010002
+MP_TYPE_CODE_PANORAMA = 0x020001
+MP_TYPE_CODE_DISPARITY = 0x020002
+MP_TYPE_CODE_MULTI_ANGLE = 0x020003
+MP_TYPE_CODE_BASELINE_PRIMARY = 0x030000
+MP_TYPE_CODE_NAMES = {
+  MP_TYPE_CODE_UNDEFINED: 'undefined',
+  MP_TYPE_CODE_LARGE_THUMBNAIL_VGA: 'large_thumbnail_vga',
+  MP_TYPE_CODE_LARGE_THUMBNAIL_FULL_HD: 'large_thumbnail_full_hd',
+  MP_TYPE_CODE_PANORAMA: 'panorama',
+  MP_TYPE_CODE_DISPARITY: 'disparity',
+  MP_TYPE_CODE_MULTI_ANGLE: 'multi_angle',
+  MP_TYPE_CODE_BASELINE_PRIMARY: 'baseline_primary',
+}
+# IFD1 tags locating the thumbnail, relative to the Exif endian marker.
+EXIF_THUMBNAIL_OFFSET_TAG = 513
+EXIF_THUMBNAIL_LENGTH_TAG = 514
+
+def GetTypeCodeName(type_code):
+  return MP_TYPE_CODE_NAMES.get(type_code, '%#08x' % type_code)
+
+def IsAppMarker(marker):
+  return marker >= 0xffe0 and marker <= 0xffef
+
+def IsJpegMarker(marker):
+  if marker == 0xffdb:
+    return True # Define quantization table
+  if marker == 0xffdd:
+    return True # Define restart interval
+  if marker == 0xffc0:
+    return True # Start of frame
+  if marker == 0xffc4:
+    return True # Define huffman table
+  if marker == 0xffda:
+    return True # Start of scan
+  return False
+
+# A marker in entropy coded data: 0xff followed by anything but 0x00 (byte
+# stuffing), 0xd0 to 0xd7 (restart markers) or 0xff (fill bytes).
+ENTROPY_DATA_MARKER_PATTERN = re.compile(r'\xff[\x01-\xcf\xd8-\xfe]')
+# SOI followed by the start of another marker.
+START_OF_IMAGE_BYTES = '\xff\xd8\xff'
+
+def IsStartOfFrameMarker(marker):
+  # SOF0 to SOF15, apart from DHT, JPG and DAC which share the range.
+  return (marker >= 0xffc0 and marker <= 0xffcf
+      and marker != 0xffc4 and marker != 0xffc8 and marker != 0xffcc)
+
+def AssertBytesEqual(a, b):
+  if not a == b:
+    raise Exception("Expected byte strings to be equivalent, but:\n"
+        + BytesToFriendlyString(a) + '\n != \n'
+        + BytesToFriendlyString(b))
+
+def AssertMarkerEqual(a, b):
+  if a != b:
+    raise Exception("Expected marker %#06x but was %#06x" % (a, b))
+
+def Assert(b, msg, bytes=None):
+  if not b:
+    if bytes:
+      msg = msg + '\n' + BytesToFriendlyString(bytes)
+    raise Exception(msg)
+
+def AssertEquals(a, b, msg=None):
+  if a != b:
+    if msg:
+      msg = msg + ": "
+    else:
+      msg = ''
+    msg = msg + 'Expected %r but was %r' % (a, b)
+    raise Exception(msg)
+
+def EndianPrefix(is_big_endian):
+  if is_big_endian:
+    return '>'
+  return '<'
+
+# Precompiled structs. Tuples are indexed by is_big_endian.
+MARKER_STRUCT = struct.Struct('>H')
+BYTE_STRUCT = struct.Struct('B')
+SHORT_STRUCTS = (struct.Struct('<H'), struct.Struct('>H'))
+INT_STRUCTS = (struct.Struct('<I'), struct.Struct('>I'))
+SRATIONAL_STRUCTS = (struct.Struct('<ii'), struct.Struct('>ii'))
+MP_ENTRY_STRUCTS = (struct.Struct('<IIIHH'), struct.Struct('>IIIHH'))
+SEGMENT_HEADER_STRUCT = struct.Struct('>HH')
+# Sample precision, height, width and number of components.
+FRAME_HEADER_STRUCT = struct.Struct('>BHHB')
+QUANTIZATION_TABLE_STRUCTS = (struct.Struct('64B'), struct.Struct('>64H'))
+
+# An IFD row is tag id, type, count and a 4 byte payload which is decoded as
+# an int in the IFD's byte order.
+IFD_ROW_FORMAT = 'HHII'
+IFD_ROW_SIZE = 12
+ifd_table_structs = {}
+# Bits of the single BYTE, SBYTE, SHORT or SSHORT value held in the first
+# bytes of a payload, by tag type, and whether it is signed.
+IFD_INLINE_VALUE_TYPES = {1: (8, False), 6: (8, True), 3: (16, False),
+    8: (16, True)}
+IFD_INLINE_TYPES = frozenset(IFD_INLINE_VALUE_TYPES)
+
+def GetInlineValue(payload, bits, is_signed, is_big_endian):
+  """Returns the value in the first bits of a payload decoded as an int."""
+  if is_big_endian:
+    value = payload >> (32 - bits)
+  else:
+    value = payload & ((1 << bits) - 1)
+  if is_signed and value >= 1 << (bits - 1):
+    value -= 1 << bits
+  return value
+
+class IfdTable:
+  """The rows of an IFD decoded with a single unpack.
+
+  values is the flat tuple of fields, so row r is values[4 * r:4 * r + 4].
+  The value of a row holding a single BYTE, SBYTE, SHORT or SSHORT is that
+  value. Any other payload is decoded as an int in the IFD's byte order,
+  which is the offset of values that do not fit in it.
+  """
+
+  def __init__(self, values, is_big_endian):
+    types = values[1::4]
+    if not IFD_INLINE_TYPES.isdisjoint(types):
+      values = list(values)
+      for row, tag_type in enumerate(types):
+        value_type = IFD_INLINE_VALUE_TYPES.get(tag_type)
+        if value_type is not None and values[4 * row + 2] == 1:
+          values[4 * row + 3] = GetInlineValue(values[4 * row + 3],
+              value_type[0], value_type[1], is_big_endian)
+      values = tuple(values)
+    self.values = values
+    self.tag_ids = values[0::4]
+
+  def __len__(self):
+    return len(self.tag_ids)
+
+  def Find(self, tag_id):
+    """Returns the (tag id, type, count, value) row for tag_id, or None."""
+    try:
+      row = self.tag_ids.index(tag_id)
+    except ValueError:
+      return None
+    return self.values[4 * row:4 * row + 4]
+
+  def Rows(self):
+    values = self.values
+    return zip(self.tag_ids, values[1::4], values[2::4], values[3::4])
+
+  def AddTo(self, tags):
+    """Adds tag id -> (type, count, value) entries to the dict tags."""
+    values = self.values
+    tags.update(zip(self.tag_ids, zip(values[1::4], values[2::4],
+        values[3::4])))
+
+def GetIfdTableStruct(count, is_big_endian):
+  """Returns a struct that decodes an IFD table of count rows in one call."""
+  key = (count, is_big_endian)
+  table_struct = ifd_table_structs.get(key)
+  if table_struct is None:
+    table_struct = struct.Struct(EndianPrefix(is_big_endian)
+        + IFD_ROW_FORMAT * count)
+    ifd_table_structs[key] = table_struct
+  return table_struct
+
+def BytesToShortBig(byte_str):
+  assert len(byte_str) == 2
+  return struct.unpack('>H', byte_str)[0]
+
+def BytesToShortLittle(byte_str):
+  assert len(byte_str) == 2
+  return struct.unpack('<H', byte_str)[0]
+
+def BytesToShort(byte_str, is_big_endian):
+  if is_big_endian:
+    return BytesToShortBig(byte_str)
+  else:
+    return BytesToShortLittle(byte_str)
+
+def BytesToIntBig(byte_str):
+  assert len(byte_str) == 4
+  return struct.unpack('>I', byte_str)[0]
+
+def BytesToIntLittle(byte_str):
+  assert len(byte_str) == 4
+  return struct.unpack('<I', byte_str)[0]
+
+def BytesToInt(byte_str, is_big_endian):
+  if is_big_endian:
+    return BytesToIntBig(byte_str)
+  else:
+    return BytesToIntLittle(byte_str)
+
+def BytesToSIntBig(byte_str):
+  assert len(byte_str) == 4
+  return struct.unpack('>i', byte_str)[0]
+
+def BytesToSIntLittle(byte_str):
+  assert len(byte_str) == 4
+  return struct.unpack('<i', byte_str)[0]
+
+def BytesToSInt(byte_str, is_big_endian):
+  if is_big_endian:
+    return BytesToSIntBig(byte_str)
+  else:
+    return BytesToSIntLittle(byte_str)
+
+def BytesToSRational(byte_str, is_big_endian):
+  assert len(byte_str) == 8
+  numer = BytesToSInt(byte_str[:4], is_big_endian)
+  denom = BytesToSInt(byte_str[4:8], is_big_endian)
+  return (numer, denom)
+
+def BytesToByte(byte_str):
+  assert len(byte_str) == 1
+  return ord(byte_str)
+
+# Size of the buffer used when copying images out of a file.
+COPY_CHUNK_SIZE = 1 << 16
+
+# Fujifilm parallax values are multiplied by this to give a pixel offset.
+# Mirrors pics3.parser.Mpo.FUJIFILM_PARALLAX_TO_PIXELS_RATIO.
+FUJIFILM_PARALLAX_TO_PIXELS_RATIO = 35
+
+class MpoImage:
+  """One image of an MPO as described by its MP Entry and APP1 headers."""
+
+  def __init__(self, index):
+    self.index = index
+    self.offset = None
+    self.size = None
+    self.data_format = None
+    self.type_code = None
+    self.dependent_parent = False
+    self.dependent_child = False
+    self.representative = False
+    # tag id -> (tag type, count, value) for IFD0 and the Exif IFD.
+    self.exif_tags = {}
+    self.makernote_tags = {}
+    # Fujifilm parallax as a (numerator, denominator) SRational and the file
+    # offset it was read from.
+    self.parallax = None
+    self.parallax_offset = None
+    # File offset and size of the JPEG thumbnail in IFD1, if any.
+    self.thumbnail_offset = None
+    self.thumbnail_size = None
+
+  def ToDict(self):
+    return {
+      'index': self.index,
+      'offset': self.offset,
+      'size': self.size,
+      'data_format': self.data_format,
+      'type_code': self.type_code,
+      'dependent_parent': self.dependent_parent,
+      'dependent_child': self.dependent_child,
+      'representative': self.representative,
+      'exif_tags': self.exif_tags,
+      'makernote_tags': self.makernote_tags,
+      'parallax': self.parallax,
+      'parallax_offset': self.parallax_offset,
+      'thumbnail_offset': self.thumbnail_offset,
+      'thumbnail_size': self.thumbnail_size,
+    }
+
+  @staticmethod
+  def FromDict(image_dict):
+    # Undoes the int key to string and tuple to list conversions of JSON.
+    image = MpoImage(image_dict['index'])
+    for key in ('offset', 'size', 'data_format', 'type_code',
+        'dependent_parent', 'dependent_child', 'representative'):
+      setattr(image, key, image_dict[key])
+    for key in ('exif_tags', 'makernote_tags'):
+      setattr(image, key, dict((int(tag_id), tuple(value))
+          for tag_id, value in image_dict[key].iteritems()))
+    if image_dict['parallax'] is not None:
+      image.parallax = tuple(image_dict['parallax'])
+    image.parallax_offset = image_dict.get('parallax_offset')
+    image.thumbnail_offset = image_dict.get('thumbnail_offset')
+    image.thumbnail_size = image_dict.get('thumbnail_size')
+    return image
+
+class MpoInfo:
+  """Result of parsing an MPO."""
+
+  def __init__(self, file_size, images):
+    self.file_size = file_size
+    self.images = images
+    # Set by estimate_parallax for files without a makernote parallax.
+    self.estimated_parallax_x_offset = None
+    # True when the images were found by scanning instead of from the MP
+    # Index, see ImageParser.Recover.
+    self.recovered = False
+
+  def GetParallax(self):
+    for image in reversed(self.images):
+      if image.parallax is not None:
+        return image.parallax
+    return None
+
+  def GetParallaxXOffset(self):
+    if len(self.images) == 2 and self.images[1].parallax is not None:
+      numer, denom = self.images[1].parallax
+      return numer * 1.0 / denom * FUJIFILM_PARALLAX_TO_PIXELS_RATIO
+    return None
+
+  def ToDict(self):
+    return {
+      'file_size': self.file_size,
+      'parallax_x_offset': self.GetParallaxXOffset(),
+      'estimated_parallax_x_offset': self.estimated_parallax_x_offset,
+      'recovered': self.recovered,
+      'images': [image.ToDict() for image in self.images],
+    }
+
+  @staticmethod
+  def FromDict(info_dict):
+    info = MpoInfo(info_dict['file_size'],
+        [MpoImage.FromDict(image_dict) for image_dict in info_dict['images']])
+    info.estimated_parallax_x_offset = info_dict.get(
+        'estimated_parallax_x_offset')
+    info.recovered = info_dict.get('recovered', False)
+    return info
+
+class SegmentIndex:
+  """Locations of the JPEG segments from SOI up to and including SOS.
+
+  Segments are held in parallel arrays with one entry per segment, in the
+  order they were indexed. offset is the file offset of the segment's marker
+  and length is the JPEG segment length, which counts the two length bytes
+  but not the marker. Frame headers and quantization tables are decoded
+  while indexing so that they can be looked up without the file.
+
+  Images may be indexed in any order, and images that are never indexed,
+  such as non-JPEG MP entries, have no segments.
+  """
+
+  def __init__(self):
+    self.images = array.array('H')
+    self.markers = array.array('H')
+    self.offsets = array.array('L')
+    self.lengths = array.array('H')
+    # Per image: the first entry and one past the last, and the SOF fields,
+    # 0 until seen.
+    self.image_starts = array.array('L')
+    self.image_ends = array.array('L')
+    self.precisions = array.array('B')
+    self.heights = array.array('H')
+    self.widths = array.array('H')
+    self.num_components = array.array('B')
+    # Per image: table id -> 64 values in zigzag order.
+    self.quantization_tables = []
+
+  def __len__(self):
+    return len(self.markers)
+
+  def GetImageCount(self):
+    return len(self.image_starts)
+
+  def SetImageCount(self, num_images):
+    """Makes room for num_images images, so that images that are never
+    indexed are still counted."""
+    while len(self.image_starts) < num_images:
+      self.image_starts.append(0)
+      self.image_ends.append(0)
+      self.precisions.append(0)
+      self.heights.append(0)
+      self.widths.append(0)
+      self.num_components.append(0)
+      self.quantization_tables.append({})
+
+  def BeginImage(self, image_index):
+    self.SetImageCount(image_index + 1)
+    self.image_starts[image_index] = len(self.markers)
+    self.image_ends[image_index] = len(self.markers)
+
+  def Add(self, image_index, marker, offset, length):
+    self.images.append(image_index)
+    self.markers.append(marker)
+    self.offsets.append(offset)
+    self.lengths.append(length)
+    self.image_ends[image_index] = len(self.markers)
+
+  def SetFrame(self, image_index, precision, height, width, num_components):
+    self.precisions[image_index] = precision
+    self.heights[image_index] = height
+    self.widths[image_index] = width
+    self.num_components[image_index] = num_components
+
+  def GetSegment(self, i):
+    """Returns (image index, marker, offset, length) of entry i."""
+    return self.images[i], self.markers[i], self.offsets[i], self.lengths[i]
+
+  def GetImageEntries(self, image_index):
+    return xrange(self.image_starts[image_index],
+        self.image_ends[image_index])
+
+  def Find(self, image_index, marker):
+    """Returns the entry of the first marker segment in an image, or -1."""
+    markers = self.markers
+    for i in self.GetImageEntries(image_index):
+      if markers[i] == marker:
+        return i
+    return -1
+
+  def FindAll(self, image_index, marker):
+    markers = self.markers
+    return [i for i in self.GetImageEntries(image_index)
+        if markers[i] == marker]
+
+  def GetPayloadRange(self, i):
+    """Returns the file offset and size of entry i after its length field."""
+    return self.offsets[i] + 4, self.lengths[i] - 2
+
+  def GetDimensions(self, image_index):
+    """Returns (width, height) from the image's frame header."""
+    return self.widths[image_index], self.heights[image_index]
+
+  def GetScanDataOffset(self, image_index):
+    """Returns the file offset of the image's entropy coded data, or None."""
+    i = self.Find(image_index, JPEG_START_OF_SCAN)
+    if i < 0:
+      return None
+    return self.offsets[i] + 2 + self.lengths[i]
+
+  def ToDict(self):
+    return {
+      'segments': [self.GetSegment(i) for i in xrange(len(self))],
+      'images': [{
+        'width': self.widths[i],
+        'height': self.heights[i],
+        'precision': self.precisions[i],
+        'num_components': self.num_components[i],
+        'scan_data_offset': self.GetScanDataOffset(i),
+        'quantization_tables': dict((table_id, list(table)) for
+            table_id, table in self.quantization_tables[i].iteritems()),
+      } for i in xrange(self.GetImageCount())],
+    }
+
+class ImageParser:
+  """Parses an MPO held in a string or an mmap.
+
+  All reads are offsets into self.data. Fixed width fields are decoded in
+  place with struct.unpack_from, so a mapped file is never copied.
+
+  ParseHeaders instead seeks around an open file and only loads the APP
+  segments at the start of each image. In that mode self.data holds one
+  image's headers at a time and self.data_offset is its position in the file.
+  """
+
+  def __init__(self, data='', log=None, tracer=None):
+    self.data = data
+    self.data_offset = 0
+    self.file_size = len(data)
+    self.bytes_read = 0
+    self.offset = 0
+    self.mp_endian_offset = 0
+    # File offset and byte order of the MP Entry table.
+    self.mp_entry_offset = None
+    self.mp_is_big_endian = None
+    self.image_sizes = []
+    self.image_offsets = []
+    self.images = []
+    self.image = self.GetImage(0)
+    self.segment_index = None
+    self.recovered = False
+    # log is called with the message of every event. tracer gets the events
+    # at its level and times each parse stage of this parser.
+    self.log = log
+    self.tracer = tracer
+    # Whether debug events go anywhere, decided once as Log is called in
+    # every parse step.
+    self.is_logging = log is not None or (tracer is not None
+        and tracer.level <= mpo_trace.DEBUG)
+    if tracer is not None:
+      tracer.Instrument(self)
+
+  def Log(self, msg, *args):
+    if self.is_logging:
+      self.Emit(mpo_trace.DEBUG, msg, args)
+
+  def Info(self, msg, *args):
+    self.Emit(mpo_trace.INFO, msg, args)
+
+  def Warn(self, msg, *args):
+    self.Emit(mpo_trace.WARNING, msg, args)
+
+  def Emit(self, level, msg, args):
+    if self.log is not None:
+      self.log(args and msg % args or msg)
+    if self.tracer is not None:
+      self.tracer.Event(level, msg, args, self.data_offset + self.offset)
+
+  def GetImage(self, i):
+    while len(self.images) <= i:
+      self.images.append(MpoImage(len(self.images)))
+    return self.images[i]
+
+  def GetInfo(self):
+    info = MpoInfo(self.file_size, self.images)
+    info.recovered = self.recovered
+    return info
+
+  def CheckAvailable(self, num_bytes):
+    Assert(num_bytes >= 0, 'Cannot read %d bytes' % num_bytes)
+    available = len(self.data) - self.offset
+    if available < num_bytes:
+      raise Exception("Tried to read %d bytes but only %d available"
+          % (num_bytes, max(available, 0)))
+
+  def ReadBytes(self, num_bytes, peek=False):
+    self.CheckAvailable(num_bytes)
+    byte_str = self.data[self.offset:self.offset + num_bytes]
+    if not peek:
+      self.offset += num_bytes
+    return byte_str
+
+  def PeekBytes(self, num_bytes):
+    return self.ReadBytes(num_bytes, True)
+
+  def ReadBuffer(self, num_bytes):
+    self.CheckAvailable(num_bytes)
+    view = buffer(self.data, self.offset, num_bytes)
+    self.offset += num_bytes
+    return view
+
+  def SkipBytes(self, num_bytes):
+    self.CheckAvailable(num_bytes)
+    self.offset += num_bytes
+
+  def MatchBytes(self, byte_str):
+    end = self.offset + len(byte_str)
+    return self.data.find(byte_str, self.offset, end) == self.offset
+
+  def Unpack(self, value_struct, peek=False):
+    end = self.offset + value_struct.size
+    if end > len(self.data):
+      self.CheckAvailable(value_struct.size)
+    values = value_struct.unpack_from(self.data, self.offset)
+    if not peek:
+      self.offset = end
+    return values
+
+  def ReadMarker(self, peek=False):
+    return self.Unpack(MARKER_STRUCT, peek)[0]
+
+  def PeekMarker(self):
+    return self.ReadMarker(True)
+
+  def ReadByte(self):
+    return self.Unpack(BYTE_STRUCT)[0]
+
+  def ReadShortBig(self):
+    return self.Unpack(MARKER_STRUCT)[0]
+
+  def ReadShort(self, is_big_endian):
+    return self.Unpack(SHORT_STRUCTS[is_big_endian])[0]
+
+  def ReadInt(self, is_big_endian):
+    return self.Unpack(INT_STRUCTS[is_big_endian])[0]
+
+  def ReadSRational(self, is_big_endian):
+    return self.Unpack(SRATIONAL_STRUCTS[is_big_endian])
+
+  def ReadAppSection(self, marker):
+    AssertMarkerEqual(marker, self.ReadMarker())
+    section_length = self.ReadShortBig()
+    Assert(section_length >= 2, "App length should be at least 2 bytes")
+    section_remaining = section_length - 2
+    self.Log("APP-OTHER %#06x", marker)
+    self.Log("APP-OTHER LENGTH %d", section_length)
+    self.SkipBytes(section_remaining)
+
+  def ReadIfdTable(self, count, is_big_endian):
+    return IfdTable(self.Unpack(GetIfdTableStruct(count, is_big_endian)),
+        is_big_endian)
+
+  def LogUnparsedTags(self, name, table, parsed_tag_id):
+    if self.is_logging:
+      for tag_id in table.tag_ids:
+        if tag_id != parsed_tag_id:
+          self.Log("Unparsed %s: %d", name, tag_id)
+
+  def ReadApp1Section(self, marker):
+    AssertMarkerEqual(marker, self.ReadMarker())
+    section_length = self.ReadShortBig()
+    Assert(section_length >= 2, "App1 length should be at least 2 bytes")
+    section_remaining = section_length - 2
+    section_end = self.offset + section_remaining
+    self.Log("APP1 %#06x", marker)
+    self.Log("APP1 LENGTH %d", section_length)
+    self.Log("APP1 Section remaining: %d", section_remaining)
+    is_exif = self.MatchBytes(EXIF_FORMAT_IDENTIFIER)
+    self.SkipBytes(6)
+    section_remaining -= 6
+    if is_exif:
+      self.Log("APP1 is Exif")
+      exif_endian_offset = self.offset
+      exif_is_big_endian = self.MatchBytes(BIG_ENDIAN_TAG)
+      Assert(exif_is_big_endian or self.MatchBytes(LITTLE_ENDIAN_TAG),
+          'Expected valid endian marker', self.PeekBytes(4))
+      self.SkipBytes(4)
+      section_remaining -= 4
+      exif_offset = 4
+      exif_offset_to_first_ifd = self.ReadInt(exif_is_big_endian)
+      section_remaining -= 4
+      exif_offset += 4
+      Assert(exif_offset_to_first_ifd == 8, 'First IFD offset should be 8')
+      AssertEquals(exif_offset, exif_offset_to_first_ifd)
+      ifd_index = 0
+      while True:
+        count = self.ReadShort(exif_is_big_endian)
+        Assert(count > 0 and count <= 9999, 'Expected at most 9999 IFD rows')
+        self.Log("EXIF IFD COUNT %d", count)
+        exif_offset += 2
+        section_remaining -= 2
+
+        exif_ifd_offset = None
+        exif_ifd_table = self.ReadIfdTable(count, exif_is_big_endian)
+        exif_offset += IFD_ROW_SIZE * count
+        section_remaining -= IFD_ROW_SIZE * count
+        # IFD1 describes the thumbnail, and its Compression, resolution and
+        # other tags would overwrite those of the image.
+        if ifd_index == 0:
+          exif_ifd_table.AddTo(self.image.exif_tags)
+        exif_index_tag_data = exif_ifd_table.Find(34665)
+        if exif_index_tag_data is not None:
+          # Pointer to Exif IFD
+          AssertEquals((34665, 4, 1), exif_index_tag_data[:3])
+          exif_ifd_offset = exif_index_tag_data[3]
+        self.LogUnparsedTags('ExifIndexTag', exif_ifd_table, 34665)
+        if ifd_index == 1:
+          self.ReadThumbnailLocation(exif_ifd_table, exif_endian_offset,
+              section_end)
+        exif_offset_to_next_ifd = self.ReadInt(exif_is_big_endian)
+        self.Log('exif_offset_to_next_ifd %d', exif_offset_to_next_ifd)
+        exif_offset += 4
+        section_remaining -= 4
+        if exif_ifd_offset is not None:
+          self.Log("Exif IFD")
+          Assert(exif_ifd_offset >= exif_offset, 'Expected exif ifd to be upcoming')
+          jump_distance = exif_ifd_offset - exif_offset
+          Assert(jump_distance < section_remaining, 'Expected exif ifd to be within section')
+          self.offset += jump_distance
+          exif_offset += jump_distance
+          section_remaining -= jump_distance
+          count = self.ReadShort(exif_is_big_endian)
+          Assert(count > 0 and count <= 9999, 'Expected at most 9999 IFD rows')
+          self.Log("EXIF2 IFD COUNT %d", count)
+          exif_offset += 2
+          section_remaining -= 2
+          makernote_offset = None
+          makernote_count = None
+          exif_ifd_table = self.ReadIfdTable(count, exif_is_big_endian)
+          exif_offset += IFD_ROW_SIZE * count
+          section_remaining -= IFD_ROW_SIZE * count
+          exif_ifd_table.AddTo(self.image.exif_tags)
+          exif_index_tag_data = exif_ifd_table.Find(37500)
+          if exif_index_tag_data is not None:
+            # Makernote
+            AssertEquals((37500, 7), exif_index_tag_data[:2])
+            makernote_count = exif_index_tag_data[2]
+            makernote_offset = exif_index_tag_data[3]
+            self.Log("MAKERNOTE %d", makernote_offset)
+          self.LogUnparsedTags('Exif2IndexTag', exif_ifd_table, 37500)
+          if makernote_offset:
+            Assert(makernote_offset >= exif_offset, 'Expected makernote to be upcoming')
+            Assert(makernote_count <= section_remaining, 'Makernote too long')
+            jump_distance = makernote_offset - exif_offset
+            Assert(jump_distance < section_remaining, 'Expected makernote to be within section')
+            self.offset += jump_distance
+            exif_offset += jump_distance
+            section_remaining -= jump_distance
+            maker_remaining = makernote_count
+            self.Log("In makernote")
+            if (maker_remaining >= 8
+                and self.MatchBytes(FUJIFILM_MAKERNOTE_IDENTIFIER)):
+              self.Log("Fujifilm makernote")
+              Assert(maker_remaining >= 14, 'At least 14 bytes required')
+              self.SkipBytes(8)  # FUJIFILM
+              exif_offset += 8
+              section_remaining -= 8
+              maker_remaining -= 8
+              maker_offset = 8
+              maker_ifd_offset = self.ReadInt(False)
+              exif_offset += 4
+              section_remaining -= 4
+              maker_remaining -= 4
+              maker_offset += 4
+              AssertEquals(maker_offset, maker_ifd_offset)
+              # May have to skip in the future
+              count = self.ReadShort(False)
+              Assert(count > 0 and count <= 9999, 'Expected at most 9999 IFD rows')
+              self.Log("MAKER IFD COUNT %d", count)
+              exif_offset += 2
+              section_remaining -= 2
+              maker_remaining -= 2
+              maker_offset += 2
+              parallax_offset = None
+              maker_ifd_table = self.ReadIfdTable(count, False)
+              exif_offset += IFD_ROW_SIZE * count
+              section_remaining -= IFD_ROW_SIZE * count
+              maker_remaining -= IFD_ROW_SIZE * count
+              maker_offset += IFD_ROW_SIZE * count
+              maker_ifd_table.AddTo(self.image.makernote_tags)
+              exif_index_tag_data = maker_ifd_table.Find(45585)
+              if exif_index_tag_data is not None:
+                # Parallax
+                AssertEquals((45585, 10, 1), exif_index_tag_data[:3])
+                parallax_offset = exif_index_tag_data[3]
+              self.LogUnparsedTags('MakerIndexTag', maker_ifd_table, 45585)
+              if parallax_offset:
+                Assert(parallax_offset >= maker_offset, 'Expected parallax to be upcoming')
+                jump_distance = parallax_offset - maker_offset
+                Assert(jump_distance < maker_remaining, 'Expected parallax to be within section')
+                self.offset += jump_distance
+                exif_offset += jump_distance
+                maker_offset += jump_distance
+                section_remaining -= jump_distance
+                maker_remaining = makernote_count
+                self.image.parallax_offset = self.data_offset + self.offset
+                numer, denom = self.ReadSRational(False)
+                exif_offset += 8
+                section_remaining -= 8
+                maker_remaining -= 8
+                maker_offset += 8
+                self.image.parallax = (numer, denom)
+                self.Log("Parallax %f (%d/%d)", numer * 1.0 / denom, numer, denom)
+            else:
+              self.Log("Unknown makernote")
+        if not exif_offset_to_next_ifd:
+          break
+        ifd_index += 1
+        Assert(exif_offset_to_next_ifd >= exif_offset, 'Expected exif next ifd to be upcoming')
+        jump_distance = exif_offset_to_next_ifd - exif_offset
+        Assert(jump_distance < section_remaining, 'Expected exif next ifd to be within section')
+        self.offset += jump_distance
+        exif_offset += jump_distance
+        section_remaining -= jump_distance
+    self.SkipBytes(section_remaining)
+
+  def ReadThumbnailLocation(self, ifd1_table, exif_endian_offset,
+      section_end):
+    thumbnail_offset_tag_data = ifd1_table.Find(EXIF_THUMBNAIL_OFFSET_TAG)
+    thumbnail_length_tag_data = ifd1_table.Find(EXIF_THUMBNAIL_LENGTH_TAG)
+    if thumbnail_offset_tag_data is None or thumbnail_length_tag_data is None:
+      return
+    offset = exif_endian_offset + thumbnail_offset_tag_data[3]
+    size = thumbnail_length_tag_data[3]
+    if (offset + size > section_end
+        or self.data.find('\xff\xd8', offset, offset + 2) != offset):
+      self.Log("Thumbnail at %d is not a JPEG within APP1", offset)
+      return
+    self.image.thumbnail_offset = self.data_offset + offset
+    self.image.thumbnail_size = size
+    self.Log("Thumbnail at %d size %d", self.image.thumbnail_offset, size)
+
+  def ReadMpEntryValue(self, mp_is_big_endian):
+    (attrib, image_size, image_data_offset, dependent_image1_entry,
+        dependent_image2_entry) = self.Unpack(
+            MP_ENTRY_STRUCTS[mp_is_big_endian])
+    attrib_byte1 = attrib >> 24
+    dependent_parent_image_flag = (attrib_byte1 & (1 << 7)) != 0
+    dependent_child_image_flag = (attrib_byte1 & (1 << 6)) != 0
+    representative_image_flag = (attrib_byte1 & (1 << 5)) != 0
+    image_data_format = attrib_byte1 & 0x7
+    type_code = attrib & 0xffffff
+    return (image_data_format, type_code, image_size, image_data_offset,
+        dependent_parent_image_flag, dependent_child_image_flag,
+        representative_image_flag)
+
+  def ReadApp2Section(self, marker):
+    AssertMarkerEqual(marker, self.ReadMarker())
+    section_length = self.ReadShortBig()
+    section_remaining = section_length - 2
+    Assert(section_length >= 2, "App length should be at least 2 bytes")
+    self.Log("APP2 %#06x", marker)
+    self.Log("APP2 LENGTH %d", section_length)
+    is_mp = self.MatchBytes(MP_FORMAT_IDENTIFIER)
+    self.SkipBytes(4)
+    section_remaining -= 4
+    if is_mp:
+      self.Log("APP2 is MP")
+      self.mp_endian_offset = self.data_offset + self.offset
+      mp_is_big_endian = self.MatchBytes(BIG_ENDIAN_TAG)
+      Assert(mp_is_big_endian or self.MatchBytes(LITTLE_ENDIAN_TAG),
+          'Expected valid endian marker', self.PeekBytes(4))
+      self.SkipBytes(4)
+      section_remaining -= 4
+      mp_offset = 4
+      mp_offset_to_first_ifd = self.ReadInt(mp_is_big_endian)
+      section_remaining -= 4
+      mp_offset += 4
+      Assert(mp_offset_to_first_ifd == 8, 'First IFD offset should be 8')
+      AssertEquals(mp_offset, mp_offset_to_first_ifd)
+      mp_version = BytesToInt(MP_VERSION, mp_is_big_endian)
+      while True:
+        count = self.ReadShort(mp_is_big_endian)
+        Assert(count > 0 and count <= 5, 'Expected at most 5 IFD rows')
+        self.Log("MP Index IFD COUNT %d", count)
+        mp_offset += 2
+        section_remaining -= 2
+
+        image_count = 0
+        version_found = False
+        mp_entry_tag_offset = 0
+        mp_index_table = self.ReadIfdTable(count, mp_is_big_endian)
+        mp_offset += IFD_ROW_SIZE * count
+        section_remaining -= IFD_ROW_SIZE * count
+        for mp_index_tag_data in mp_index_table.Rows():
+          Assert(mp_index_tag_data[0] >= 45056 and mp_index_tag_data[0] <= 45060,
+              'Unexpected mp index tag')
+          if mp_index_tag_data[0] == 45056:
+            # Version data
+            AssertEquals((45056, 7, 4, mp_version), mp_index_tag_data)
+            version_found = True
+          elif mp_index_tag_data[0] == 45057:
+            # Number of Images
+            AssertEquals((45057, 4, 1), mp_index_tag_data[:3])
+            image_count = mp_index_tag_data[3]
+          elif mp_index_tag_data[0] == 45058:
+            # MP Entry tag
+            AssertEquals((45058, 7, 16 * image_count), mp_index_tag_data[:3])
+            mp_entry_tag_offset = mp_index_tag_data[3]
+          else:
+            self.Log("Unparsed MPIndexTag: %d", mp_index_tag_data[0])
+        Assert(version_found, 'Expected MPIndex Version to be found')
+        Assert(mp_entry_tag_offset != 0, 'Expected MPIndex Entry Tag to be found')
+        Assert(image_count >= 1, 'Expected at least one image')
+
+        mp_offset_to_next_ifd = self.ReadInt(mp_is_big_endian)
+        self.Log('mp_offset_to_next_ifd %d', mp_offset_to_next_ifd)
+        mp_offset += 4
+        section_remaining -= 4
+
+        # TODO: Should jump directly to entry offset instead of assuming it follows.
+        AssertEquals(mp_offset, mp_entry_tag_offset)
+        AssertEquals(self.data_offset + self.offset,
+            self.mp_endian_offset + mp_entry_tag_offset)
+
+        self.mp_entry_offset = self.data_offset + self.offset
+        self.mp_is_big_endian = mp_is_big_endian
+        for i in xrange(image_count):
+          mp_entry_value_data = self.ReadMpEntryValue(mp_is_big_endian)
+          mp_offset += 16
+          section_remaining -= 16
+          self.Log("MP Entry[%d] format %d type %s", i,
+              mp_entry_value_data[0], GetTypeCodeName(mp_entry_value_data[1]))
+          image_size = mp_entry_value_data[2]
+          image_data_offset = mp_entry_value_data[3]
+          self.image_sizes.append(image_size)
+          if i == 0:
+            AssertEquals(0, image_data_offset, 'First image data offset should be null')
+            self.image_offsets.append(0)
+          else:
+            self.image_offsets.append(image_data_offset + self.mp_endian_offset)
+          image = self.GetImage(i)
+          image.offset = self.image_offsets[-1]
+          image.size = image_size
+          (image.data_format, image.type_code) = mp_entry_value_data[:2]
+          (image.dependent_parent, image.dependent_child,
+              image.representative) = mp_entry_value_data[4:]
+
+        AssertEquals(mp_offset_to_next_ifd, mp_offset,
+            'next IFD must be at current point')
+        Assert(mp_offset_to_next_ifd - mp_offset < section_remaining,
+            'Not enough bytes in current section to reach offset')
+        break # Could parse MP Index Attribute block
+    self.Log("APP2 Section remaining: %d", section_remaining)
+    self.SkipBytes(section_remaining)
+
+  def ReadJpegSection(self, marker):
+    Assert(JPEG_START_OF_SCAN != marker,
+        'ReadJpegSection cannot be used with START_OF_SCAN')
+    AssertMarkerEqual(marker, self.ReadMarker())
+    section_length = self.ReadShortBig()
+    Assert(section_length >= 2,
+        "Jpeg section length should be at least 2 bytes")
+    self.Log("JPEG %#06x", marker)
+    self.Log("JPEG SECTION LENGTH %d", section_length)
+    return self.ReadBuffer(section_length - 2)
+
+  def ReadJpegScanSection(self, marker):
+    AssertMarkerEqual(marker, JPEG_START_OF_SCAN)
+    header_start = self.offset
+    AssertMarkerEqual(marker, self.ReadMarker())
+    header_length = self.ReadShortBig()
+    Assert(header_length >= 2,
+        "Header length should be at least 2 bytes")
+    self.Log("JPEG SOS %#06x", marker)
+    self.Log("JPEG SOS HEADER LENGTH %d", header_length)
+    num_components = self.ReadByte()
+    self.Log("NUM COMP %d", num_components)
+    Assert(num_components <= 4, "Expected at most 4 components in scan section")
+    # Component and table selectors
+    self.SkipBytes(2 * num_components)
+    header_size = self.offset - header_start - 2
+    self.Log("%d %d", header_size, header_length)
+    assert header_size == header_length
+    header = self.ReadBuffer(header_length - 2)
+    if self.is_logging:
+      self.Log(BytesToFriendlyString(header))
+
+  def ReadQuantizationTables(self, section_end, tables):
+    while self.offset < section_end:
+      precision_and_id = self.ReadByte()
+      tables[precision_and_id & 0xf] = array.array('H',
+          self.Unpack(QUANTIZATION_TABLE_STRUCTS[precision_and_id >> 4 != 0]))
+
+  def ReadSegmentIndex(self, i, segment_index):
+    """Adds the segments of image i up to and including SOS to an index.
+
+    Reading starts at self.offset, which must be at the image's SOI.
+    """
+    segment_index.BeginImage(i)
+    self.ReadStartOfImage()
+    while True:
+      marker_offset = self.data_offset + self.offset
+      marker, section_length = self.Unpack(SEGMENT_HEADER_STRUCT)
+      Assert(marker >> 8 == 0xff, 'Expected a marker at offset %d but was '
+          '%#06x' % (marker_offset, marker))
+      Assert(section_length >= 2,
+          "Segment length should be at least 2 bytes")
+      segment_index.Add(i, marker, marker_offset, section_length)
+      section_end = self.offset + section_length - 2
+      if IsStartOfFrameMarker(marker):
+        segment_index.SetFrame(i, *self.Unpack(FRAME_HEADER_STRUCT, True))
+      elif marker == JPEG_DEFINE_QUANTIZATION_TABLE:
+        self.ReadQuantizationTables(section_end,
+            segment_index.quantization_tables[i])
+      self.offset = section_end
+      self.CheckAvailable(0)
+      if marker == JPEG_START_OF_SCAN:
+        break
+
+  def IndexSegments(self):
+    """Returns a SegmentIndex of every image once Parse has run."""
+    segment_index = SegmentIndex()
+    segment_index.SetImageCount(len(self.image_offsets))
+    for i in self.GetImagesInFileOrder():
+      if not self.IsJpegImage(i):
+        continue
+      self.offset = self.image_offsets[i]
+      self.ReadSegmentIndex(i, segment_index)
+    self.segment_index = segment_index
+    return segment_index
+
+  def GetImageRange(self, i):
+    start = self.image_offsets[i]
+    return start, start + self.image_sizes[i]
+
+  def GetImageData(self, i):
+    start, end = self.GetImageRange(i)
+    return buffer(self.data, start, end - start)
+
+  def GetThumbnailData(self, i):
+    """Returns a view of image i's Exif thumbnail, or None."""
+    image = self.images[i]
+    if image.thumbnail_offset is None:
+      return None
+    return buffer(self.data, image.thumbnail_offset, image.thumbnail_size)
+
+  def ReadThumbnail(self, mpo_file, i):
+    """Reads image i's Exif thumbnail from a file, or returns None.
+
+    Only needs the image headers, so it can follow ParseHeaders.
+    """
+    image = self.images[i]
+    if image.thumbnail_offset is None:
+      return None
+    mpo_file.seek(image.thumbnail_offset)
+    thumbnail = mpo_file.read(image.thumbnail_size)
+    self.bytes_read += len(thumbnail)
+    AssertEquals(image.thumbnail_size, len(thumbnail), 'Thumbnail truncated')
+    return thumbnail
+
+  def HasEndOfImage(self, image_data):
+    return (len(image_data) >= 2
+        and struct.unpack_from('>H', image_data, len(image_data) - 2)[0]
+            == END_OF_IMAGE)
+
+  def LoadHeader(self, mpo_file, offset, until_scan=False):
+    # Reads SOI, every APP segment and the marker that follows them, or with
+    # until_scan every segment up to and including SOS.
+    mpo_file.seek(offset)
+    chunks = [mpo_file.read(2)]
+    while True:
+      segment_header = mpo_file.read(4)
+      chunks.append(segment_header)
+      if len(segment_header) < 4:
+        break
+      marker, section_length = struct.unpack('>HH', segment_header)
+      if not IsAppMarker(marker) and not until_scan:
+        break
+      Assert(section_length >= 2, "App length should be at least 2 bytes")
+      chunks.append(mpo_file.read(section_length - 2))
+      if marker == JPEG_START_OF_SCAN:
+        break
+    self.data = ''.join(chunks)
+    self.data_offset = offset
+    self.offset = 0
+    self.bytes_read += len(self.data)
+
+  def ReadStartOfImage(self):
+    AssertMarkerEqual(START_OF_IMAGE, self.ReadMarker())
+
+  def ReadFirstImageHeader(self):
+    self.image = self.GetImage(0)
+    self.ReadStartOfImage()
+    while True:
+      possible_app_marker = self.PeekMarker()
+      if not IsAppMarker(possible_app_marker):
+        break
+      if possible_app_marker == APP2_MARKER:
+        self.ReadApp2Section(possible_app_marker)
+      elif possible_app_marker == APP1_MARKER:
+        self.ReadApp1Section(possible_app_marker)
+      else:
+        self.ReadAppSection(possible_app_marker)
+
+  def CheckImageTable(self):
+    Assert(self.image_offsets, 'Expected at least one image')
+    AssertEquals(len(self.image_offsets), len(self.image_sizes))
+    AssertEquals(0, self.image_offsets[0])
+    # Images may come in any order but must lie in the file without
+    # overlapping.
+    end = 0
+    for i in self.GetImagesInFileOrder():
+      Assert(self.image_offsets[i] >= end, 'Image %d overlaps the one '
+          'before it' % i)
+      end = self.image_offsets[i] + self.image_sizes[i]
+      Assert(end <= self.file_size, 'Image %d runs past the end of the file'
+          % i)
+
+  def GetImagesInFileOrder(self):
+    """Returns the image indexes sorted by offset."""
+    return sorted(xrange(len(self.image_offsets)),
+        key=lambda i: self.image_offsets[i])
+
+  def IsJpegImage(self, i):
+    # Other data formats are only located, their headers are not read.
+    return self.images[i].data_format in (None, MP_IMAGE_DATA_FORMAT_JPEG)
+
+  def ReadImageHeader(self, i):
+    self.image = self.GetImage(i)
+    self.ReadStartOfImage()
+    while True:
+      possible_app_marker = self.PeekMarker()
+      if not IsAppMarker(possible_app_marker):
+        break
+      if possible_app_marker == APP1_MARKER:
+        self.Log("Image[%d] APP1", i)
+        self.ReadApp1Section(possible_app_marker)
+      else:
+        self.Log("Image[%d] APP OTHER", i)
+        self.ReadAppSection(possible_app_marker)
+
+  def FindEndOfImage(self, offset):
+    """Returns the offset just past the EOI of the image starting at offset.
+
+    Header segments are skipped by length, so a thumbnail in APP1 is not
+    mistaken for the end. Scan data is searched with a regular expression
+    that passes over stuffed 0xff00 bytes and RST markers, so Python only
+    sees the markers between scans. Returns None if there is no EOI.
+    """
+    self.offset = offset
+    try:
+      self.ReadSegmentIndex(0, SegmentIndex())
+    except Exception, e:
+      self.Warn("Header of image at %d unreadable: %s", offset, e)
+      self.offset = offset + 2
+    data = self.data
+    while True:
+      match = ENTROPY_DATA_MARKER_PATTERN.search(data, self.offset)
+      if match is None:
+        return None
+      marker_offset = match.start()
+      marker = MARKER_STRUCT.unpack_from(data, marker_offset)[0]
+      if marker == END_OF_IMAGE:
+        return marker_offset + 2
+      if marker == START_OF_IMAGE:
+        # Truncated image, the next one starts here.
+        return marker_offset
+      # A table or scan header between scans of a progressive image.
+      if marker_offset + 4 > len(data):
+        return None
+      length = MARKER_STRUCT.unpack_from(data, marker_offset + 2)[0]
+      self.offset = marker_offset + 2 + length
+
+  def FindImageOffsets(self):
+    """Returns the offsets of the images in self.data by scanning markers."""
+    data = self.data
+    image_offsets = []
+    offset = 0
+    while True:
+      offset = data.find(START_OF_IMAGE_BYTES, offset)
+      if offset < 0:
+        break
+      image_offsets.append(offset)
+      offset = self.FindEndOfImage(offset)
+      if offset is None:
+        break
+    return image_offsets
+
+  def Recover(self):
+    """Finds the images without the MP Index and returns an MpoInfo.
+
+    Used for files whose MP Index is missing or unsupported. Each image runs
+    from its SOI to the start of the next one. Only the APP1 metadata of
+    each image is read and the MpoInfo is flagged as recovered.
+    """
+    image_offsets = self.FindImageOffsets()
+    Assert(image_offsets, 'No images found')
+    self.image_offsets = image_offsets
+    self.image_sizes = [end - start for start, end
+        in zip(image_offsets, image_offsets[1:] + [self.file_size])]
+    self.images = []
+    self.recovered = True
+    self.Info("Recovered %d images", len(image_offsets))
+    for i in xrange(len(image_offsets)):
+      image = self.GetImage(i)
+      image.offset = image_offsets[i]
+      image.size = self.image_sizes[i]
+      image.data_format = MP_IMAGE_DATA_FORMAT_JPEG
+      self.offset = image_offsets[i]
+      try:
+        self.ReadImageHeader(i)
+      except Exception, e:
+        self.Warn("Image[%d] header unreadable: %s", i, e)
+    return self.GetInfo()
+
+  def Parse(self, recover=False):
+    """Parses self.data and returns an MpoInfo.
+
+    With recover, a file whose MP Index cannot be used is split by scanning
+    for image boundaries instead of raising.
+    """
+    try:
+      self.ReadFirstImageHeader()
+      self.CheckImageTable()
+    except Exception, e:
+      if not recover:
+        raise
+      self.Warn("MP Index unusable, scanning for images: %s", e)
+      return self.Recover()
+    for i in xrange(1, len(self.image_offsets)):
+      if self.IsJpegImage(i):
+        self.offset = self.image_offsets[i]
+        self.ReadImageHeader(i)
+    return self.GetInfo()
+
+  def WriteImage(self, i, out_file):
+    image_data = self.GetImageData(i)
+    out_file.write(image_data)
+    if not self.HasEndOfImage(image_data):
+      self.Warn("Image %d missing EOI", i)
+      out_file.write(struct.pack('>H', END_OF_IMAGE))
+
+  def CopyImage(self, mpo_file, i, out_file, chunk_size=COPY_CHUNK_SIZE):
+    """Copies image i from mpo_file to out_file through a fixed size buffer.
+
+    Only needs the image table, so it can follow ParseHeaders.
+    """
+    start, end = self.GetImageRange(i)
+    mpo_file.seek(start)
+    chunk = bytearray(chunk_size)
+    chunk_view = memoryview(chunk)
+    remaining = end - start
+    tail = ''
+    while remaining > 0:
+      num_read = mpo_file.readinto(chunk_view[:min(chunk_size, remaining)])
+      if not num_read:
+        raise Exception("Image %d truncated with %d bytes remaining"
+            % (i, remaining))
+      out_file.write(chunk_view[:num_read])
+      remaining -= num_read
+      tail = (tail + str(chunk[max(num_read - 2, 0):num_read]))[-2:]
+    if not self.HasEndOfImage(tail):
+      self.Warn("Image %d missing EOI", i)
+      out_file.write(struct.pack('>H', END_OF_IMAGE))
+
+  def ParseHeaders(self, mpo_file, index_segments=False, file_size=None):
+    """Parses the headers of an open file and returns an MpoInfo.
+
+    With index_segments the headers are read up to SOS and self.segment_index
+    is filled in along the way. Headers are read in file order, so mpo_file
+    only needs to seek forwards. file_size is needed for file objects
+    without a fileno, such as archive members.
+    """
+    self.ParseIndex(mpo_file, file_size, index_segments)
+    for i in self.GetImagesInFileOrder()[1:]:
+      self.LoadImageHeader(mpo_file, i, index_segments)
+    if self.tracer is not None:
+      self.tracer.Count('header_bytes', self.bytes_read)
+    return self.GetInfo()
+
+  def ParseIndex(self, mpo_file, file_size=None, index_segments=False):
+    """Reads the first image's headers and the MP Index from an open file.
+
+    Afterwards the offset, size and type of every image are known, and
+    LoadImageHeader reads the headers of any one of them.
+    """
+    if file_size is None:
+      file_size = os.fstat(mpo_file.fileno()).st_size
+    self.file_size = file_size
+    if index_segments:
+      self.segment_index = SegmentIndex()
+    self.LoadHeader(mpo_file, 0, index_segments)
+    self.ReadFirstImageHeader()
+    self.CheckImageTable()
+    if index_segments:
+      self.segment_index.SetImageCount(len(self.image_offsets))
+      self.offset = 0
+      self.ReadSegmentIndex(0, self.segment_index)
+
+  def LoadImageHeader(self, mpo_file, i, index_segments=False):
+    """Reads the headers of image i, once ParseIndex has run."""
+    if i == 0 or not self.IsJpegImage(i):
+      return
+    self.LoadHeader(mpo_file, self.image_offsets[i], index_segments)
+    self.ReadImageHeader(i)
+    if index_segments:
+      self.offset = 0
+      self.ReadSegmentIndex(i, self.segment_index)
+
+def MapFile(mpo_file):
+  """Returns a read-only mmap of an open file."""
+  return mmap.mmap(mpo_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+def ExtractImages(filename, output_pattern, chunk_size=COPY_CHUNK_SIZE,
+    log=None, tracer=None):
+  """Writes each image of an MPO file to output_pattern % index.
+
+  Reads only the headers and then streams each image, so memory use does not
+  depend on the file size. Returns the MpoInfo and the paths written.
+  """
+  mpo_file = open(filename, 'rb')
+  try:
+    parser = ImageParser(log=log, tracer=tracer)
+    info = parser.ParseHeaders(mpo_file)
+    output_filenames = []
+    for i in xrange(len(parser.image_offsets)):
+      output_filename = output_pattern % i
+      out_file = open(output_filename, 'wb')
+      try:
+        parser.CopyImage(mpo_file, i, out_file, chunk_size)
+      finally:
+        out_file.close()
+      output_filenames.append(output_filename)
+    return info, output_filenames
+  finally:
+    mpo_file.close()
+
+def ParseMpo(data, log=None, recover=False, tracer=None):
+  """Parses an MPO held in a string or mmap and returns an MpoInfo."""
+  return ImageParser(data, log, tracer).Parse(recover)
+
+def IndexMpoFile(filename, log=None, tracer=None):
+  """Returns the MpoInfo and SegmentIndex of an MPO file.
+
+  Only the segments up to the start of each image's scan data are read.
+  """
+  mpo_file = open(filename, 'rb')
+  try:
+    parser = ImageParser(log=log, tracer=tracer)
+    info = parser.ParseHeaders(mpo_file, True)
+    return info, parser.segment_index
+  finally:
+    mpo_file.close()
+
+def ParseMpoFile(filename, log=None, recover=False, tracer=None):
+  """Parses the headers of an MPO file and returns an MpoInfo.
+
+  Only the APP segments at the start of each image are read. With recover,
+  a file whose MP Index cannot be used is mapped and scanned instead.
+  """
+  mpo_file = open(filename, 'rb')
+  try:
+    try:
+      return ImageParser(log=log, tracer=tracer).ParseHeaders(mpo_file)
+    except Exception:
+      if not recover:
+        raise
+    data = MapFile(mpo_file)
+    try:
+      return ImageParser(data, log, tracer).Recover()
+    finally:
+      data.close()
+  finally:
+    mpo_file.close()
+
+class MpoFile:
+  """Lazy access to the images of an open MPO file.
+
+  Only the first image's headers and the MP Index are read up front. The
+  headers of any other image are read when it is first asked for, and its
+  data is read by seeking straight to it, so taking one view of a
+  multi-view file reads that view and nothing else.
+
+  Close closes the file, and an MpoFile can be used in a with statement to
+  do so when it is left.
+  """
+
+  def __init__(self, mpo_file, file_size=None, log=None, tracer=None):
+    self.mpo_file = mpo_file
+    self.parser = ImageParser(log=log, tracer=tracer)
+    self.parser.ParseIndex(mpo_file, file_size)
+    self.loaded = set([0])
+
+  def GetImageCount(self):
+    return len(self.parser.image_offsets)
+
+  def GetTypeCode(self, i):
+    return self.parser.images[i].type_code
+
+  def FindImages(self, type_code):
+    """Returns the indexes of the images with the given MP type code."""
+    return [i for i in xrange(self.GetImageCount())
+        if self.GetTypeCode(i) == type_code]
+
+  def GetImage(self, i):
+    """Returns the MpoImage of image i, reading its headers if needed."""
+    if i not in self.loaded:
+      self.parser.LoadImageHeader(self.mpo_file, i)
+      self.loaded.add(i)
+    return self.parser.images[i]
+
+  def ReadImage(self, i):
+    """Returns the data of image i as a string."""
+    start, end = self.parser.GetImageRange(i)
+    self.mpo_file.seek(start)
+    image_data = self.mpo_file.read(end - start)
+    self.parser.bytes_read += len(image_data)
+    AssertEquals(end - start, len(image_data), 'Image %d truncated' % i)
+    return image_data
+
+  def CopyImage(self, i, out_file, chunk_size=COPY_CHUNK_SIZE):
+    """Copies image i to out_file, see ImageParser.CopyImage."""
+    start, end = self.parser.GetImageRange(i)
+    self.parser.CopyImage(self.mpo_file, i, out_file, chunk_size)
+    self.parser.bytes_read += end - start
+
+  def GetBytesRead(self):
+    return self.parser.bytes_read
+
+  def GetInfo(self):
+    """Returns an MpoInfo with the headers of every image loaded."""
+    for i in xrange(self.GetImageCount()):
+      self.GetImage(i)
+    return self.parser.GetInfo()
+
+  def Close(self):
+    self.mpo_file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.Close()
+
+def OpenMpoFile(filename, log=None, tracer=None):
+  """Returns an MpoFile for filename, which the caller should Close."""
+  mpo_file = open(filename, 'rb')
+  try:
+    return MpoFile(mpo_file, log=log, tracer=tracer)
+  except:
+    mpo_file.close()
+    raise
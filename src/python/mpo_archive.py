@@ -0,0 +1,268 @@
+"""Reading MPOs straight from zip and tar archives.
+
+Members are parsed from the archive stream without being extracted to disk.
+Stored zip members and members of uncompressed tar files can seek, so a
+header-only parse reads only the APP segments of each image. Compressed
+members are read forwards and the data between headers is skipped by
+decompressing it. ExtractMember streams the images of a member in one
+forward pass.
+"""
+
+import sys, os, time, struct, tarfile, zipfile
+
+import mpo
+
+MPO_EXTENSIONS = ('.mpo',)
+
+# Size of the buffer used to skip forwards in streams that cannot seek.
+SKIP_CHUNK_SIZE = 1 << 16
+
+class SliceFile:
+  """A read-only view of size bytes of a seekable file, starting at start."""
+
+  def __init__(self, base_file, start, size):
+    self.base_file = base_file
+    self.start = start
+    self.size = size
+    self.position = 0
+
+  def seek(self, offset, whence=os.SEEK_SET):
+    if whence == os.SEEK_CUR:
+      offset += self.position
+    elif whence == os.SEEK_END:
+      offset += self.size
+    self.position = max(0, min(offset, self.size))
+
+  def tell(self):
+    return self.position
+
+  def read(self, size=-1):
+    if size < 0 or size > self.size - self.position:
+      size = self.size - self.position
+    self.base_file.seek(self.start + self.position)
+    data = self.base_file.read(size)
+    self.position += len(data)
+    return data
+
+  def readinto(self, buf):
+    data = self.read(len(buf))
+    buf[:len(data)] = data
+    return len(data)
+
+class ForwardFile:
+  """Gives a stream that can only be read forwards the file methods that
+  ImageParser.ParseHeaders uses. Seeking forwards reads and discards."""
+
+  def __init__(self, stream):
+    self.stream = stream
+    self.position = 0
+
+  def seek(self, offset, whence=os.SEEK_SET):
+    if whence == os.SEEK_CUR:
+      offset += self.position
+    mpo.Assert(whence != os.SEEK_END and offset >= self.position,
+        'Cannot seek backwards in a stream')
+    while self.position < offset:
+      if not self.read(min(offset - self.position, SKIP_CHUNK_SIZE)):
+        break
+
+  def tell(self):
+    return self.position
+
+  def read(self, size=-1):
+    data = self.stream.read(size)
+    self.position += len(data)
+    return data
+
+  def readinto(self, buf):
+    data = self.read(len(buf))
+    buf[:len(data)] = data
+    return len(data)
+
+class ArchiveMember:
+  """An MPO in an archive. file is only valid until the next member."""
+
+  def __init__(self, name, size, file):
+    self.name = name
+    self.size = size
+    self.file = file
+
+def IsMpoName(name):
+  return os.path.splitext(name)[1].lower() in MPO_EXTENSIONS
+
+def IterZipMembers(zip_file):
+  for zip_info in zip_file.infolist():
+    if zip_info.filename.endswith('/') or not IsMpoName(zip_info.filename):
+      continue
+    if zip_info.compress_type == zipfile.ZIP_STORED and not (
+        zip_info.flag_bits & 0x1):
+      # Stored data can be read in place, which allows seeking over it.
+      zip_file.fp.seek(zip_info.header_offset)
+      file_header = struct.unpack(zipfile.structFileHeader,
+          zip_file.fp.read(zipfile.sizeFileHeader))
+      data_offset = (zip_info.header_offset + zipfile.sizeFileHeader
+          + file_header[zipfile._FH_FILENAME_LENGTH]
+          + file_header[zipfile._FH_EXTRA_FIELD_LENGTH])
+      member_file = SliceFile(zip_file.fp, data_offset, zip_info.file_size)
+    else:
+      member_file = ForwardFile(zip_file.open(zip_info))
+    yield ArchiveMember(zip_info.filename, zip_info.file_size, member_file)
+
+def IterTarMembers(tar_file, is_stream):
+  for tar_info in tar_file:
+    if not tar_info.isfile() or not IsMpoName(tar_info.name):
+      continue
+    member_file = tar_file.extractfile(tar_info)
+    if is_stream:
+      member_file = ForwardFile(member_file)
+    yield ArchiveMember(tar_info.name, tar_info.size, member_file)
+
+def IterArchiveMembers(archive_filename):
+  """Yields an ArchiveMember for each MPO in a zip or tar file.
+
+  '-' reads a tar stream from stdin.
+  """
+  if archive_filename == '-':
+    tar_file = tarfile.open(fileobj=sys.stdin, mode='r|*')
+    try:
+      for member in IterTarMembers(tar_file, True):
+        yield member
+    finally:
+      tar_file.close()
+  elif zipfile.is_zipfile(archive_filename):
+    zip_file = zipfile.ZipFile(archive_filename)
+    try:
+      for member in IterZipMembers(zip_file):
+        yield member
+    finally:
+      zip_file.close()
+  else:
+    # Not opened as a stream, so the members of uncompressed tar files seek
+    # in place. Compressed ones decompress to seek forwards.
+    tar_file = tarfile.open(archive_filename, 'r:*')
+    try:
+      for member in IterTarMembers(tar_file, False):
+        yield member
+    finally:
+      tar_file.close()
+
+def ParseMember(member, log=None, tracer=None):
+  """Parses the headers of an archive member and returns the parser."""
+  parser = mpo.ImageParser(log=log, tracer=tracer)
+  parser.ParseHeaders(member.file, file_size=member.size)
+  return parser
+
+class ImageStream:
+  """Reads one image of a member: the header the parser already loaded,
+  then the rest of the image from the member file."""
+
+  def __init__(self, header, member_file, remaining):
+    self.header = header
+    self.header_offset = 0
+    self.member_file = member_file
+    self.remaining = remaining
+
+  def read(self, size=-1):
+    # Fills the request across the end of the header, as tarfile treats a
+    # short read as the end of the file.
+    if size < 0:
+      size = len(self.header) - self.header_offset + self.remaining
+    data = ''
+    if self.header_offset < len(self.header):
+      data = self.header[self.header_offset:self.header_offset + size]
+      self.header_offset += len(data)
+      size -= len(data)
+    size = min(size, self.remaining)
+    if size > 0:
+      rest = self.member_file.read(size)
+      self.remaining -= len(rest)
+      data += rest
+    return data
+
+def ExtractMember(member, write_image, log=None, tracer=None):
+  """Streams each image of a member to write_image and returns the parser.
+
+  The member is read once, forwards. write_image(member, i, size, stream)
+  is called for each image in file order and can read up to size bytes from
+  stream; whatever it leaves is skipped.
+  """
+  parser = mpo.ImageParser(log=log, tracer=tracer)
+  parser.file_size = member.size
+  parser.LoadHeader(member.file, 0)
+  parser.ReadFirstImageHeader()
+  parser.CheckImageTable()
+  for i in parser.GetImagesInFileOrder():
+    header = ''
+    if i > 0:
+      member.file.seek(parser.image_offsets[i])
+      if parser.IsJpegImage(i):
+        parser.LoadHeader(member.file, parser.image_offsets[i])
+        parser.ReadImageHeader(i)
+        header = parser.data
+    else:
+      header = parser.data
+    size = parser.image_sizes[i]
+    mpo.Assert(len(header) <= size, 'Image %d header runs past its end' % i)
+    write_image(member, i, size,
+        ImageStream(header, member.file, size - len(header)))
+  return parser
+
+def GetImageName(member_name, i):
+  """Returns a relative path for image i of a member, without any parts
+  that could leave the output directory."""
+  parts = [part for part in member_name.replace('\\', '/').split('/')
+      if part not in ('', '.', '..')]
+  return '%s.image%d.jpg' % (os.path.splitext('/'.join(parts))[0], i)
+
+class DirectoryImageWriter:
+  """A write_image for ExtractMember that writes each image to a file
+  under output_dir. As with ImageParser.CopyImage, a missing EOI is added."""
+
+  def __init__(self, output_dir, chunk_size=mpo.COPY_CHUNK_SIZE):
+    self.output_dir = output_dir
+    self.chunk_size = chunk_size
+
+  def __call__(self, member, i, size, stream):
+    output_filename = os.path.join(self.output_dir,
+        GetImageName(member.name, i))
+    output_subdir = os.path.dirname(output_filename)
+    if not os.path.isdir(output_subdir):
+      os.makedirs(output_subdir)
+    out_file = open(output_filename, 'wb')
+    try:
+      tail = ''
+      while True:
+        chunk = stream.read(self.chunk_size)
+        if not chunk:
+          break
+        out_file.write(chunk)
+        tail = (tail + chunk[-2:])[-2:]
+      if tail != struct.pack('>H', mpo.END_OF_IMAGE):
+        out_file.write(struct.pack('>H', mpo.END_OF_IMAGE))
+    finally:
+      out_file.close()
+
+class TarImageWriter:
+  """A write_image for ExtractMember that streams each image into a tar
+  file, compressed as its extension says.
+
+  A tar header holds the size of what follows, so images are stored as they
+  are in the MPO, without adding a missing EOI.
+  """
+
+  def __init__(self, tar_filename):
+    mode = 'w|'
+    if tar_filename.endswith(('.tar.gz', '.tgz')):
+      mode = 'w|gz'
+    elif tar_filename.endswith(('.tar.bz2', '.tbz2')):
+      mode = 'w|bz2'
+    self.tar_file = tarfile.open(tar_filename, mode)
+
+  def __call__(self, member, i, size, stream):
+    tar_info = tarfile.TarInfo(GetImageName(member.name, i))
+    tar_info.size = size
+    tar_info.mtime = int(time.time())
+    self.tar_file.addfile(tar_info, stream)
+
+  def Close(self):
+    self.tar_file.close()
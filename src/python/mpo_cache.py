@@ -0,0 +1,150 @@
+"""Persistent cache of parsed MPO metadata.
+
+Entries are stored in a SQLite database keyed by path and parse mode, and
+are only used while the file's size, mtime and inode (and optionally its
+SHA-1) are unchanged.
+"""
+
+import os, json, time, hashlib, sqlite3
+
+import mpo
+
+DEFAULT_MAX_ENTRIES = 1000000
+
+HASH_CHUNK_SIZE = 1 << 20
+
+def GetMode(full=False, recover=False, estimate_parallax=False):
+  """Returns the parse mode entries are kept under for these parse options,
+  so that results of parses with different options are kept apart.
+  Estimating parallax maps the whole file, as full does."""
+  mode = (full or estimate_parallax) and 'full' or 'headers'
+  if recover:
+    mode += '+recover'
+  if estimate_parallax:
+    mode += '+parallax'
+  return mode
+
+def HashFile(filename):
+  sha1 = hashlib.sha1()
+  f = open(filename, 'rb')
+  try:
+    while True:
+      chunk = f.read(HASH_CHUNK_SIZE)
+      if not chunk:
+        break
+      sha1.update(chunk)
+  finally:
+    f.close()
+  return sha1.hexdigest()
+
+class MpoCache:
+  """Caches MpoInfo results for MPO files.
+
+  A changed file invalidates its entry. Once there are more than max_entries
+  entries the least recently used are evicted. With verify_contents the file
+  is hashed on every lookup, which costs a full read but catches in-place
+  rewrites that keep the size and mtime.
+
+  Lookups take a key from GetKey, which stats the file. The same key should
+  be passed to Put, so that a file changed while it was being parsed is
+  stored under its old stat and invalidated on the next lookup.
+  """
+
+  def __init__(self, db_filename, max_entries=DEFAULT_MAX_ENTRIES,
+      verify_contents=False):
+    self.db = sqlite3.connect(db_filename)
+    columns = [row[1] for row in self.db.execute('PRAGMA table_info(mpo_info)')]
+    if columns and 'mode' not in columns:
+      # Entries from before parse modes were kept apart cannot be trusted.
+      self.db.execute('DROP TABLE mpo_info')
+    self.db.execute('CREATE TABLE IF NOT EXISTS mpo_info ('
+        'path TEXT, mode TEXT, size INTEGER, mtime REAL, inode INTEGER, '
+        'sha1 TEXT, info TEXT, last_access REAL, PRIMARY KEY (path, mode))')
+    self.db.execute('CREATE INDEX IF NOT EXISTS mpo_info_last_access '
+        'ON mpo_info (last_access)')
+    self.max_entries = max_entries
+    self.num_entries = self.db.execute(
+        'SELECT COUNT(*) FROM mpo_info').fetchone()[0]
+    self.verify_contents = verify_contents
+    self.hits = 0
+    self.misses = 0
+    self.invalidations = 0
+    self.evictions = 0
+
+  def GetKey(self, filename, mode=GetMode()):
+    """Returns the key of a file's entry for a parse mode from GetMode."""
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    return path, mode, stat.st_size, stat.st_mtime, stat.st_ino
+
+  def Get(self, key):
+    """Returns the cached MpoInfo for a key from GetKey, or None."""
+    path, mode, size, mtime, inode = key
+    row = self.db.execute('SELECT size, mtime, inode, sha1, info '
+        'FROM mpo_info WHERE path = ? AND mode = ?', (path, mode)).fetchone()
+    if row is not None:
+      cached_size, cached_mtime, cached_inode, cached_sha1, info_json = row
+      valid = (size, mtime, inode) == (cached_size, cached_mtime, cached_inode)
+      if valid and self.verify_contents:
+        valid = cached_sha1 == HashFile(path)
+      if valid:
+        self.hits += 1
+        self.db.execute('UPDATE mpo_info SET last_access = ? '
+            'WHERE path = ? AND mode = ?', (time.time(), path, mode))
+        return mpo.MpoInfo.FromDict(json.loads(info_json))
+      self.invalidations += 1
+      self.Delete(path, mode)
+    self.misses += 1
+    return None
+
+  def Put(self, key, info):
+    """Stores the MpoInfo parsed from a file after GetKey returned key."""
+    path, mode, size, mtime, inode = key
+    sha1 = None
+    if self.verify_contents:
+      sha1 = HashFile(path)
+    self.Delete(path, mode)
+    self.db.execute('INSERT INTO mpo_info '
+        '(path, mode, size, mtime, inode, sha1, info, last_access) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        (path, mode, size, mtime, inode, sha1, json.dumps(info.ToDict()),
+            time.time()))
+    self.num_entries += 1
+    if self.num_entries > self.max_entries:
+      self.Evict(self.num_entries - self.max_entries)
+
+  def Delete(self, path, mode):
+    cursor = self.db.execute('DELETE FROM mpo_info WHERE path = ? AND mode = ?',
+        (path, mode))
+    self.num_entries -= cursor.rowcount
+
+  def Evict(self, num_entries):
+    cursor = self.db.execute('DELETE FROM mpo_info WHERE rowid IN ('
+        'SELECT rowid FROM mpo_info ORDER BY last_access LIMIT ?)',
+        (num_entries,))
+    self.num_entries -= cursor.rowcount
+    self.evictions += cursor.rowcount
+
+  def ParseMpoFile(self, filename, recover=False):
+    """Like mpo.ParseMpoFile but consults and fills the cache."""
+    key = self.GetKey(filename, GetMode(recover=recover))
+    info = self.Get(key)
+    if info is None:
+      info = mpo.ParseMpoFile(filename, recover=recover)
+      self.Put(key, info)
+    return info
+
+  def Commit(self):
+    self.db.commit()
+
+  def Close(self):
+    self.db.commit()
+    self.db.close()
+
+  def GetStats(self):
+    return {
+      'hits': self.hits,
+      'misses': self.misses,
+      'invalidations': self.invalidations,
+      'evictions': self.evictions,
+    }
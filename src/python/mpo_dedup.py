@@ -0,0 +1,277 @@
+"""Finding near-duplicate MPOs by a perceptual hash of their left image.
+
+The hash is a 64 bit DCT hash: the image is reduced to 32x32 grey levels and
+each bit says whether one of the 64 lowest frequency DCT coefficients is
+above their median. Re-encoded, re-exported and slightly shifted copies of a
+photo hash within a few bits of each other.
+
+The left image's Exif thumbnail is hashed where there is one, which costs a
+few KB of reads. It is cropped to the aspect ratio of the full image first,
+as cameras letterbox it to 4:3, which keeps its hash within a few bits of a
+hash of the decoded image. Files without a thumbnail are decoded at reduced
+scale.
+
+HashIndex keeps the hashes in a SQLite file as a multi-index hash table:
+each hash is split into eight one byte chunks held in indexed columns. Two
+hashes within 7 bits of each other must share a chunk, and within 15 bits
+must have a chunk within one bit, so a query only compares the few hashes in
+matching buckets. A BK-tree was not used because 64 bit hashes are spread so
+evenly that it visits most of its nodes for any useful distance. Requires
+NumPy and PIL.
+"""
+
+import os, io, sqlite3, itertools
+
+import numpy
+from PIL import Image, JpegImagePlugin
+
+import mpo
+
+DCT_SIZE = 32
+HASH_SIZE = 8
+NUM_CHUNKS = 8
+CHUNK_BITS = 8
+DEFAULT_THRESHOLD = 6
+MAX_THRESHOLD = 2 * NUM_CHUNKS - 1
+# Exif tags holding the size of the full image.
+EXIF_PIXEL_X_DIMENSION_TAG = 40962
+EXIF_PIXEL_Y_DIMENSION_TAG = 40963
+SOURCES = ('auto', 'thumbnail', 'decode')
+# Rows of a bucket compared at a time, which bounds the size of the distance
+# matrix when hashes cluster.
+COMPARE_BLOCK_SIZE = 512
+
+DCT_MATRIX = numpy.cos(numpy.pi * numpy.outer(numpy.arange(DCT_SIZE),
+    2 * numpy.arange(DCT_SIZE) + 1) / (2.0 * DCT_SIZE))
+POPCOUNT_TABLE = numpy.array([bin(i).count('1') for i in xrange(256)],
+    numpy.uint8)
+
+def HammingDistance(a, b):
+  return bin(a ^ b).count('1')
+
+def PopCount(values):
+  """Returns the number of bits set in each element of a uint64 array."""
+  values = numpy.ascontiguousarray(values)
+  return POPCOUNT_TABLE[values.view(numpy.uint8)].reshape(
+      values.shape + (8,)).sum(axis=-1)
+
+def ComputeHash(image):
+  """Returns the 64 bit DCT hash of a PIL image."""
+  if image.mode != 'L':
+    image = image.convert('L')
+  pixels = numpy.asarray(image.resize((DCT_SIZE, DCT_SIZE), Image.ANTIALIAS),
+      numpy.float64)
+  coefficients = DCT_MATRIX.dot(pixels).dot(DCT_MATRIX.T)[
+      :HASH_SIZE, :HASH_SIZE].ravel()
+  # The DC term is left out of the median as it only reflects brightness.
+  bits = coefficients > numpy.median(coefficients[1:])
+  return sum(1 << i for i in numpy.flatnonzero(bits).tolist())
+
+def CropToAspect(image, width, height):
+  """Crops a PIL image about its centre to the aspect ratio width:height."""
+  image_width, image_height = image.size
+  crop_height = int(round(image_width * float(height) / width))
+  if crop_height < image_height:
+    top = (image_height - crop_height) // 2
+    return image.crop((0, top, image_width, top + crop_height))
+  crop_width = int(round(image_height * float(width) / height))
+  left = (image_width - crop_width) // 2
+  return image.crop((left, 0, left + crop_width, image_height))
+
+def GetExifDimensions(image):
+  try:
+    return (image.exif_tags[EXIF_PIXEL_X_DIMENSION_TAG][2],
+        image.exif_tags[EXIF_PIXEL_Y_DIMENSION_TAG][2])
+  except KeyError:
+    return None
+
+def OpenJpeg(image_data):
+  # Opened as a plain JPEG, see render_mpo.DecodeImage.
+  return JpegImagePlugin.JpegImageFile(io.BytesIO(image_data))
+
+def HashFile(filename, source='auto'):
+  """Returns the hash of an MPO's left image and the source it came from,
+  'thumbnail' or 'decode'."""
+  with mpo.OpenMpoFile(filename) as lazy_file:
+    image = lazy_file.GetImage(0)
+    if source != 'decode':
+      dimensions = GetExifDimensions(image)
+      thumbnail = lazy_file.parser.ReadThumbnail(lazy_file.mpo_file, 0)
+      if thumbnail is not None and dimensions is not None:
+        return ComputeHash(CropToAspect(OpenJpeg(thumbnail),
+            *dimensions)), 'thumbnail'
+      mpo.Assert(source != 'thumbnail', 'No usable thumbnail')
+    left = OpenJpeg(lazy_file.ReadImage(0))
+    # The hash only needs 32x32, so let the decoder drop coefficients.
+    left.draft('L', (DCT_SIZE * 4, DCT_SIZE * 4))
+    return ComputeHash(left), 'decode'
+
+def GetChunks(hash_value):
+  return [(hash_value >> (chunk * CHUNK_BITS)) & ((1 << CHUNK_BITS) - 1)
+      for chunk in xrange(NUM_CHUNKS)]
+
+def GetProbeMasks(threshold):
+  """Returns the XOR masks of the chunk values to look in. Hashes within
+  threshold bits have some chunk within threshold // NUM_CHUNKS bits."""
+  radius = threshold // NUM_CHUNKS
+  masks = []
+  for num_bits in xrange(radius + 1):
+    for bits in itertools.combinations(xrange(CHUNK_BITS), num_bits):
+      masks.append(sum(1 << bit for bit in bits))
+  return masks
+
+def ToSigned(hash_value):
+  # SQLite integers are signed 64 bit.
+  return hash_value - (1 << 64) if hash_value >= 1 << 63 else hash_value
+
+def FromSigned(value):
+  return value + (1 << 64) if value < 0 else value
+
+class UnionFind:
+  """Disjoint sets of the items passed to Union, each held in parents."""
+
+  def __init__(self):
+    self.parents = {}
+
+  def Find(self, item):
+    root = item
+    while self.parents.get(root, root) != root:
+      root = self.parents[root]
+    while item != root:
+      self.parents[item], item = root, self.parents.get(item, item)
+    return root
+
+  def Union(self, a, b):
+    self.parents.setdefault(a, a)
+    self.parents.setdefault(b, b)
+    a, b = self.Find(a), self.Find(b)
+    if a != b:
+      self.parents[max(a, b)] = min(a, b)
+
+def FindPairs(hashes, threshold):
+  """Yields (left, right) index arrays of pairs of a uint64 array within
+  threshold bits. A pair may be yielded more than once."""
+  masks = GetProbeMasks(threshold)
+  num_values = 1 << CHUNK_BITS
+  for chunk in xrange(NUM_CHUNKS):
+    values = (hashes >> numpy.uint64(chunk * CHUNK_BITS)) & numpy.uint64(
+        num_values - 1)
+    order = numpy.argsort(values, kind='mergesort')
+    starts = numpy.searchsorted(values[order], numpy.arange(num_values + 1))
+    for value in xrange(num_values):
+      bucket = order[starts[value]:starts[value + 1]]
+      if not len(bucket):
+        continue
+      for mask in masks:
+        other_value = value ^ mask
+        # Each pair of buckets is compared from the lower value only.
+        if other_value < value:
+          continue
+        other = order[starts[other_value]:starts[other_value + 1]]
+        if not len(other):
+          continue
+        other_hashes = hashes[other]
+        for block_start in xrange(0, len(bucket), COMPARE_BLOCK_SIZE):
+          block = bucket[block_start:block_start + COMPARE_BLOCK_SIZE]
+          distances = PopCount(hashes[block][:, None] ^ other_hashes[None, :])
+          rows, columns = numpy.nonzero(distances <= threshold)
+          left, right = block[rows], other[columns]
+          if other_value == value:
+            keep = left < right
+            left, right = left[keep], right[keep]
+          if len(left):
+            yield left, right
+
+class HashIndex:
+  """Perceptual hashes of MPO files, keyed by absolute path.
+
+  Entries are only used while the file's size and mtime are unchanged. The
+  (size, mtime) of every entry is held in memory, so checking which files
+  need hashing costs one stat per file.
+  """
+
+  def __init__(self, db_filename):
+    self.db = sqlite3.connect(db_filename)
+    chunk_columns = ['c%d' % chunk for chunk in xrange(NUM_CHUNKS)]
+    self.db.execute('CREATE TABLE IF NOT EXISTS phash ('
+        'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, hash INTEGER, '
+        'source TEXT, %s)' % ', '.join('%s INTEGER' % column
+            for column in chunk_columns))
+    for column in chunk_columns:
+      self.db.execute('CREATE INDEX IF NOT EXISTS phash_%s ON phash (%s)'
+          % (column, column))
+    self.entries = dict((path, (size, mtime)) for path, size, mtime
+        in self.db.execute('SELECT path, size, mtime FROM phash'))
+
+  def __len__(self):
+    return len(self.entries)
+
+  def IsCurrent(self, path, size, mtime):
+    return self.entries.get(path) == (size, mtime)
+
+  def Put(self, path, size, mtime, hash_value, source):
+    self.entries[path] = (size, mtime)
+    self.db.execute('INSERT OR REPLACE INTO phash VALUES (?, ?, ?, ?, ?, %s)'
+        % ', '.join('?' * NUM_CHUNKS), [path, size, mtime,
+            ToSigned(hash_value), source] + GetChunks(hash_value))
+
+  def Delete(self, path):
+    del self.entries[path]
+    self.db.execute('DELETE FROM phash WHERE path = ?', (path,))
+
+  def Prune(self):
+    """Forgets files that no longer exist and returns how many."""
+    missing = [path for path in self.entries if not os.path.exists(path)]
+    for path in missing:
+      self.Delete(path)
+    return len(missing)
+
+  def Query(self, hash_value, threshold=DEFAULT_THRESHOLD):
+    """Returns (distance, path) of the files within threshold bits of
+    hash_value, closest first."""
+    mpo.Assert(0 <= threshold <= MAX_THRESHOLD, 'Threshold must be 0 to %d'
+        % MAX_THRESHOLD)
+    masks = GetProbeMasks(threshold)
+    conditions = []
+    params = []
+    for chunk, value in enumerate(GetChunks(hash_value)):
+      conditions.append('c%d IN (%s)' % (chunk, ', '.join('?' * len(masks))))
+      params.extend(value ^ mask for mask in masks)
+    matches = []
+    for path, stored_hash in self.db.execute('SELECT path, hash FROM phash '
+        'WHERE %s' % ' OR '.join(conditions), params):
+      distance = HammingDistance(hash_value, FromSigned(stored_hash))
+      if distance <= threshold:
+        matches.append((distance, path))
+    matches.sort()
+    return matches
+
+  def FindDuplicates(self, threshold=DEFAULT_THRESHOLD):
+    """Returns groups of paths, each linked by hashes within threshold bits.
+
+    Groups are closed under the relation, so a chain of small differences
+    can join files further apart than threshold.
+    """
+    mpo.Assert(0 <= threshold <= MAX_THRESHOLD, 'Threshold must be 0 to %d'
+        % MAX_THRESHOLD)
+    paths = []
+    hash_values = []
+    for path, stored_hash in self.db.execute('SELECT path, hash FROM phash'):
+      paths.append(path)
+      hash_values.append(FromSigned(stored_hash))
+    hashes = numpy.array(hash_values, numpy.uint64)
+    groups = UnionFind()
+    for left, right in FindPairs(hashes, threshold):
+      for i, j in zip(left.tolist(), right.tolist()):
+        groups.Union(i, j)
+    members = {}
+    for i in groups.parents:
+      members.setdefault(groups.Find(i), []).append(paths[i])
+    return sorted(sorted(group) for group in members.itervalues())
+
+  def Commit(self):
+    self.db.commit()
+
+  def Close(self):
+    self.db.commit()
+    self.db.close()
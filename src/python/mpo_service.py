@@ -0,0 +1,288 @@
+"""Rendering MPO stereo pairs on request, for serve_mpo.py.
+
+RenderService decodes the left and right images of a file at one of the JPEG
+decoder's reduced scales, keeps the pixels in a DecodedCache bounded by bytes
+and composites the requested view from them. Decoding and compositing run on
+a fixed pool of worker threads: PIL's decoder and encoder and NumPy's array
+operations release the GIL, and the decoded pixels stay in this process
+instead of being pickled back from worker processes. Concurrent requests for
+the same rendering, or for renderings that need the same decode, wait for
+the one already running. Requires NumPy and PIL.
+"""
+
+import os, io, math, time, bisect, threading, collections
+from multiprocessing.pool import ThreadPool
+
+from PIL import Image
+
+import mpo, mpo_views, render_mpo, pyramid_mpo, estimate_parallax
+
+DEFAULT_CACHE_BYTES = 512 << 20
+DEFAULT_QUALITY = 85
+SCALES = mpo_views.SCALES
+VIEWS = mpo_views.VIEWS
+mpo.AssertEquals(sorted(render_mpo.RENDERERS), list(mpo_views.RENDER_MODES),
+    'mpo_views.RENDER_MODES out of date')
+
+class DecodedPair:
+  """The decoded images of one file at one scale."""
+
+  def __init__(self, left, right, parallax_x_offset):
+    self.left = left
+    self.right = right
+    # In pixels of the decoded images, not the full size ones.
+    self.parallax_x_offset = parallax_x_offset
+    self.size = left.nbytes + right.nbytes
+
+class DecodedCache:
+  """An LRU cache of DecodedPairs holding at most max_bytes of pixels.
+
+  Thread safe. A pair larger than max_bytes is not kept at all.
+  """
+
+  def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+    self.max_bytes = max_bytes
+    self.entries = collections.OrderedDict()
+    self.num_bytes = 0
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def Get(self, key):
+    with self.lock:
+      pair = self.entries.pop(key, None)
+      if pair is None:
+        self.misses += 1
+        return None
+      # Reinserted to mark it most recently used.
+      self.entries[key] = pair
+      self.hits += 1
+      return pair
+
+  def Peek(self, key):
+    """Returns the pair for key without counting a lookup or using it."""
+    with self.lock:
+      return self.entries.get(key)
+
+  def Put(self, key, pair):
+    with self.lock:
+      old_pair = self.entries.pop(key, None)
+      if old_pair is not None:
+        self.num_bytes -= old_pair.size
+      if pair.size > self.max_bytes:
+        return
+      self.entries[key] = pair
+      self.num_bytes += pair.size
+      while self.num_bytes > self.max_bytes:
+        _, evicted = self.entries.popitem(last=False)
+        self.num_bytes -= evicted.size
+        self.evictions += 1
+
+  def GetStats(self):
+    with self.lock:
+      lookups = self.hits + self.misses
+      return {
+        'entries': len(self.entries),
+        'bytes': self.num_bytes,
+        'max_bytes': self.max_bytes,
+        'hits': self.hits,
+        'misses': self.misses,
+        'evictions': self.evictions,
+        'hit_rate': lookups and float(self.hits) / lookups or 0.0,
+      }
+
+class PendingCall:
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+
+class Coalescer:
+  """Runs a function once per key for all the threads that ask for it at
+  the same time. Results are not kept once the last caller has them."""
+
+  def __init__(self):
+    self.calls = {}
+    self.lock = threading.Lock()
+    self.num_coalesced = 0
+
+  def Run(self, key, function, *args):
+    with self.lock:
+      call = self.calls.get(key)
+      is_owner = call is None
+      if is_owner:
+        call = self.calls[key] = PendingCall()
+      else:
+        self.num_coalesced += 1
+    if not is_owner:
+      call.done.wait()
+    else:
+      try:
+        call.result = function(*args)
+      except Exception, e:
+        call.error = e
+      finally:
+        with self.lock:
+          del self.calls[key]
+        call.done.set()
+    if call.error is not None:
+      raise call.error
+    return call.result
+
+class LatencyHistogram:
+  """Counts latencies in buckets growing by a factor of two from 1ms."""
+
+  # Upper bounds of the buckets in seconds. Anything slower goes in a last,
+  # unbounded bucket.
+  BOUNDS = [0.001 * 2 ** i for i in xrange(16)]
+
+  def __init__(self):
+    self.counts = [0] * (len(self.BOUNDS) + 1)
+    self.total = 0.0
+    self.maximum = 0.0
+    self.lock = threading.Lock()
+
+  def Add(self, seconds):
+    with self.lock:
+      self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+      self.total += seconds
+      self.maximum = max(self.maximum, seconds)
+
+  def GetPercentile(self, fraction):
+    """Returns the upper bound of the bucket holding the given fraction of
+    latencies, or the maximum for the last bucket."""
+    count = sum(self.counts)
+    if not count:
+      return 0.0
+    rank = int(math.ceil(fraction * count))
+    seen = 0
+    for i, bucket_count in enumerate(self.counts):
+      seen += bucket_count
+      if seen >= rank:
+        if i < len(self.BOUNDS):
+          return min(self.BOUNDS[i], self.maximum)
+        break
+    return self.maximum
+
+  def GetStats(self):
+    with self.lock:
+      count = sum(self.counts)
+      return {
+        'count': count,
+        'mean_ms': count and self.total * 1000 / count or 0.0,
+        'max_ms': self.maximum * 1000,
+        'p50_ms': self.GetPercentile(0.5) * 1000,
+        'p90_ms': self.GetPercentile(0.9) * 1000,
+        'p99_ms': self.GetPercentile(0.99) * 1000,
+        'buckets': dict(('<%gms' % (bound * 1000), bucket_count)
+            for bound, bucket_count in zip(self.BOUNDS + [float('inf')],
+                self.counts) if bucket_count),
+      }
+
+def DecodePair(filename, scale):
+  """Decodes the left and right images of a file at 1/scale of full size."""
+  mpo_file = open(filename, 'rb')
+  try:
+    data = mpo.MapFile(mpo_file)
+    try:
+      parser = mpo.ImageParser(data)
+      info = parser.Parse()
+      mpo.AssertEquals(2, len(info.images), 'Expected stereo image')
+      parallax_x_offset = info.GetParallaxXOffset()
+      if parallax_x_offset is None:
+        parallax_x_offset = estimate_parallax.EstimateParallaxXOffset(parser)
+      left, full_width = pyramid_mpo.DecodeScaled(parser.GetImageData(0),
+          scale)
+      right, _ = pyramid_mpo.DecodeScaled(parser.GetImageData(1), scale)
+    finally:
+      data.close()
+  finally:
+    mpo_file.close()
+  # The decoder may round the size, so scale by the actual width.
+  return DecodedPair(left, right,
+      parallax_x_offset * left.shape[1] / full_width)
+
+def RenderPair(pair, view):
+  """Returns the RGB array of a view of a DecodedPair."""
+  if view == 'left':
+    return pair.left
+  if view == 'right':
+    return pair.right
+  left, right = render_mpo.AlignStereoPair(pair.left, pair.right,
+      pair.parallax_x_offset)
+  return render_mpo.RENDERERS[view](left, right)
+
+def RenderJpeg(pair, view, quality):
+  out = io.BytesIO()
+  Image.fromarray(RenderPair(pair, view)).save(out, 'JPEG', quality=quality)
+  return out.getvalue()
+
+class RenderService:
+  """Renders views of MPO files, sharing decodes between requests.
+
+  Render blocks the calling thread, typically one per HTTP request, while a
+  pool of worker threads does the decoding and compositing.
+  """
+
+  def __init__(self, workers, cache_bytes=DEFAULT_CACHE_BYTES,
+      quality=DEFAULT_QUALITY):
+    self.pool = ThreadPool(max(workers, 1))
+    self.cache = DecodedCache(cache_bytes)
+    self.quality = quality
+    self.decodes = Coalescer()
+    self.renders = Coalescer()
+    self.decode_latency = LatencyHistogram()
+    self.render_latency = LatencyHistogram()
+
+  def GetFileKey(self, filename):
+    # Keyed by size and mtime too, so a rewritten file is decoded again.
+    st = os.stat(filename)
+    return filename, st.st_size, st.st_mtime
+
+  def GetPair(self, file_key, scale):
+    key = file_key + (scale,)
+    pair = self.cache.Get(key)
+    if pair is None:
+      pair = self.decodes.Run(key, self.Decode, key)
+    return pair
+
+  def Decode(self, key):
+    # Checked again as another decode of the key may have finished since the
+    # caller missed.
+    pair = self.cache.Peek(key)
+    if pair is not None:
+      return pair
+    start = time.time()
+    pair = self.pool.apply(DecodePair, (key[0], key[3]))
+    self.decode_latency.Add(time.time() - start)
+    self.cache.Put(key, pair)
+    return pair
+
+  def RenderView(self, file_key, view, scale):
+    pair = self.GetPair(file_key, scale)
+    start = time.time()
+    jpeg = self.pool.apply(RenderJpeg, (pair, view, self.quality))
+    self.render_latency.Add(time.time() - start)
+    return jpeg
+
+  def Render(self, filename, view, scale):
+    """Returns a view of a file at 1/scale of full size as JPEG data."""
+    mpo.Assert(view in VIEWS, 'Unknown view %r' % view)
+    mpo.Assert(scale in SCALES, 'Scale must be one of %s' % (SCALES,))
+    file_key = self.GetFileKey(filename)
+    return self.renders.Run(file_key + (view, scale), self.RenderView,
+        file_key, view, scale)
+
+  def GetStats(self):
+    return {
+      'cache': self.cache.GetStats(),
+      'coalesced_decodes': self.decodes.num_coalesced,
+      'coalesced_renders': self.renders.num_coalesced,
+      'decode_latency': self.decode_latency.GetStats(),
+      'render_latency': self.render_latency.GetStats(),
+    }
+
+  def Close(self):
+    self.pool.close()
+    self.pool.join()
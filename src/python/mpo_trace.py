@@ -0,0 +1,162 @@
+"""Tracing of MPO parsing.
+
+A Tracer receives the parse events of mpo.ImageParser at a chosen level and
+keeps a call count and the time spent in each parse stage. Tracers can be
+merged, so the stats of batch workers add up to one report. A parser without
+a tracer has no instrumented methods and only checks for a tracer where it
+logs, so tracing can be left available in production code at no real cost.
+
+RunProfiled wraps one call in cProfile and memory tracing.
+"""
+
+import time, resource
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING}
+LEVEL_NAMES = dict((level, name) for name, level in LEVELS.iteritems())
+
+# ImageParser methods that are timed, and the stage each is counted under.
+# Times are inclusive, so the APP1 stage includes reading the thumbnail
+# location and extraction includes writing.
+STAGE_METHODS = {
+  'LoadHeader': 'load',
+  'ReadStartOfImage': 'soi',
+  'ReadApp1Section': 'app1',
+  'ReadApp2Section': 'app2',
+  'ReadAppSection': 'app_other',
+  'CheckImageTable': 'image_table',
+  'ReadSegmentIndex': 'segments',
+  'Recover': 'recover',
+  'WriteImage': 'extract',
+  'CopyImage': 'extract',
+}
+
+class TraceEvent:
+  """A parse event. The message is only formatted when asked for."""
+
+  def __init__(self, level, msg, args, offset):
+    self.level = level
+    self.msg = msg
+    self.args = args
+    # File offset the parser was at, where known.
+    self.offset = offset
+
+  def GetMessage(self):
+    if self.args:
+      return self.msg % self.args
+    return self.msg
+
+  def __str__(self):
+    return '%s: %s' % (LEVEL_NAMES.get(self.level, self.level),
+        self.GetMessage())
+
+class Tracer:
+  """Collects parse events, counters and per stage timers."""
+
+  def __init__(self, level=WARNING):
+    self.level = level
+    self.listeners = []
+    # name -> count, and stage -> total seconds.
+    self.counts = {}
+    self.seconds = {}
+
+  def AddListener(self, listener):
+    """Calls listener(TraceEvent) for every event at or above self.level."""
+    self.listeners.append(listener)
+
+  def Event(self, level, msg, args=(), offset=None):
+    if level < self.level:
+      return
+    self.Count(LEVEL_NAMES.get(level, 'level%d' % level) + '_events')
+    if self.listeners:
+      event = TraceEvent(level, msg, args, offset)
+      for listener in self.listeners:
+        listener(event)
+
+  def Count(self, name, n=1):
+    self.counts[name] = self.counts.get(name, 0) + n
+
+  def AddTime(self, stage, seconds):
+    self.counts[stage] = self.counts.get(stage, 0) + 1
+    self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+  def Instrument(self, parser):
+    """Times the stage methods of one parser.
+
+    Each method is shadowed by a timed wrapper on the instance, so other
+    parsers are unaffected.
+    """
+    for method_name, stage in STAGE_METHODS.iteritems():
+      method = getattr(parser, method_name, None)
+      if method is not None:
+        setattr(parser, method_name, self.TimeCalls(stage, method))
+
+  def TimeCalls(self, stage, function):
+    def Timed(*args, **kwargs):
+      start = time.time()
+      try:
+        return function(*args, **kwargs)
+      finally:
+        self.AddTime(stage, time.time() - start)
+    return Timed
+
+  def GetStats(self):
+    return {'counts': dict(self.counts), 'seconds': dict(self.seconds)}
+
+  def Merge(self, stats):
+    """Adds the result of another tracer's GetStats."""
+    for name, n in stats['counts'].iteritems():
+      self.Count(name, n)
+    for stage, seconds in stats['seconds'].iteritems():
+      self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+  def FormatStats(self):
+    """Returns report lines, stages first, slowest first."""
+    lines = []
+    for stage, seconds in sorted(self.seconds.iteritems(),
+        key=lambda item: -item[1]):
+      calls = self.counts.get(stage, 0)
+      lines.append('%-14s %8d calls %10.2f ms %8.1f us/call' % (stage, calls,
+          seconds * 1000, seconds * 1e6 / max(calls, 1)))
+    for name, n in sorted(self.counts.iteritems()):
+      if name not in self.seconds:
+        lines.append('%-14s %8d' % (name, n))
+    return lines
+
+def RunProfiled(function, args=(), profile_filename=None,
+    trace_memory=False):
+  """Calls function(*args) and returns its result and a stats dict.
+
+  With profile_filename the call runs under cProfile and the profile is
+  dumped there for pstats. With trace_memory the stats hold the peak memory
+  of the call in KB. That comes from tracemalloc where it exists; Python 2
+  has no tracemalloc, so the peak RSS of the process is reported instead.
+  """
+  stats = {}
+  tracemalloc = None
+  if trace_memory:
+    try:
+      import tracemalloc
+      tracemalloc.start()
+    except ImportError:
+      tracemalloc = None
+  profile = None
+  if profile_filename:
+    import cProfile
+    profile = cProfile.Profile()
+    profile.enable()
+  try:
+    result = function(*args)
+  finally:
+    if profile is not None:
+      profile.disable()
+      profile.dump_stats(profile_filename)
+    if tracemalloc is not None:
+      stats['peak_memory_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+      tracemalloc.stop()
+    elif trace_memory:
+      stats['peak_rss_kb'] = resource.getrusage(
+          resource.RUSAGE_SELF).ru_maxrss
+  return result, stats
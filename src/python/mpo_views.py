@@ -0,0 +1,11 @@
+"""The views and scales serve_mpo.py renders.
+
+Kept apart from mpo_service.py, which needs NumPy and PIL, so that clients
+such as load_test_mpo.py can check their requests without them.
+"""
+
+# The render_mpo.py modes, checked against its RENDERERS by mpo_service.py.
+RENDER_MODES = ('anaglyph', 'cross', 'interlaced', 'parallel')
+VIEWS = ('left', 'right') + RENDER_MODES
+# Reduced scales the JPEG decoder can decode at directly.
+SCALES = (1, 2, 4, 8)
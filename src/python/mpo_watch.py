@@ -0,0 +1,234 @@
+"""Finding new and changed MPO files under directory trees.
+
+WatchState records the size and mtime of every file that has been processed
+in a SQLite file, and is held in memory as a dict so that a rescan costs one
+lstat per directory entry. InotifyWatcher reports the files written or moved
+into watched directories as they appear. Python 2 has no inotify module, so
+it calls libc through ctypes; PollingWatcher rescans on a timer where that
+is not available.
+"""
+
+import os, stat, time, errno, select, struct, sqlite3
+
+MPO_EXTENSIONS = ('.mpo',)
+
+class WatchState:
+  """The (size, mtime) of each processed file, keyed by absolute path."""
+
+  def __init__(self, db_filename):
+    self.db = sqlite3.connect(db_filename)
+    self.db.execute('CREATE TABLE IF NOT EXISTS processed ('
+        'path TEXT PRIMARY KEY, size INTEGER, mtime REAL)')
+    self.entries = dict((path, (size, mtime)) for path, size, mtime
+        in self.db.execute('SELECT path, size, mtime FROM processed'))
+
+  def IsProcessed(self, path, size, mtime):
+    return self.entries.get(path) == (size, mtime)
+
+  def Put(self, path, size, mtime):
+    self.entries[path] = (size, mtime)
+    self.db.execute('INSERT OR REPLACE INTO processed (path, size, mtime) '
+        'VALUES (?, ?, ?)', (path, size, mtime))
+
+  def DeleteMissing(self, root, seen_paths):
+    """Forgets files under root that are not in seen_paths, so that they are
+    processed again if they come back. Returns the number forgotten."""
+    prefix = os.path.join(root, '')
+    missing = [path for path in self.entries
+        if path.startswith(prefix) and path not in seen_paths]
+    for path in missing:
+      del self.entries[path]
+      self.db.execute('DELETE FROM processed WHERE path = ?', (path,))
+    return len(missing)
+
+  def Commit(self):
+    self.db.commit()
+
+  def Close(self):
+    self.db.commit()
+    self.db.close()
+
+def IsMpoName(name):
+  return os.path.splitext(name)[1].lower() in MPO_EXTENSIONS
+
+def ScanTree(path):
+  """Yields (path, size, mtime) for the MPO files at or under path.
+
+  Each entry is lstat'ed once, rather than the stat per entry that os.walk
+  makes on top of the one needed for the size. Symlinks are not followed.
+  """
+  try:
+    st = os.lstat(path)
+  except OSError:
+    return
+  if stat.S_ISREG(st.st_mode):
+    if IsMpoName(path):
+      yield path, st.st_size, st.st_mtime
+    return
+  if not stat.S_ISDIR(st.st_mode):
+    return
+  pending_dirs = [path]
+  while pending_dirs:
+    dirname = pending_dirs.pop()
+    try:
+      names = os.listdir(dirname)
+    except OSError:
+      continue
+    names.sort(reverse=True)
+    for name in names:
+      child = os.path.join(dirname, name)
+      try:
+        st = os.lstat(child)
+      except OSError:
+        continue
+      if stat.S_ISDIR(st.st_mode):
+        pending_dirs.append(child)
+      elif stat.S_ISREG(st.st_mode) and IsMpoName(name):
+        yield child, st.st_size, st.st_mtime
+
+class PollingWatcher:
+  """Asks for a full rescan every interval seconds."""
+
+  def __init__(self, interval):
+    self.interval = interval
+    self.next_scan_time = time.time() + interval
+
+  def AddTree(self, root):
+    pass
+
+  def Wait(self, timeout):
+    """Returns the paths that may have changed, or None to rescan all."""
+    delay = self.next_scan_time - time.time()
+    if delay > timeout:
+      time.sleep(timeout)
+      return []
+    time.sleep(max(delay, 0))
+    self.next_scan_time = time.time() + self.interval
+    return None
+
+  def Close(self):
+    pass
+
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+INOTIFY_EVENT_STRUCT = struct.Struct('iIII')
+# Files are reported once they are closed after writing or moved in, so a
+# partly uploaded file is not picked up. New directories get their own watch.
+INOTIFY_MASK = (IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+    | IN_MOVE_SELF | IN_ONLYDIR)
+INOTIFY_READ_SIZE = 1 << 16
+
+class InotifyWatcher:
+  """Watches directory trees with inotify through ctypes.
+
+  Raises OSError from the constructor where inotify is unavailable.
+  """
+
+  def __init__(self):
+    import ctypes, ctypes.util
+    libc_name = ctypes.util.find_library('c')
+    if not libc_name:
+      raise OSError(errno.ENOSYS, 'libc not found')
+    self.libc = ctypes.CDLL(libc_name, use_errno=True)
+    if not hasattr(self.libc, 'inotify_init1'):
+      raise OSError(errno.ENOSYS, 'inotify is not available')
+    self.fd = self.libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+    if self.fd < 0:
+      error = ctypes.get_errno()
+      raise OSError(error, os.strerror(error))
+    self.ctypes = ctypes
+    # Watch descriptor -> directory.
+    self.watched_dirs = {}
+
+  def AddWatch(self, dirname):
+    wd = self.libc.inotify_add_watch(self.fd, dirname, INOTIFY_MASK)
+    if wd < 0:
+      error = self.ctypes.get_errno()
+      if error == errno.ENOSPC:
+        raise OSError(error, 'Out of inotify watches, raise '
+            'fs.inotify.max_user_watches or use polling')
+      # The directory went away before it could be watched.
+      return
+    self.watched_dirs[wd] = dirname
+
+  def AddTree(self, root):
+    """Watches root and every directory under it."""
+    pending_dirs = [root]
+    while pending_dirs:
+      dirname = pending_dirs.pop()
+      self.AddWatch(dirname)
+      try:
+        names = os.listdir(dirname)
+      except OSError:
+        continue
+      for name in names:
+        child = os.path.join(dirname, name)
+        try:
+          if stat.S_ISDIR(os.lstat(child).st_mode):
+            pending_dirs.append(child)
+        except OSError:
+          pass
+
+  def Wait(self, timeout):
+    """Returns the paths that may have changed, or None to rescan all.
+
+    New directories are returned as well, as files may have been written to
+    them before their watch was added.
+    """
+    readable, _, _ = select.select([self.fd], [], [], timeout)
+    if not readable:
+      return []
+    paths = []
+    while True:
+      try:
+        data = os.read(self.fd, INOTIFY_READ_SIZE)
+      except OSError, e:
+        if e.errno == errno.EAGAIN:
+          break
+        raise
+      offset = 0
+      while offset < len(data):
+        wd, mask, cookie, name_length = INOTIFY_EVENT_STRUCT.unpack_from(
+            data, offset)
+        offset += INOTIFY_EVENT_STRUCT.size
+        name = data[offset:offset + name_length].rstrip('\0')
+        offset += name_length
+        if mask & IN_Q_OVERFLOW:
+          # Events were dropped, so only a rescan can tell what changed.
+          return None
+        if mask & IN_IGNORED:
+          self.watched_dirs.pop(wd, None)
+          continue
+        dirname = self.watched_dirs.get(wd)
+        if dirname is None or not name:
+          continue
+        path = os.path.join(dirname, name)
+        if mask & IN_ISDIR:
+          if mask & (IN_CREATE | IN_MOVED_TO):
+            self.AddTree(path)
+            paths.append(path)
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and IsMpoName(name):
+          paths.append(path)
+    return paths
+
+  def Close(self):
+    os.close(self.fd)
+
+def CreateWatcher(poll_interval, use_polling=False):
+  """Returns an InotifyWatcher, or a PollingWatcher if inotify cannot be
+  used or use_polling is set."""
+  if not use_polling:
+    try:
+      return InotifyWatcher()
+    except (OSError, AttributeError):
+      pass
+  return PollingWatcher(poll_interval)
@@ -0,0 +1,296 @@
+"""Writing of MPO files from JPEGs: stereo pairs or any number of views.
+
+MpoWriter is the inverse of mpo.ImageParser. Only the APP segments of each
+source are held in memory. The entropy coded data is streamed through a fixed
+size buffer, and every offset in the MP Entry table is worked out from the
+source sizes before anything is written.
+"""
+
+import os, struct
+
+import mpo
+
+# MP Index IFD and MP Attribute IFD tags.
+MP_VERSION_TAG = 45056
+MP_NUMBER_OF_IMAGES_TAG = 45057
+MP_ENTRY_TAG = 45058
+MP_INDIVIDUAL_NUM_TAG = 45313
+MP_BASE_VIEWPOINT_NUM_TAG = 45572
+
+EXIF_IFD_POINTER_TAG = 34665
+EXIF_MAKERNOTE_TAG = 37500
+FUJIFILM_PARALLAX_TAG = 45585
+
+TIFF_TYPE_LONG = 4
+TIFF_TYPE_UNDEFINED = 7
+TIFF_TYPE_SRATIONAL = 10
+
+REPRESENTATIVE_IMAGE_FLAG = 1 << 29
+
+# The MPF segments written here are little endian, as Fujifilm's are.
+IFD_ROW_STRUCT = struct.Struct('<HHI')
+IFD_COUNT_STRUCT = struct.Struct('<H')
+INT_STRUCT = struct.Struct('<I')
+SRATIONAL_STRUCT = struct.Struct('<ii')
+MP_ENTRY_STRUCT = struct.Struct('<IIIHH')
+SEGMENT_HEADER_STRUCT = struct.Struct('>HH')
+# Marker, length and 'MPF\0' come before the MP endian marker.
+MP_ENDIAN_MARKER_OFFSET = 8
+MAX_SEGMENT_LENGTH = 0xffff
+
+def EncodeIfd(rows, next_ifd_offset):
+  """Encodes (tag id, type, count, 4 byte value) rows as an IFD."""
+  parts = [IFD_COUNT_STRUCT.pack(len(rows))]
+  for tag_id, tag_type, count, value in rows:
+    parts.append(IFD_ROW_STRUCT.pack(tag_id, tag_type, count) + value)
+  parts.append(INT_STRUCT.pack(next_ifd_offset))
+  return ''.join(parts)
+
+def GetIfdSize(num_rows):
+  return 2 + mpo.IFD_ROW_SIZE * num_rows + 4
+
+def EncodeAppSegment(marker, payload, min_length=0):
+  """Encodes an APP segment, zero padded to at least min_length bytes."""
+  length = max(len(payload) + 2, min_length - 2)
+  payload += '\0' * (length - 2 - len(payload))
+  mpo.Assert(length <= MAX_SEGMENT_LENGTH, 'APP segment too long')
+  return SEGMENT_HEADER_STRUCT.pack(marker, length) + payload
+
+def EncodeFujifilmExif(parallax):
+  """Returns an Exif APP1 segment holding only a Fujifilm parallax.
+
+  The layout is IFD0, the Exif IFD and then the makernote, which is what
+  ImageParser.ReadApp1Section expects.
+  """
+  exif_ifd_offset = 8 + GetIfdSize(1)
+  makernote_offset = exif_ifd_offset + GetIfdSize(1)
+  # Offsets within the makernote are relative to its start.
+  maker_ifd_offset = len(mpo.FUJIFILM_MAKERNOTE_IDENTIFIER) + 4
+  parallax_offset = maker_ifd_offset + GetIfdSize(1)
+  makernote = ''.join([
+    mpo.FUJIFILM_MAKERNOTE_IDENTIFIER,
+    INT_STRUCT.pack(maker_ifd_offset),
+    EncodeIfd([(FUJIFILM_PARALLAX_TAG, TIFF_TYPE_SRATIONAL, 1,
+        INT_STRUCT.pack(parallax_offset))], 0),
+    SRATIONAL_STRUCT.pack(*parallax),
+  ])
+  return EncodeAppSegment(mpo.APP1_MARKER, ''.join([
+    mpo.EXIF_FORMAT_IDENTIFIER,
+    mpo.LITTLE_ENDIAN_TAG,
+    INT_STRUCT.pack(8),
+    EncodeIfd([(EXIF_IFD_POINTER_TAG, TIFF_TYPE_LONG, 1,
+        INT_STRUCT.pack(exif_ifd_offset))], 0),
+    EncodeIfd([(EXIF_MAKERNOTE_TAG, TIFF_TYPE_UNDEFINED, len(makernote),
+        INT_STRUCT.pack(makernote_offset))], 0),
+    makernote,
+  ]))
+
+class SourceJpeg:
+  """The APP segments of a source JPEG and where its remaining data starts.
+
+  Any MPF segment is dropped, since the writer replaces it.
+  """
+
+  def __init__(self, jpeg_file, log=None):
+    self.jpeg_file = jpeg_file
+    jpeg_file.seek(0, os.SEEK_END)
+    self.file_size = jpeg_file.tell()
+    parser = mpo.ImageParser(log=log)
+    parser.LoadHeader(jpeg_file, 0)
+    parser.ReadImageHeader(0)
+    self.image = parser.images[0]
+    self.header = bytearray(parser.data)
+    # (start, end) of each APP segment to copy, as offsets into header.
+    self.segments = []
+    self.mpf_segment_length = 0
+    offset = 2
+    while offset + 4 <= len(self.header):
+      marker, length = SEGMENT_HEADER_STRUCT.unpack_from(self.header, offset)
+      if not mpo.IsAppMarker(marker):
+        break
+      end = offset + 2 + length
+      if (marker == mpo.APP2_MARKER and self.header[offset + 4:offset + 8]
+          == mpo.MP_FORMAT_IDENTIFIER):
+        self.mpf_segment_length = end - offset
+      else:
+        self.segments.append((offset, end))
+      offset = end
+    # Everything from the first non APP marker on is streamed.
+    self.body_offset = offset
+
+  def GetSegmentsSize(self):
+    return sum(end - start for start, end in self.segments)
+
+  def GetBodySize(self):
+    return self.file_size - self.body_offset
+
+  def HasExif(self):
+    for start, end in self.segments:
+      marker = SEGMENT_HEADER_STRUCT.unpack_from(self.header, start)[0]
+      if (marker == mpo.APP1_MARKER and self.header[start + 4:start + 10]
+          == mpo.EXIF_FORMAT_IDENTIFIER):
+        return True
+    return False
+
+  def SetParallax(self, parallax):
+    """Overwrites the Fujifilm parallax in the Exif makernote.
+
+    Returns False if the source has no parallax value to overwrite.
+    """
+    if self.image.parallax_offset is None:
+      return False
+    SRATIONAL_STRUCT.pack_into(self.header, self.image.parallax_offset,
+        *parallax)
+    return True
+
+class MpoWriter:
+  """Writes a stereo MPO from a left and a right JPEG, or an MPO of any
+  number of JPEGs.
+
+  The MPF APP2 segment goes after each image's other APP segments, where
+  Fujifilm cameras put it. If a source already had an MPF segment, the new
+  one is padded to the same length. A parsed MPO whose images are written
+  back out therefore keeps its layout and offsets.
+  """
+
+  def __init__(self, log=None):
+    self.log = log
+
+  def EncodeAttributeRows(self, type_code, i):
+    """Returns the MP Attribute IFD rows of image i."""
+    rows = [(MP_INDIVIDUAL_NUM_TAG, TIFF_TYPE_LONG, 1, INT_STRUCT.pack(i + 1))]
+    if type_code in (mpo.MP_TYPE_CODE_DISPARITY,
+        mpo.MP_TYPE_CODE_MULTI_ANGLE):
+      rows.append((MP_BASE_VIEWPOINT_NUM_TAG, TIFF_TYPE_LONG, 1,
+          INT_STRUCT.pack(1)))
+    return rows
+
+  def EncodeMpfSegments(self, sources, type_code, image_sizes=None):
+    """Returns the MPF APP2 segment of each image.
+
+    Without image_sizes the MP Entry table is left zeroed, which is enough to
+    measure the segments.
+    """
+    num_images = len(sources)
+    # First image: the MP Index IFD, the MP Entry table and then the MP
+    # Attribute IFD, as ImageParser.ReadApp2Section expects.
+    index_ifd_rows = 3
+    mp_entry_offset = 8 + GetIfdSize(index_ifd_rows)
+    attribute_ifd_offset = mp_entry_offset + MP_ENTRY_STRUCT.size * num_images
+    mp_endian_offset = (2 + sources[0].GetSegmentsSize()
+        + MP_ENDIAN_MARKER_OFFSET)
+    entries = []
+    image_offset = 0
+    for i in xrange(num_images):
+      if image_sizes is None:
+        entries.append('\0' * MP_ENTRY_STRUCT.size)
+        continue
+      attributes = mpo.MP_IMAGE_DATA_FORMAT_JPEG << 24 | type_code
+      data_offset = 0
+      if i == 0:
+        attributes |= REPRESENTATIVE_IMAGE_FLAG
+      else:
+        data_offset = image_offset - mp_endian_offset
+      entries.append(MP_ENTRY_STRUCT.pack(attributes, image_sizes[i],
+          data_offset, 0, 0))
+      image_offset += image_sizes[i]
+    payloads = [''.join([
+      mpo.MP_FORMAT_IDENTIFIER,
+      mpo.LITTLE_ENDIAN_TAG,
+      INT_STRUCT.pack(8),
+      EncodeIfd([
+        (MP_VERSION_TAG, TIFF_TYPE_UNDEFINED, 4, mpo.MP_VERSION),
+        (MP_NUMBER_OF_IMAGES_TAG, TIFF_TYPE_LONG, 1,
+            INT_STRUCT.pack(num_images)),
+        (MP_ENTRY_TAG, TIFF_TYPE_UNDEFINED, MP_ENTRY_STRUCT.size * num_images,
+            INT_STRUCT.pack(mp_entry_offset)),
+      ], attribute_ifd_offset),
+      ''.join(entries),
+      EncodeIfd(self.EncodeAttributeRows(type_code, 0), 0),
+    ])]
+    for i in xrange(1, num_images):
+      payloads.append(''.join([
+        mpo.MP_FORMAT_IDENTIFIER,
+        mpo.LITTLE_ENDIAN_TAG,
+        INT_STRUCT.pack(8),
+        EncodeIfd([(MP_VERSION_TAG, TIFF_TYPE_UNDEFINED, 4, mpo.MP_VERSION)]
+            + self.EncodeAttributeRows(type_code, i), 0),
+      ]))
+    return [EncodeAppSegment(mpo.APP2_MARKER, payload,
+        source.mpf_segment_length) for source, payload
+        in zip(sources, payloads)]
+
+  def Write(self, left_file, right_file, out_file, parallax=None,
+      chunk_size=mpo.COPY_CHUNK_SIZE):
+    """Writes an MPO of two open JPEG files to out_file.
+
+    parallax is an optional Fujifilm (numerator, denominator) SRational for
+    the right image. It replaces an existing makernote value, or is written
+    in a new Exif segment if the right image has no Exif.
+    """
+    sources = [SourceJpeg(jpeg_file, self.log)
+        for jpeg_file in (left_file, right_file)]
+    prefixes = ['', '']
+    if parallax is not None and not sources[1].SetParallax(parallax):
+      mpo.Assert(not sources[1].HasExif(), 'Cannot add a parallax to an Exif '
+          'segment without a Fujifilm makernote')
+      prefixes[1] = EncodeFujifilmExif(parallax)
+    return self.WriteSources(sources, prefixes, out_file,
+        mpo.MP_TYPE_CODE_DISPARITY, chunk_size)
+
+  def WriteImages(self, jpeg_files, out_file,
+      type_code=mpo.MP_TYPE_CODE_MULTI_ANGLE, chunk_size=mpo.COPY_CHUNK_SIZE):
+    """Writes an MPO of any number of open JPEG files to out_file, with
+    every MP Entry of type_code."""
+    sources = [SourceJpeg(jpeg_file, self.log) for jpeg_file in jpeg_files]
+    return self.WriteSources(sources, [''] * len(sources), out_file,
+        type_code, chunk_size)
+
+  def WriteSources(self, sources, prefixes, out_file, type_code, chunk_size):
+    # The MPF segments have a fixed size, so encode them once without the
+    # MP Entry table to measure each image.
+    mpf_lengths = [len(segment) for segment
+        in self.EncodeMpfSegments(sources, type_code)]
+    image_sizes = [2 + len(prefix) + source.GetSegmentsSize() + mpf_length
+        + source.GetBodySize() for source, prefix, mpf_length
+        in zip(sources, prefixes, mpf_lengths)]
+    mpf_segments = self.EncodeMpfSegments(sources, type_code, image_sizes)
+    for source, prefix, mpf_segment in zip(sources, prefixes, mpf_segments):
+      out_file.write(source.header[:2])
+      out_file.write(prefix)
+      for start, end in source.segments:
+        out_file.write(buffer(source.header, start, end - start))
+      out_file.write(mpf_segment)
+      self.CopyBody(source, out_file, chunk_size)
+    return image_sizes
+
+  def CopyBody(self, source, out_file, chunk_size):
+    source.jpeg_file.seek(source.body_offset)
+    chunk = bytearray(chunk_size)
+    chunk_view = memoryview(chunk)
+    remaining = source.GetBodySize()
+    while remaining > 0:
+      num_read = source.jpeg_file.readinto(
+          chunk_view[:min(chunk_size, remaining)])
+      if not num_read:
+        raise Exception('Source truncated with %d bytes remaining'
+            % remaining)
+      out_file.write(chunk_view[:num_read])
+      remaining -= num_read
+
+def WriteMpo(left_filename, right_filename, output_filename, parallax=None,
+    log=None):
+  """Packs two JPEG files into a stereo MPO file. Returns the image sizes."""
+  left_file = open(left_filename, 'rb')
+  try:
+    right_file = open(right_filename, 'rb')
+    try:
+      out_file = open(output_filename, 'wb')
+      try:
+        return MpoWriter(log).Write(left_file, right_file, out_file, parallax)
+      finally:
+        out_file.close()
+    finally:
+      right_file.close()
+  finally:
+    left_file.close()
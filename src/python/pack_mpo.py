@@ -0,0 +1,41 @@
+#!/usr/bin/python
+
+"""Packs a left and a right JPEG into a stereo MPO file.
+
+The JPEGs are copied into the output as they are, with a new MPF segment in
+each, so no image data is decoded or recompressed.
+"""
+
+import sys, time, optparse
+
+import mpo, mpo_writer
+
+def ParseParallax(value):
+  """Parses a Fujifilm parallax given as N or N/D."""
+  numer, _, denom = value.partition('/')
+  return int(numer), int(denom or 1)
+
+def Main(argv):
+  option_parser = optparse.OptionParser(
+      usage='%prog [options] <left.jpg> <right.jpg> <output.mpo>')
+  option_parser.add_option('-p', '--parallax',
+      help='Fujifilm parallax of the right image as N or N/D, so that the '
+          'viewer shifts it by N/D * %d pixels'
+          % mpo.FUJIFILM_PARALLAX_TO_PIXELS_RATIO)
+  options, args = option_parser.parse_args(argv)
+  if len(args) != 3:
+    option_parser.error('Expected two JPEG files and an output file')
+  parallax = None
+  if options.parallax is not None:
+    try:
+      parallax = ParseParallax(options.parallax)
+    except ValueError:
+      option_parser.error('Invalid --parallax %r' % options.parallax)
+
+  start = time.time()
+  image_sizes = mpo_writer.WriteMpo(args[0], args[1], args[2], parallax)
+  print 'Wrote %s, %d + %d bytes, in %.1f ms' % (args[2], image_sizes[0],
+      image_sizes[1], (time.time() - start) * 1000)
+
+if __name__ == '__main__':
+  Main(sys.argv[1:])
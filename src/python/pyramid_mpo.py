@@ -0,0 +1,166 @@
+#!/usr/bin/python
+
+"""Writes 1/2, 1/4 and 1/8 scale previews of MPO stereo pairs.
+
+For every level the left and right images are decoded straight from the
+compressed data at reduced scale using the JPEG decoder's DCT scaling, so no
+level needs a full size decode. An anaglyph is rendered at each level as in
+render_mpo.py. Files whose outputs are newer than the input are skipped.
+Requires NumPy and PIL.
+"""
+
+import sys, os, io, time, multiprocessing, optparse
+
+import numpy
+from PIL import Image, JpegImagePlugin
+
+import mpo, batch_parse_mpo, render_mpo, estimate_parallax
+
+DEFAULT_SCALES = (2, 4, 8)
+DEFAULT_QUALITY = 85
+VIEWS = ('left', 'right', 'anaglyph')
+
+def DecodeScaled(image_data, scale):
+  """Decodes JPEG data into an RGB array at roughly 1/scale of full size.
+
+  Returns the array and the full size width.
+  """
+  image = JpegImagePlugin.JpegImageFile(io.BytesIO(image_data))
+  full_width, full_height = image.size
+  image.draft('RGB', (full_width // scale, full_height // scale))
+  if image.mode != 'RGB':
+    image = image.convert('RGB')
+  return numpy.asarray(image), full_width
+
+def SaveImage(array, output_filename, quality):
+  Image.fromarray(array).save(output_filename, quality=quality)
+
+def GetOutputFilename(filename, output_dir, view, scale):
+  name = os.path.splitext(os.path.basename(filename))[0]
+  return os.path.join(output_dir or os.path.dirname(filename),
+      '%s.%s.%d.jpg' % (name, view, scale))
+
+def GetOutputFilenames(filename, output_dir, scales):
+  return [GetOutputFilename(filename, output_dir, view, scale)
+      for scale in scales for view in VIEWS]
+
+def IsUpToDate(filename, output_filenames):
+  input_mtime = os.path.getmtime(filename)
+  for output_filename in output_filenames:
+    try:
+      if os.path.getmtime(output_filename) < input_mtime:
+        return False
+    except OSError:
+      return False
+  return True
+
+def WritePyramid(filename, output_dir, scales, quality=DEFAULT_QUALITY):
+  """Writes every level for one MPO file and returns seconds per scale."""
+  timings = {}
+  mpo_file = open(filename, 'rb')
+  try:
+    data = mpo.MapFile(mpo_file)
+    try:
+      parser = mpo.ImageParser(data)
+      info = parser.Parse()
+      mpo.AssertEquals(2, len(info.images), 'Expected stereo image')
+      parallax_x_offset = info.GetParallaxXOffset()
+      if parallax_x_offset is None:
+        parallax_x_offset = estimate_parallax.EstimateParallaxXOffset(parser)
+      for scale in scales:
+        start = time.time()
+        left, full_width = DecodeScaled(parser.GetImageData(0), scale)
+        right, _ = DecodeScaled(parser.GetImageData(1), scale)
+        SaveImage(left, GetOutputFilename(filename, output_dir, 'left',
+            scale), quality)
+        SaveImage(right, GetOutputFilename(filename, output_dir, 'right',
+            scale), quality)
+        # The decoder may round the size, so scale by the actual width.
+        aligned_left, aligned_right = render_mpo.AlignStereoPair(left, right,
+            parallax_x_offset * left.shape[1] / full_width)
+        SaveImage(render_mpo.RenderAnaglyph(aligned_left, aligned_right),
+            GetOutputFilename(filename, output_dir, 'anaglyph', scale),
+            quality)
+        timings[scale] = time.time() - start
+    finally:
+      data.close()
+  finally:
+    mpo_file.close()
+  return timings
+
+def WriteOne(args):
+  filename, output_dir, scales, quality = args
+  try:
+    return filename, WritePyramid(filename, output_dir, scales, quality), None
+  except Exception, e:
+    return filename, None, '%s: %s' % (e.__class__.__name__, e)
+
+def Main(argv):
+  option_parser = optparse.OptionParser(
+      usage='%prog [options] <dir-or-glob>...')
+  option_parser.add_option('-d', '--output-dir',
+      help='Directory for previews [default: next to each input]')
+  option_parser.add_option('-s', '--scales',
+      default=','.join(str(scale) for scale in DEFAULT_SCALES),
+      help='Comma separated downscale factors, each 1, 2, 4 or 8 '
+          '[default: %default]')
+  option_parser.add_option('-q', '--quality', type='int',
+      default=DEFAULT_QUALITY, help='JPEG quality [default: %default]')
+  option_parser.add_option('-j', '--jobs', type='int',
+      default=multiprocessing.cpu_count(),
+      help='Number of worker processes [default: %default]')
+  option_parser.add_option('-f', '--force', action='store_true',
+      default=False, help='Rewrite previews that are newer than their input')
+  options, args = option_parser.parse_args(argv)
+  if not args:
+    option_parser.error('Expected at least one directory or glob')
+  try:
+    scales = [int(scale) for scale in options.scales.split(',')]
+  except ValueError:
+    option_parser.error('Invalid --scales %r' % options.scales)
+  for scale in scales:
+    if scale not in (1, 2, 4, 8):
+      option_parser.error('JPEG decoders can only scale by 1, 2, 4 or 8')
+
+  filenames = batch_parse_mpo.FindMpoFiles(args)
+  tasks = []
+  num_skipped = 0
+  for filename in filenames:
+    if not options.force and IsUpToDate(filename, GetOutputFilenames(
+        filename, options.output_dir, scales)):
+      num_skipped += 1
+    else:
+      tasks.append((filename, options.output_dir, scales, options.quality))
+
+  start = time.time()
+  total_timings = dict((scale, 0.0) for scale in scales)
+  num_written = 0
+  num_failed = 0
+  pool = multiprocessing.Pool(max(options.jobs, 1))
+  try:
+    for filename, timings, error in pool.imap_unordered(WriteOne, tasks):
+      if error:
+        num_failed += 1
+        print '%s: %s' % (filename, error)
+        continue
+      num_written += 1
+      for scale, seconds in timings.iteritems():
+        total_timings[scale] += seconds
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+  elapsed = max(time.time() - start, 1e-6)
+
+  print 'Wrote %d files (%d skipped, %d failed) in %.2fs' % (num_written,
+      num_skipped, num_failed, elapsed)
+  for scale in scales:
+    # Worker time, so this is the CPU cost of a level rather than wall time.
+    print '  1/%d: %.1f ms per file' % (scale,
+        total_timings[scale] * 1000 / max(num_written, 1))
+  return num_failed and 1 or 0
+
+if __name__ == '__main__':
+  sys.exit(Main(sys.argv[1:]))
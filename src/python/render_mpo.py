@@ -0,0 +1,154 @@
+#!/usr/bin/python
+
+"""Renders MPO stereo pairs as anaglyph, side by side or interlaced images.
+
+Compositing works on whole NumPy channels, mirroring the canvas code in
+display/threedanaglyph.js and encoder/webp.js. Requires NumPy and PIL.
+"""
+
+import sys, os, io, math, multiprocessing, optparse
+
+import numpy
+from PIL import Image, JpegImagePlugin
+
+import mpo, estimate_parallax
+
+DEFAULT_QUALITY = 90
+
+def DecodeImage(image_data):
+  """Decodes JPEG data into an RGB array of shape (height, width, 3)."""
+  # Open as a plain JPEG; the sub-images carry MPF headers that would
+  # otherwise make PIL treat each of them as a whole MPO.
+  image = JpegImagePlugin.JpegImageFile(io.BytesIO(image_data))
+  if image.mode != 'RGB':
+    image = image.convert('RGB')
+  return numpy.asarray(image)
+
+def LoadStereoPair(filename):
+  """Returns the decoded left and right images and the parallax x offset.
+
+  The offset is estimated from the images when there is no makernote value.
+  """
+  mpo_file = open(filename, 'rb')
+  try:
+    data = mpo.MapFile(mpo_file)
+    try:
+      parser = mpo.ImageParser(data)
+      info = parser.Parse()
+      mpo.AssertEquals(2, len(info.images), 'Expected stereo image')
+      parallax_x_offset = info.GetParallaxXOffset()
+      if parallax_x_offset is None:
+        parallax_x_offset = estimate_parallax.EstimateParallaxXOffset(parser)
+      left = DecodeImage(parser.GetImageData(0))
+      right = DecodeImage(parser.GetImageData(1))
+    finally:
+      data.close()
+  finally:
+    mpo_file.close()
+  return left, right, parallax_x_offset
+
+def AlignStereoPair(left, right, parallax_x_offset):
+  """Crops both images to the region they share once parallax is applied.
+
+  Matches drawCanvasFor3dSideBySide_ in encoder/webp.js. The results are
+  views into the inputs.
+  """
+  mpo.AssertEquals(left.shape, right.shape, 'Expected images of equal size')
+  width = left.shape[1]
+  x_offset = int(math.floor(abs(parallax_x_offset)))
+  mpo.Assert(x_offset < width, 'Parallax offset %d exceeds image width %d'
+      % (x_offset, width))
+  if parallax_x_offset > 0:
+    return left[:, x_offset:], right[:, :width - x_offset]
+  elif parallax_x_offset < 0:
+    return left[:, :width - x_offset], right[:, x_offset:]
+  return left, right
+
+def RenderAnaglyph(left, right):
+  # Red/cyan as in ThreeDAnaglyph.createAnaglyph_:
+  # r = 0.7 * g1 + 0.3 * b1, g = g2, b = b2.
+  red = left[..., 1].astype(numpy.uint16)
+  red *= 7
+  blue = left[..., 2].astype(numpy.uint16)
+  blue *= 3
+  red += blue
+  red //= 10
+  result = right.copy()
+  result[..., 0] = red
+  return result
+
+def RenderParallel(left, right):
+  return numpy.hstack((left, right))
+
+def RenderCrossEye(left, right):
+  return numpy.hstack((right, left))
+
+def RenderInterlaced(left, right):
+  # Even rows from the left image and odd rows from the right.
+  result = left.copy()
+  result[1::2] = right[1::2]
+  return result
+
+RENDERERS = {
+  'anaglyph': RenderAnaglyph,
+  'parallel': RenderParallel,
+  'cross': RenderCrossEye,
+  'interlaced': RenderInterlaced,
+}
+
+def RenderFile(filename, mode, output_filename, quality=DEFAULT_QUALITY):
+  left, right, parallax_x_offset = LoadStereoPair(filename)
+  left, right = AlignStereoPair(left, right, parallax_x_offset)
+  result = RENDERERS[mode](left, right)
+  Image.fromarray(result).save(output_filename, quality=quality)
+
+def RenderOne(args):
+  filename, mode, output_filename, quality = args
+  try:
+    RenderFile(filename, mode, output_filename, quality)
+  except Exception, e:
+    return filename, '%s: %s' % (e.__class__.__name__, e)
+  return filename, None
+
+def GetOutputFilename(filename, output_dir, mode):
+  name = os.path.splitext(os.path.basename(filename))[0]
+  return os.path.join(output_dir or os.path.dirname(filename),
+      '%s.%s.jpg' % (name, mode))
+
+def Main(argv):
+  option_parser = optparse.OptionParser(
+      usage='%prog [options] <mpo-file>...')
+  option_parser.add_option('-m', '--mode', default='anaglyph',
+      choices=sorted(RENDERERS.keys()),
+      help='One of %s [default: %%default]' % ', '.join(sorted(RENDERERS)))
+  option_parser.add_option('-d', '--output-dir',
+      help='Directory for rendered images [default: next to each input]')
+  option_parser.add_option('-q', '--quality', type='int',
+      default=DEFAULT_QUALITY, help='JPEG quality [default: %default]')
+  option_parser.add_option('-j', '--jobs', type='int',
+      default=multiprocessing.cpu_count(),
+      help='Number of worker processes [default: %default]')
+  options, args = option_parser.parse_args(argv)
+  if not args:
+    option_parser.error('Expected at least one MPO file')
+
+  tasks = [(filename, options.mode,
+      GetOutputFilename(filename, options.output_dir, options.mode),
+      options.quality) for filename in args]
+  pool = multiprocessing.Pool(max(options.jobs, 1))
+  num_failed = 0
+  try:
+    for filename, error in pool.imap_unordered(RenderOne, tasks):
+      if error:
+        num_failed += 1
+        print '%s: %s' % (filename, error)
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+  return num_failed and 1 or 0
+
+if __name__ == '__main__':
+  sys.exit(Main(sys.argv[1:]))
@@ -0,0 +1,167 @@
+#!/usr/bin/python
+
+"""Serves renderings of the MPO files under a directory over HTTP.
+
+  GET /render/<path>?view=anaglyph&scale=2  JPEG of one view of a file
+  GET /info/<path>                          JSON MpoInfo of a file
+  GET /stats                                JSON latencies and cache stats
+
+view is left, right or one of the render_mpo.py modes, and scale is 1, 2,
+4 or 8. Each connection gets a thread and decoding runs on a fixed pool of
+worker threads shared by all of them, see mpo_service.py. Use
+load_test_mpo.py to drive it. Requires NumPy and PIL.
+"""
+
+import sys, os, json, time, urllib, urlparse, threading, collections
+import multiprocessing, optparse, BaseHTTPServer, SocketServer
+
+import mpo, mpo_service
+
+DEFAULT_PORT = 8080
+# Connections waiting to be accepted, raised from 5 so that a burst from a
+# load test is not refused.
+LISTEN_BACKLOG = 128
+
+class HttpError(Exception):
+  def __init__(self, status, message):
+    Exception.__init__(self, message)
+    self.status = status
+
+class RenderServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  request_queue_size = LISTEN_BACKLOG
+
+  def __init__(self, address, root, service, verbose=False):
+    BaseHTTPServer.HTTPServer.__init__(self, address, RequestHandler)
+    self.root = os.path.realpath(root)
+    self.service = service
+    self.verbose = verbose
+    self.start_time = time.time()
+    # Route -> LatencyHistogram of whole requests, including waits for
+    # coalesced work.
+    self.latencies = collections.defaultdict(mpo_service.LatencyHistogram)
+    self.status_counts = collections.defaultdict(int)
+    self.stats_lock = threading.Lock()
+
+  def GetPath(self, relative_path):
+    """Returns the file a request path names, refusing any outside root."""
+    path = os.path.realpath(os.path.join(self.root,
+        urllib.unquote(relative_path)))
+    if not path.startswith(os.path.join(self.root, '')):
+      raise HttpError(403, 'Outside the served directory')
+    if not os.path.isfile(path):
+      raise HttpError(404, 'No such file')
+    return path
+
+  def RecordRequest(self, route, status, seconds):
+    with self.stats_lock:
+      histogram = self.latencies[route]
+      self.status_counts[status] += 1
+    histogram.Add(seconds)
+
+  def GetStats(self):
+    with self.stats_lock:
+      latencies = dict(self.latencies)
+      status_counts = dict(self.status_counts)
+    stats = self.service.GetStats()
+    stats['uptime'] = time.time() - self.start_time
+    stats['status_counts'] = status_counts
+    stats['request_latency'] = dict((route, histogram.GetStats())
+        for route, histogram in latencies.iteritems())
+    return stats
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):
+    start = time.time()
+    url = urlparse.urlparse(self.path)
+    route, _, relative_path = url.path.lstrip('/').partition('/')
+    query = dict(urlparse.parse_qsl(url.query))
+    status = 200
+    try:
+      if route == 'render':
+        body = self.Render(relative_path, query)
+        content_type = 'image/jpeg'
+      elif route == 'info':
+        info = mpo.ParseMpoFile(self.server.GetPath(relative_path))
+        body = json.dumps(info.ToDict(), sort_keys=True)
+        content_type = 'application/json'
+      elif route == 'stats':
+        body = json.dumps(self.server.GetStats(), sort_keys=True, indent=1)
+        content_type = 'application/json'
+      else:
+        route = 'other'
+        raise HttpError(404, 'Unknown route')
+    except HttpError, e:
+      status, body = e.status, str(e)
+    except Exception, e:
+      status, body = 500, '%s: %s' % (e.__class__.__name__, e)
+    if status != 200:
+      content_type = 'text/plain'
+      body += '\n'
+    self.send_response(status)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+    self.server.RecordRequest(route, status, time.time() - start)
+
+  def Render(self, relative_path, query):
+    view = query.get('view', 'anaglyph')
+    if view not in mpo_service.VIEWS:
+      raise HttpError(400, 'view must be one of %s'
+          % ', '.join(mpo_service.VIEWS))
+    try:
+      scale = int(query.get('scale', 1))
+    except ValueError:
+      scale = None
+    if scale not in mpo_service.SCALES:
+      raise HttpError(400, 'scale must be one of %s'
+          % ', '.join(str(scale) for scale in mpo_service.SCALES))
+    return self.server.service.Render(self.server.GetPath(relative_path),
+        view, scale)
+
+  def log_message(self, format, *args):
+    if self.server.verbose:
+      BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+def Main(argv):
+  option_parser = optparse.OptionParser(usage='%prog [options] <dir>')
+  option_parser.add_option('--host', default='localhost',
+      help='Address to listen on [default: %default]')
+  option_parser.add_option('-p', '--port', type='int', default=DEFAULT_PORT,
+      help='Port to listen on [default: %default]')
+  option_parser.add_option('-j', '--jobs', type='int',
+      default=multiprocessing.cpu_count(),
+      help='Number of decode and composite worker threads '
+          '[default: %default]')
+  option_parser.add_option('--cache-mb', type='int',
+      default=mpo_service.DEFAULT_CACHE_BYTES >> 20,
+      help='Megabytes of decoded pixels to keep [default: %default]')
+  option_parser.add_option('-q', '--quality', type='int',
+      default=mpo_service.DEFAULT_QUALITY,
+      help='JPEG quality of renderings [default: %default]')
+  option_parser.add_option('-v', '--verbose', action='store_true',
+      default=False, help='Log every request')
+  options, args = option_parser.parse_args(argv)
+  if len(args) != 1 or not os.path.isdir(args[0]):
+    option_parser.error('Expected one directory to serve')
+
+  service = mpo_service.RenderService(options.jobs, options.cache_mb << 20,
+      options.quality)
+  server = RenderServer((options.host, options.port), args[0], service,
+      options.verbose)
+  sys.stderr.write('Serving %s on http://%s:%d/\n' % (server.root,
+      options.host, server.server_address[1]))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    service.Close()
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(Main(sys.argv[1:]))
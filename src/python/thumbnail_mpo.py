@@ -0,0 +1,90 @@
+#!/usr/bin/python
+
+"""Writes a preview JPEG for each image of MPO files.
+
+The Exif thumbnail stored in each image's APP1 segment is copied out as is,
+so a preview costs a few KB of reads. Images without one are decoded at
+reduced scale instead, which needs PIL.
+"""
+
+import sys, os, io, optparse
+
+import mpo
+
+DEFAULT_MAX_SIZE = 160
+DEFAULT_QUALITY = 85
+
+def DecodeThumbnail(image_data, max_size, quality=DEFAULT_QUALITY):
+  """Returns JPEG data of image_data scaled to fit in max_size x max_size."""
+  # Imported here so that PIL is only needed for the fallback.
+  from PIL import JpegImagePlugin
+  image = JpegImagePlugin.JpegImageFile(io.BytesIO(image_data))
+  # Lets the decoder drop DCT coefficients rather than decode full size.
+  image.draft('RGB', (max_size, max_size))
+  image.thumbnail((max_size, max_size))
+  out = io.BytesIO()
+  image.save(out, 'JPEG', quality=quality)
+  return out.getvalue()
+
+def GetThumbnails(filename, max_size=DEFAULT_MAX_SIZE):
+  """Returns a list of (JPEG data, is_embedded) for each image of an MPO."""
+  mpo_file = open(filename, 'rb')
+  try:
+    parser = mpo.ImageParser()
+    parser.ParseHeaders(mpo_file)
+    thumbnails = []
+    data = None
+    try:
+      for i in xrange(len(parser.image_offsets)):
+        thumbnail = parser.ReadThumbnail(mpo_file, i)
+        if thumbnail is not None:
+          thumbnails.append((thumbnail, True))
+          continue
+        if data is None:
+          data = mpo.MapFile(mpo_file)
+        start, end = parser.GetImageRange(i)
+        thumbnails.append((DecodeThumbnail(buffer(data, start, end - start),
+            max_size), False))
+    finally:
+      if data is not None:
+        data.close()
+    return thumbnails
+  finally:
+    mpo_file.close()
+
+def GetOutputFilename(filename, output_dir, i):
+  name = os.path.splitext(os.path.basename(filename))[0]
+  return os.path.join(output_dir or os.path.dirname(filename),
+      '%s.thumb%d.jpg' % (name, i))
+
+def Main(argv):
+  option_parser = optparse.OptionParser(
+      usage='%prog [options] <mpo-file>...')
+  option_parser.add_option('-d', '--output-dir',
+      help='Directory for thumbnails [default: next to each input]')
+  option_parser.add_option('-s', '--max-size', type='int',
+      default=DEFAULT_MAX_SIZE,
+      help='Largest side of decoded thumbnails [default: %default]')
+  options, args = option_parser.parse_args(argv)
+  if not args:
+    option_parser.error('Expected at least one MPO file')
+
+  num_failed = 0
+  for filename in args:
+    try:
+      thumbnails = GetThumbnails(filename, options.max_size)
+    except Exception, e:
+      num_failed += 1
+      print '%s: %s: %s' % (filename, e.__class__.__name__, e)
+      continue
+    for i, (thumbnail, is_embedded) in enumerate(thumbnails):
+      output_filename = GetOutputFilename(filename, options.output_dir, i)
+      out_file = open(output_filename, 'wb')
+      out_file.write(thumbnail)
+      out_file.close()
+      print '%s: %s thumbnail, %d bytes' % (output_filename,
+          is_embedded and 'embedded' or 'decoded', len(thumbnail))
+  return num_failed and 1 or 0
+
+if __name__ == '__main__':
+  sys.exit(Main(sys.argv[1:]))
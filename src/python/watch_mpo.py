@@ -0,0 +1,277 @@
+#!/usr/bin/python
+
+"""Parses and extracts MPO files as they appear under directory trees.
+
+A state file records the size and mtime of every file processed, so a run
+only parses files that are new or changed since the last one. After the
+first scan, inotify reports new files as they are written, or the trees
+are rescanned every --poll-interval seconds where inotify is unavailable.
+Files are handed to a fixed number of worker processes. At most --max-pending
+files are queued, and scanning waits for workers beyond that.
+
+Writes one JSON line per processed file, as batch_parse_mpo.py does. With
+--once the trees are scanned and processed once, which replaces a cron job
+that reparses everything.
+"""
+
+import sys, os, json, time, errno, threading, Queue, multiprocessing
+import optparse
+
+import mpo, mpo_watch
+
+DEFAULT_POLL_INTERVAL = 60
+DEFAULT_SETTLE_TIME = 2
+# How often results are collected and the state committed while waiting.
+WAKE_INTERVAL = 1
+
+def GetOutputPattern(output_dir, root, filename):
+  """Returns the image path pattern for a file, mirroring its path under
+  root."""
+  name = os.path.splitext(os.path.relpath(filename, root))[0]
+  return os.path.join(output_dir, name.replace('%', '%%') + '.image%d.jpg')
+
+def ProcessOne(args):
+  filename, output_pattern = args
+  result = {'path': filename}
+  try:
+    if output_pattern:
+      output_subdir = os.path.dirname(output_pattern)
+      try:
+        os.makedirs(output_subdir)
+      except OSError, e:
+        if e.errno != errno.EEXIST:
+          raise
+      info, _ = mpo.ExtractImages(filename, output_pattern)
+    else:
+      info = mpo.ParseMpoFile(filename)
+    result.update(info.ToDict())
+  except Exception, e:
+    result['error'] = '%s: %s' % (e.__class__.__name__, e)
+  return result
+
+def RunTask(task):
+  """Runs a BoundedPool task in a worker and returns (result, error)."""
+  function, args = task
+  try:
+    return function(args), None
+  except Exception, e:
+    return None, '%s: %s' % (e.__class__.__name__, e)
+
+class BoundedPool:
+  """A process pool that blocks Submit while max_pending tasks are
+  unfinished, so that a burst of new files cannot queue without bound.
+
+  Results are collected on the pool's result thread and handed back to the
+  calling thread by GetResults. Tasks run through RunTask, so an exception
+  comes back as an error and its slot is still released; the pool only
+  calls back for tasks that return.
+  """
+
+  def __init__(self, jobs, max_pending):
+    self.pool = multiprocessing.Pool(jobs)
+    self.slots = threading.BoundedSemaphore(max_pending)
+    self.results = Queue.Queue()
+    self.num_pending = 0
+
+  def Submit(self, function, args, context):
+    self.slots.acquire()
+    self.num_pending += 1
+    self.pool.apply_async(RunTask, ((function, args),),
+        callback=lambda outcome: self.OnResult(context, *outcome))
+
+  def OnResult(self, context, result, error):
+    self.results.put((context, result, error))
+    self.slots.release()
+
+  def GetResults(self, block=False):
+    """Returns the (context, result, error) of the tasks finished so far, or
+    with block waits for every submitted task. result is None where the task
+    raised."""
+    results = []
+    while self.num_pending:
+      try:
+        results.append(self.results.get(block))
+      except Queue.Empty:
+        break
+      self.num_pending -= 1
+    return results
+
+  def Close(self):
+    self.pool.close()
+    self.pool.join()
+
+  def Terminate(self):
+    self.pool.terminate()
+    self.pool.join()
+
+class Watcher:
+  """Finds files that need processing and submits them to a BoundedPool."""
+
+  def __init__(self, roots, state, pool, output_dir, settle_time):
+    self.roots = roots
+    self.state = state
+    self.pool = pool
+    self.output_dir = output_dir
+    self.settle_time = settle_time
+    # path -> (size, mtime) of files submitted and not finished.
+    self.in_flight = {}
+    # Files modified too recently to be complete, checked again later.
+    self.unsettled = set()
+    self.num_processed = 0
+    self.num_failed = 0
+
+  def GetRoot(self, path):
+    for root in self.roots:
+      if path == root or path.startswith(os.path.join(root, '')):
+        return root
+    return None
+
+  def Consider(self, path, size, mtime, now):
+    if self.state.IsProcessed(path, size, mtime):
+      return False
+    if self.in_flight.get(path) == (size, mtime):
+      return False
+    if now - mtime < self.settle_time:
+      self.unsettled.add(path)
+      return False
+    output_pattern = None
+    if self.output_dir:
+      output_pattern = GetOutputPattern(self.output_dir, self.GetRoot(path),
+          path)
+    self.in_flight[path] = (size, mtime)
+    self.pool.Submit(ProcessOne, (path, output_pattern), (path, size, mtime))
+    # Results are collected while submitting so that a long scan still
+    # records progress.
+    self.CollectResults()
+    return True
+
+  def ScanAll(self):
+    """Scans every root and returns (files seen, files submitted)."""
+    num_seen = 0
+    num_submitted = 0
+    now = time.time()
+    for root in self.roots:
+      seen_paths = set()
+      for path, size, mtime in mpo_watch.ScanTree(root):
+        seen_paths.add(path)
+        if self.Consider(path, size, mtime, now):
+          num_submitted += 1
+      self.state.DeleteMissing(root, seen_paths)
+      num_seen += len(seen_paths)
+    self.state.Commit()
+    return num_seen, num_submitted
+
+  def ScanPaths(self, paths):
+    now = time.time()
+    for path in paths:
+      if self.GetRoot(path) is None:
+        continue
+      for file_path, size, mtime in mpo_watch.ScanTree(path):
+        self.Consider(file_path, size, mtime, now)
+
+  def CheckUnsettled(self):
+    paths = self.unsettled
+    self.unsettled = set()
+    self.ScanPaths(paths)
+
+  def CollectResults(self, block=False):
+    for (path, size, mtime), result, error in self.pool.GetResults(block):
+      if error:
+        result = {'path': path, 'error': error}
+      if self.in_flight.get(path) == (size, mtime):
+        del self.in_flight[path]
+      # Failed files are recorded too, so they are retried only once they
+      # change.
+      self.state.Put(path, size, mtime)
+      self.num_processed += 1
+      if 'error' in result:
+        self.num_failed += 1
+      sys.stdout.write(json.dumps(result, sort_keys=True) + '\n')
+    sys.stdout.flush()
+
+def Main(argv):
+  option_parser = optparse.OptionParser(
+      usage='%prog [options] --state <state-file> <dir>...')
+  option_parser.add_option('--state',
+      help='SQLite file recording the files already processed')
+  option_parser.add_option('-d', '--output-dir',
+      help='Extract the images of each file under this directory')
+  option_parser.add_option('--once', action='store_true', default=False,
+      help='Scan and process once, then exit')
+  option_parser.add_option('--poll', action='store_true', default=False,
+      help='Rescan on a timer even if inotify is available')
+  option_parser.add_option('--poll-interval', type='float',
+      default=DEFAULT_POLL_INTERVAL,
+      help='Seconds between rescans when polling [default: %default]')
+  option_parser.add_option('--settle-time', type='float',
+      default=DEFAULT_SETTLE_TIME,
+      help='Leave files modified this recently until later, as they may '
+          'still be being written [default: %default]')
+  option_parser.add_option('-j', '--jobs', type='int',
+      default=multiprocessing.cpu_count(),
+      help='Number of worker processes [default: %default]')
+  option_parser.add_option('--max-pending', type='int', default=0,
+      help='Files queued for workers before scanning waits '
+          '[default: 4 per job]')
+  options, args = option_parser.parse_args(argv)
+  if not options.state or not args:
+    option_parser.error('Expected a state file and at least one directory')
+  jobs = max(options.jobs, 1)
+  max_pending = options.max_pending or 4 * jobs
+
+  roots = [os.path.abspath(arg) for arg in args]
+  state = mpo_watch.WatchState(options.state)
+  file_watcher = None
+  if not options.once:
+    file_watcher = mpo_watch.CreateWatcher(options.poll_interval,
+        options.poll)
+    # Watches go in before the first scan so that no file written during it
+    # is missed.
+    for root in roots:
+      file_watcher.AddTree(root)
+    sys.stderr.write('Watching with %s\n' % file_watcher.__class__.__name__)
+  pool = BoundedPool(jobs, max_pending)
+  watcher = Watcher(roots, state, pool, options.output_dir,
+      options.settle_time)
+  try:
+    is_first_scan = True
+    while True:
+      start = time.time()
+      num_seen, num_submitted = watcher.ScanAll()
+      if is_first_scan or num_submitted:
+        sys.stderr.write('Scanned %d files in %.2fs, %d to process\n' % (
+            num_seen, time.time() - start, num_submitted))
+      is_first_scan = False
+      if options.once:
+        break
+      while True:
+        watcher.CollectResults()
+        state.Commit()
+        timeout = WAKE_INTERVAL
+        if watcher.unsettled:
+          timeout = min(timeout, options.settle_time)
+        paths = file_watcher.Wait(timeout)
+        if paths is None:
+          break
+        watcher.ScanPaths(paths)
+        watcher.CheckUnsettled()
+    pool.Close()
+    watcher.CollectResults(True)
+  except KeyboardInterrupt:
+    pool.Terminate()
+  except:
+    pool.Terminate()
+    raise
+  finally:
+    if file_watcher is not None:
+      file_watcher.Close()
+    state.Close()
+  if watcher.unsettled:
+    sys.stderr.write('Left %d files still being written for the next run\n'
+        % len(watcher.unsettled))
+  sys.stderr.write('Processed %d files (%d failed)\n' % (
+      watcher.num_processed, watcher.num_failed))
+  return watcher.num_failed and 1 or 0
+
+if __name__ == '__main__':
+  sys.exit(Main(sys.argv[1:]))
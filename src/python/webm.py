@@ -0,0 +1,326 @@
+"""Streaming WebM writer for VP8 frames.
+
+Mirrors encoder/webm.js and encoder/ebml.js, which build the whole file in
+memory in the browser. WebmWriter instead writes each frame to the file as it
+is added. Sizes and positions that are only known at the end are written as
+fixed width placeholders and patched by seeking back in Finish, so memory use
+does not depend on the number of frames.
+"""
+
+import struct, array
+
+# EBML header, see Ebml.TagId.
+EBML_ID = 0x1a45dfa3
+EBML_VERSION_ID = 0x4286
+EBML_READ_VERSION_ID = 0x42f7
+EBML_MAX_ID_LENGTH_ID = 0x42f2
+EBML_MAX_SIZE_LENGTH_ID = 0x42f3
+DOC_TYPE_ID = 0x4282
+DOC_TYPE_VERSION_ID = 0x4287
+DOC_TYPE_READ_VERSION_ID = 0x4285
+
+# WebM elements, see Webm.EbmlTagId.
+SEGMENT_ID = 0x18538067
+SEGMENT_INFO_ID = 0x1549a966
+TIMECODE_SCALE_ID = 0x2ad7b1
+MUXING_APP_ID = 0x4d80
+WRITING_APP_ID = 0x5741
+DURATION_ID = 0x4489
+TRACKS_ID = 0x1654ae6b
+TRACK_ENTRY_ID = 0xae
+TRACK_NUMBER_ID = 0xd7
+TRACK_UID_ID = 0x73c5
+TRACK_FLAG_LACING_ID = 0x9c
+TRACK_LANGUAGE_ID = 0x22b59c
+TRACK_CODEC_ID_ID = 0x86
+TRACK_CODEC_NAME_ID = 0x258688
+TRACK_TYPE_ID = 0x83
+TRACK_VIDEO_ID = 0xe0
+TRACK_VIDEO_PIXEL_WIDTH_ID = 0xb0
+TRACK_VIDEO_PIXEL_HEIGHT_ID = 0xba
+TRACK_VIDEO_STEREO_MODE_ID = 0x53b8
+CLUSTER_ID = 0x1f43b675
+CLUSTER_TIMECODE_ID = 0xe7
+CLUSTER_FRAME_BLOCK_ID = 0xa3
+SEEK_HEAD_ID = 0x114d9b74
+SEEK_ENTRY_ID = 0x4dbb
+SEEK_ID_ID = 0x53ab
+SEEK_POSITION_ID = 0x53ac
+CUES_ID = 0x1c53bb6b
+CUE_POINT_ID = 0xbb
+CUE_TIME_ID = 0xb3
+CUE_TRACK_POSITIONS_ID = 0xb7
+CUE_TRACK_ID = 0xf7
+CUE_CLUSTER_POSITION_ID = 0xf1
+
+MKV_STEREO_MODE_MONO = 0
+MKV_STEREO_MODE_SIDE_BY_SIDE = 1
+
+# Max duration of a cluster in milliseconds. Block timecodes are signed 16
+# bit offsets from their cluster's timecode, so this must stay below 32768.
+CLUSTER_MAX_DURATION = 30000
+
+# Timecodes are in milliseconds.
+TIMECODE_SCALE = 1000000
+
+TRACK_NUMBER = 1
+MUXING_APP = 'pics3'
+
+VP8_FRAME_MARKER = '\x9d\x01\x2a'
+
+# Width of sizes and positions that are patched once the file is complete.
+PLACEHOLDER_SIZE_LENGTH = 8
+SEEK_POSITION_LENGTH = 8
+
+BLOCK_HEADER_STRUCT = struct.Struct('>BhB')
+KEY_FRAME_FLAG = 0x80
+
+def EncodeId(value):
+  """Encodes an element id, which already carries its length marker."""
+  parts = []
+  while value > 0:
+    parts.append(chr(value & 0xff))
+    value >>= 8
+  return ''.join(reversed(parts))
+
+def EncodeUnsigned(value, length=None):
+  """Encodes a big endian unsigned int in the fewest bytes, or in length."""
+  assert value >= 0, 'Number must be >= 0'
+  parts = []
+  while value > 0 or not parts:
+    parts.append(chr(value & 0xff))
+    value >>= 8
+  if length is not None:
+    assert len(parts) <= length, 'Value too large for %d bytes' % length
+    parts.extend('\0' * (length - len(parts)))
+  return ''.join(reversed(parts))
+
+def EncodeSize(value, length=None):
+  """Encodes an element size as an EBML variable length int."""
+  if length is None:
+    length = 1
+    # All ones is reserved for unknown sizes.
+    while value >= (1 << (7 * length)) - 1:
+      length += 1
+  assert length <= 8 and value < (1 << (7 * length)) - 1, (
+      'Size %d does not fit in %d bytes' % (value, length))
+  return EncodeUnsigned(value | (1 << (7 * length)), length)
+
+def EncodeElement(element_id, payload):
+  return EncodeId(element_id) + EncodeSize(len(payload)) + payload
+
+def EncodeUnsignedElement(element_id, value):
+  return EncodeElement(element_id, EncodeUnsigned(value))
+
+def EncodeDoubleElement(element_id, value):
+  return EncodeElement(element_id, struct.pack('>d', value))
+
+def EncodeMasterElement(element_id, children):
+  return EncodeElement(element_id, ''.join(children))
+
+def ParseWebp(data):
+  """Returns (width, height, vp8_data) of a lossy WebP image.
+
+  Mirrors Webm.parseWebpImage_, which only supports the simple 'VP8 ' form.
+  """
+  riff_id, riff_length, webp_id, vp8_tag, vp8_length = struct.unpack_from(
+      '<4sI4s4sI', data)
+  if riff_id != 'RIFF' or webp_id != 'WEBP':
+    raise Exception('Expected a RIFF WEBP file')
+  if riff_length != len(data) - 8:
+    raise Exception('Riff length expected to be full webp file')
+  if vp8_tag != 'VP8 ':
+    raise Exception('Expected a lossy VP8 image but found %r' % vp8_tag)
+  vp8_data = data[20:20 + vp8_length]
+  # Skip the three byte frame tag.
+  if vp8_data[3:6] != VP8_FRAME_MARKER:
+    raise Exception('Expected VP8 frame marker')
+  width_data, height_data = struct.unpack_from('<HH', vp8_data, 6)
+  if width_data >> 14 or height_data >> 14:
+    raise Exception('Expected no VP8 scaling')
+  return width_data & 0x3fff, height_data & 0x3fff, vp8_data
+
+class WebmWriter:
+  """Writes a single VP8 track to a seekable file.
+
+  The layout follows Webm.encodeEbml_ with two differences that make
+  streaming possible. The seek head points at the segment info, tracks and
+  cues but not at each cluster, because the number of clusters is unknown
+  when it is written. Cluster and cue timecodes are absolute.
+  """
+
+  def __init__(self, out_file, is_stereo_side_by_side=False):
+    self.out_file = out_file
+    self.is_stereo_side_by_side = is_stereo_side_by_side
+    self.width = None
+    self.height = None
+    self.duration = 0
+    self.segment_size_offset = None
+    self.segment_data_offset = None
+    self.duration_offset = None
+    # Seek head entry id -> file offset of its position placeholder.
+    self.seek_position_offsets = {}
+    self.cluster_offset = None
+    self.cluster_size_offset = None
+    self.cluster_timecode = 0
+    # A cue point per frame as in Webm.encodeClusters_, kept as arrays.
+    self.cue_timecodes = array.array('L')
+    self.cue_cluster_offsets = array.array('L')
+
+  def Tell(self):
+    return self.out_file.tell()
+
+  def Write(self, data):
+    self.out_file.write(data)
+
+  def Patch(self, offset, data):
+    end = self.Tell()
+    self.out_file.seek(offset)
+    self.out_file.write(data)
+    self.out_file.seek(end)
+
+  def WritePlaceholderHeader(self, element_id):
+    """Writes an element id and a placeholder size. Returns the size offset."""
+    self.Write(EncodeId(element_id))
+    size_offset = self.Tell()
+    self.Write(EncodeSize(0, PLACEHOLDER_SIZE_LENGTH))
+    return size_offset
+
+  def PatchSize(self, size_offset):
+    """Sets a placeholder size to cover everything written after it."""
+    size = self.Tell() - size_offset - PLACEHOLDER_SIZE_LENGTH
+    self.Patch(size_offset, EncodeSize(size, PLACEHOLDER_SIZE_LENGTH))
+
+  def GetSegmentPosition(self):
+    return self.Tell() - self.segment_data_offset
+
+  def WriteHeaders(self):
+    self.Write(EncodeMasterElement(EBML_ID, [
+      EncodeUnsignedElement(EBML_VERSION_ID, 1),
+      EncodeUnsignedElement(EBML_READ_VERSION_ID, 1),
+      EncodeUnsignedElement(EBML_MAX_ID_LENGTH_ID, 4),
+      EncodeUnsignedElement(EBML_MAX_SIZE_LENGTH_ID, 8),
+      EncodeElement(DOC_TYPE_ID, 'webm'),
+      EncodeUnsignedElement(DOC_TYPE_VERSION_ID, 2),
+      EncodeUnsignedElement(DOC_TYPE_READ_VERSION_ID, 2),
+    ]))
+    self.segment_size_offset = self.WritePlaceholderHeader(SEGMENT_ID)
+    self.segment_data_offset = self.Tell()
+
+    # The seek head is built before it is written so that the offsets of its
+    # position placeholders are known.
+    seek_ids = (SEGMENT_INFO_ID, TRACKS_ID, CUES_ID)
+    seek_entries = [EncodeMasterElement(SEEK_ENTRY_ID, [
+      EncodeElement(SEEK_ID_ID, EncodeId(seek_id)),
+      EncodeElement(SEEK_POSITION_ID,
+          EncodeUnsigned(0, SEEK_POSITION_LENGTH)),
+    ]) for seek_id in seek_ids]
+    seek_head = EncodeMasterElement(SEEK_HEAD_ID, seek_entries)
+    entry_offset = self.Tell() + len(seek_head) - sum(
+        len(entry) for entry in seek_entries)
+    for seek_id, entry in zip(seek_ids, seek_entries):
+      self.seek_position_offsets[seek_id] = (
+          entry_offset + len(entry) - SEEK_POSITION_LENGTH)
+      entry_offset += len(entry)
+    self.Write(seek_head)
+
+    self.PatchSeekPosition(SEGMENT_INFO_ID)
+    segment_info = EncodeMasterElement(SEGMENT_INFO_ID, [
+      EncodeUnsignedElement(TIMECODE_SCALE_ID, TIMECODE_SCALE),
+      EncodeElement(MUXING_APP_ID, MUXING_APP),
+      EncodeElement(WRITING_APP_ID, MUXING_APP),
+      EncodeDoubleElement(DURATION_ID, 0),
+    ])
+    # Duration is the last element, so its payload ends the segment info.
+    self.duration_offset = self.Tell() + len(segment_info) - 8
+    self.Write(segment_info)
+
+    self.PatchSeekPosition(TRACKS_ID)
+    video_width = self.width
+    if self.is_stereo_side_by_side:
+      video_width = self.width // 2
+    video = [
+      EncodeUnsignedElement(TRACK_VIDEO_PIXEL_WIDTH_ID, video_width),
+      EncodeUnsignedElement(TRACK_VIDEO_PIXEL_HEIGHT_ID, self.height),
+    ]
+    if self.is_stereo_side_by_side:
+      video.append(EncodeUnsignedElement(TRACK_VIDEO_STEREO_MODE_ID,
+          MKV_STEREO_MODE_SIDE_BY_SIDE))
+    self.Write(EncodeMasterElement(TRACKS_ID, [
+      EncodeMasterElement(TRACK_ENTRY_ID, [
+        EncodeUnsignedElement(TRACK_NUMBER_ID, TRACK_NUMBER),
+        EncodeUnsignedElement(TRACK_UID_ID, 1),
+        EncodeUnsignedElement(TRACK_FLAG_LACING_ID, 0),
+        EncodeElement(TRACK_LANGUAGE_ID, 'und'),
+        EncodeElement(TRACK_CODEC_ID_ID, 'V_VP8'),
+        EncodeElement(TRACK_CODEC_NAME_ID, 'VP8'),
+        EncodeUnsignedElement(TRACK_TYPE_ID, 1),
+        EncodeMasterElement(TRACK_VIDEO_ID, video),
+      ]),
+    ]))
+
+  def PatchSeekPosition(self, seek_id):
+    """Points seek_id's seek head entry at the current position."""
+    self.Patch(self.seek_position_offsets[seek_id],
+        EncodeUnsigned(self.GetSegmentPosition(), SEEK_POSITION_LENGTH))
+
+  def StartCluster(self):
+    self.cluster_offset = self.GetSegmentPosition()
+    self.cluster_size_offset = self.WritePlaceholderHeader(CLUSTER_ID)
+    self.cluster_timecode = int(round(self.duration))
+    self.Write(EncodeUnsignedElement(CLUSTER_TIMECODE_ID,
+        self.cluster_timecode))
+
+  def FinishCluster(self):
+    if self.cluster_size_offset is not None:
+      self.PatchSize(self.cluster_size_offset)
+      self.cluster_size_offset = None
+
+  def AddFrame(self, width, height, vp8_data, duration):
+    """Appends a VP8 key frame shown for duration milliseconds."""
+    if duration <= 0:
+      raise Exception('Expected a positive frame duration')
+    if self.width is None:
+      self.width = width
+      self.height = height
+      self.WriteHeaders()
+    elif (width, height) != (self.width, self.height):
+      raise Exception('All frames should be %dx%d but got %dx%d'
+          % (self.width, self.height, width, height))
+    timecode = int(round(self.duration))
+    if (self.cluster_size_offset is None
+        or timecode - self.cluster_timecode >= CLUSTER_MAX_DURATION):
+      self.FinishCluster()
+      self.StartCluster()
+    block_header = BLOCK_HEADER_STRUCT.pack(TRACK_NUMBER | 0x80,
+        timecode - self.cluster_timecode, KEY_FRAME_FLAG)
+    self.Write(EncodeId(CLUSTER_FRAME_BLOCK_ID)
+        + EncodeSize(len(block_header) + len(vp8_data)) + block_header)
+    self.Write(vp8_data)
+    self.cue_timecodes.append(timecode)
+    self.cue_cluster_offsets.append(self.cluster_offset)
+    self.duration += duration
+
+  def AddWebp(self, webp_data, duration):
+    width, height, vp8_data = ParseWebp(webp_data)
+    self.AddFrame(width, height, vp8_data, duration)
+
+  def Finish(self):
+    """Writes the cues and patches the sizes, positions and duration."""
+    if self.width is None:
+      raise Exception('At least one frame expected')
+    self.FinishCluster()
+    self.PatchSeekPosition(CUES_ID)
+    cues_size_offset = self.WritePlaceholderHeader(CUES_ID)
+    for timecode, cluster_offset in zip(self.cue_timecodes,
+        self.cue_cluster_offsets):
+      self.Write(EncodeMasterElement(CUE_POINT_ID, [
+        EncodeUnsignedElement(CUE_TIME_ID, timecode),
+        EncodeMasterElement(CUE_TRACK_POSITIONS_ID, [
+          EncodeUnsignedElement(CUE_TRACK_ID, TRACK_NUMBER),
+          EncodeUnsignedElement(CUE_CLUSTER_POSITION_ID, cluster_offset),
+        ]),
+      ]))
+    self.PatchSize(cues_size_offset)
+    self.PatchSize(self.segment_size_offset)
+    self.Patch(self.duration_offset, struct.pack('>d', self.duration))
@@ -1,37 +1,207 @@
 #!/usr/bin/python
 
-import sys, os
+"""Wraps files into JavaScript string arrays joined at load time.
 
-def Usage():
-  print "Usage: ./wrap_js_string.py line_prefix <input_file>"
-  sys.exit(1)
+With one input and no output directory the wrapped file is printed, as
+before. With --output-dir each input is written to <name>.js there, and with
+--cache inputs whose contents, prefix and options are unchanged since the
+last run are skipped, so a build only rewraps what changed.
 
-if len(sys.argv) != 3:
-  Usage()
+Inputs are read and wrapped in fixed size chunks and lines are written as
+they are produced, so time and memory do not grow with the square of the
+file size.
+"""
 
-line_prefix = sys.argv[1]
-in_filename = sys.argv[2]
-if not os.path.exists(in_filename):
-  Usage()
+import sys, os, re, json, hashlib, optparse
 
-f = open(in_filename, 'r')
+LINE_LENGTH = 78
+CONTINUATION_PREFIX = "    '"
+READ_CHUNK_SIZE = 1 << 16
+# Part of the cache key, so that output is rewrapped when wrapping changes.
+WRAP_VERSION = 1
 
-data = line_prefix + "['" + f.read().strip() + "'].join('');"
+def ReadStripped(in_file, chunk_size=READ_CHUNK_SIZE):
+  """Yields the contents of in_file without leading or trailing whitespace.
 
-f.close()
+  Trailing whitespace of a chunk is held back until more data follows it.
+  """
+  started = False
+  held_whitespace = ''
+  while True:
+    chunk = in_file.read(chunk_size)
+    if not chunk:
+      return
+    if not started:
+      chunk = chunk.lstrip()
+      if not chunk:
+        continue
+      started = True
+    stripped = chunk.rstrip()
+    if stripped:
+      yield held_whitespace + stripped
+      held_whitespace = chunk[len(stripped):]
+    else:
+      held_whitespace += chunk
 
-first_line = True
+def WrapPieces(pieces):
+  """Yields output lines for the concatenation of pieces.
 
-while data:
-  if first_line:
-    data_len = 78
-  else:
-    data_len = 78 - 5
-  line = data[:data_len]
-  data = data[data_len:]
-  if not first_line:
-    line = "    '" + line
-  if data:
-    line = line + "',"
-  print line
-  first_line = False
+  The first line is LINE_LENGTH characters of the data and each later line
+  holds LINE_LENGTH - 5 after the continuation prefix. Every line but the
+  last ends with "',". Only the unwrapped remainder of the previous piece is
+  kept, so every character is copied a bounded number of times.
+  """
+  pending = ''
+  data_len = LINE_LENGTH
+  line_prefix = ''
+  for piece in pieces:
+    data = pending + piece
+    pos = 0
+    # A line can only be finished once it is known that more data follows.
+    while len(data) - pos > data_len:
+      yield line_prefix + data[pos:pos + data_len] + "',"
+      pos += data_len
+      data_len = LINE_LENGTH - len(CONTINUATION_PREFIX)
+      line_prefix = CONTINUATION_PREFIX
+    pending = data[pos:]
+  yield line_prefix + pending
+
+def WrapFile(line_prefix, in_file, out_file):
+  def Pieces():
+    yield line_prefix + "['"
+    for chunk in ReadStripped(in_file):
+      yield chunk
+    yield "'].join('');"
+  for line in WrapPieces(Pieces()):
+    out_file.write(line + '\n')
+
+def GetConstantName(filename):
+  """Returns a JavaScript constant name for a file, eg SAMPLE1_AUTOPARALLAX
+  for sample1-autoparallax.b64."""
+  name = os.path.splitext(os.path.basename(filename))[0]
+  return re.sub(r'[^A-Z0-9]+', '_', name.upper()).strip('_')
+
+def GetLinePrefix(line_prefix, filename):
+  return line_prefix.replace('{name}', GetConstantName(filename))
+
+def GetOutputFilename(output_dir, filename):
+  return os.path.join(output_dir,
+      os.path.splitext(os.path.basename(filename))[0] + '.js')
+
+def HashInput(line_prefix, filename, goog_provide):
+  digest = hashlib.sha1(json.dumps([WRAP_VERSION, line_prefix, goog_provide]))
+  in_file = open(filename, 'rb')
+  try:
+    while True:
+      chunk = in_file.read(READ_CHUNK_SIZE)
+      if not chunk:
+        break
+      digest.update(chunk)
+  finally:
+    in_file.close()
+  return digest.hexdigest()
+
+def GetProvidedName(line_prefix):
+  """Returns the dotted name assigned by a prefix like 'a.b.C = '."""
+  match = re.match(r'\s*([A-Za-z_$][\w$]*(?:\.[A-Za-z_$][\w$]*)+)\s*=',
+      line_prefix)
+  return match and match.group(1)
+
+def WriteWrapped(line_prefix, filename, output_filename, goog_provide):
+  # Written to a temporary file and renamed so that an interrupted build
+  # never leaves a truncated output looking up to date.
+  temp_filename = output_filename + '.tmp'
+  in_file = open(filename, 'rb')
+  try:
+    out_file = open(temp_filename, 'wb')
+    try:
+      out_file.write('// Generated by wrap_js_string.py from %s.\n\n'
+          % os.path.basename(filename))
+      if goog_provide:
+        provided_name = GetProvidedName(line_prefix)
+        if not provided_name:
+          raise Exception('Cannot find the name to provide in %r'
+              % line_prefix)
+        out_file.write("goog.provide('%s');\n\n" % provided_name)
+      WrapFile(line_prefix, in_file, out_file)
+    finally:
+      out_file.close()
+  finally:
+    in_file.close()
+  os.rename(temp_filename, output_filename)
+
+def LoadCache(cache_filename):
+  try:
+    cache_file = open(cache_filename, 'rb')
+  except IOError:
+    return {}
+  try:
+    return json.load(cache_file)
+  except ValueError:
+    return {}
+  finally:
+    cache_file.close()
+
+def SaveCache(cache_filename, cache):
+  temp_filename = cache_filename + '.tmp'
+  cache_file = open(temp_filename, 'wb')
+  try:
+    json.dump(cache, cache_file, indent=1, sort_keys=True)
+  finally:
+    cache_file.close()
+  os.rename(temp_filename, cache_filename)
+
+def Main(argv):
+  option_parser = optparse.OptionParser(
+      usage='%prog [options] <line_prefix> <input_file>...')
+  option_parser.add_option('-d', '--output-dir',
+      help='Write each input to <name>.js in this directory instead of '
+          'printing it')
+  option_parser.add_option('--cache',
+      help='JSON file of input hashes used to skip unchanged inputs')
+  option_parser.add_option('--goog-provide', action='store_true',
+      default=False, help='Start each output with a goog.provide of the '
+          'name the prefix assigns')
+  options, args = option_parser.parse_args(argv)
+  if len(args) < 2:
+    option_parser.error('Expected a line prefix and at least one input file')
+  line_prefix = args[0]
+  filenames = args[1:]
+  for filename in filenames:
+    if not os.path.isfile(filename):
+      option_parser.error('No such file %s' % filename)
+  if not options.output_dir:
+    if len(filenames) > 1 or options.cache or options.goog_provide:
+      option_parser.error('Several inputs, --cache and --goog-provide need '
+          '--output-dir')
+    WrapFile(line_prefix, open(filenames[0], 'rb'), sys.stdout)
+    return 0
+
+  if not os.path.isdir(options.output_dir):
+    os.makedirs(options.output_dir)
+  cache = {}
+  if options.cache:
+    cache = LoadCache(options.cache)
+  num_wrapped = 0
+  for filename in filenames:
+    output_filename = GetOutputFilename(options.output_dir, filename)
+    file_line_prefix = GetLinePrefix(line_prefix, filename)
+    input_hash = None
+    if options.cache:
+      input_hash = HashInput(file_line_prefix, filename, options.goog_provide)
+      if (cache.get(output_filename) == input_hash
+          and os.path.exists(output_filename)):
+        continue
+    WriteWrapped(file_line_prefix, filename, output_filename,
+        options.goog_provide)
+    num_wrapped += 1
+    if options.cache:
+      cache[output_filename] = input_hash
+      # Saved after every file so that finished work survives a failure.
+      SaveCache(options.cache, cache)
+  print 'Wrapped %d of %d files into %s' % (num_wrapped, len(filenames),
+      options.output_dir)
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(Main(sys.argv[1:]))